@@ -0,0 +1,264 @@
+# coding: utf-8
+'''
+Batched database writes for the DDI harvester
+'''
+
+import contextlib
+import logging
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+
+class BulkInserter(object):
+    '''Collect rows for 'table' and write them with one multi-row INSERT per
+    batch, committing after each batch.
+
+    Rows get their ids when they are added so callers can use them before
+    the batch is written.
+
+    :param session: SQLAlchemy session used for the writes
+    :param table: the SQLAlchemy table to insert into
+    :param batch_size: number of rows per INSERT and commit
+    :type batch_size: int
+    :param common: column values shared by all rows
+    '''
+
+    def __init__(self, session, table, batch_size=500, **common):
+        self.session = session
+        self.table = table
+        self.batch_size = max(1, batch_size)
+        self.common = common
+        self.rows = []
+        self.written = 0
+
+    def add(self, **values):
+        '''Add a row and write the batch if it is full.
+
+        :returns: id of the row
+        :rtype: unicode
+        '''
+        row = dict(self.common)
+        row.update(values)
+        row.setdefault('id', unicode(uuid.uuid4()))
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+        return row['id']
+
+    def flush(self):
+        '''Write and commit the rows collected so far.
+        '''
+        if not self.rows:
+            return
+        self.session.execute(self.table.insert(), self.rows)
+        self.session.commit()
+        self.written += len(self.rows)
+        log.debug('Inserted {n} rows into {t}'.format(n=len(self.rows),
+                                                      t=self.table.name))
+        self.rows = []
+
+
+@contextlib.contextmanager
+def indexing_suspended():
+    '''Turn off the automatic search indexing of CKAN in the block, the
+    datasets written are indexed with index_packages().
+    '''
+    from pylons import config
+    previous = config.get('ckan.search.automatic_indexing')
+    config['ckan.search.automatic_indexing'] = False
+    try:
+        yield
+    finally:
+        if previous is None:
+            del config['ckan.search.automatic_indexing']
+        else:
+            config['ckan.search.automatic_indexing'] = previous
+
+
+def index_packages(package_ids, commit=True):
+    '''Index the datasets 'package_ids' and commit the search index once,
+    or not at all if 'commit' is False.
+    '''
+    import ckan.model as model
+    from ckan.lib.search import index_for
+    from ckan.logic import get_action
+
+    if not package_ids:
+        return
+    package_index = index_for(model.Package)
+    context = {'model': model, 'ignore_auth': True, 'validate': False,
+               'use_cache': False}
+    for package_id in package_ids:
+        package_index.update_dict(
+            get_action('package_show')(context, {'id': package_id}),
+            defer_commit=True)
+    if commit:
+        package_index.commit()
+    log.debug('Indexed {n} datasets'.format(n=len(package_ids)))
+
+
+def soft_commit():
+    '''Make the indexed datasets searchable with a soft commit of Solr, or a
+    normal commit with a Solr client without soft commits.
+    '''
+    from ckan.lib.search.common import make_connection
+
+    conn = make_connection()
+    try:
+        conn.commit(softCommit=True)
+    except TypeError:
+        conn.commit()
+
+
+class DeferredIndex(object):
+    '''Datasets written without indexing, indexed together in chunks and with
+    one commit of the search index.
+
+    :param chunk_size: number of datasets per call of 'index'
+    :type chunk_size: int
+    :param index: function(package_ids) indexing datasets without committing
+        the search index, index_packages() by default
+    :param commit: function committing the search index, soft_commit() by
+        default
+    '''
+
+    def __init__(self, chunk_size=100, index=None, commit=None):
+        self.chunk_size = max(1, chunk_size)
+        self.index = index
+        self.commit = commit
+        self.package_ids = []
+        self._added = set()
+
+    def add(self, package_ids):
+        '''Add datasets to be indexed, each only once.
+        '''
+        for package_id in package_ids:
+            if package_id not in self._added:
+                self._added.add(package_id)
+                self.package_ids.append(package_id)
+
+    def flush(self):
+        '''Index the added datasets in chunks and commit the search index.
+
+        :returns: the number of datasets indexed
+        :rtype: int
+        '''
+        package_ids, self.package_ids = self.package_ids, []
+        self._added = set()
+        if not package_ids:
+            return 0
+        for start in xrange(0, len(package_ids), self.chunk_size):
+            chunk = package_ids[start:start + self.chunk_size]
+            if self.index is None:
+                index_packages(chunk, commit=False)
+            else:
+                self.index(chunk)
+        (self.commit or soft_commit)()
+        return len(package_ids)
+
+
+class PackageBatch(object):
+    '''Write datasets without committing and commit them together once
+    'size' datasets have been written or the oldest one was written 'seconds'
+    ago. The datasets of a committed batch are indexed with 'index'.
+
+    If writing or committing a dataset fails, the batch is rolled back and
+    written again one dataset at a time with 'write_one', so that one invalid
+    dataset does not fail the others.
+
+    :param session: SQLAlchemy session used for the writes
+    :param write: function(harvest_object, package_dict) writing a dataset
+        without committing, raises on failure
+    :param write_one: function(harvest_object, package_dict) writing and
+        committing a dataset, returns whether it succeeded
+    :param size: number of datasets per commit
+    :type size: int
+    :param seconds: maximum age of an uncommitted dataset
+    :type seconds: float
+    :param index: function(package_ids) indexing the committed datasets,
+        index_packages() by default
+    :param after_commit: function called without arguments once the datasets
+        of a batch are committed, for writes that must not be rolled back
+        with a failed batch
+    '''
+
+    def __init__(self, session, write, write_one, size=100, seconds=60.0,
+                 index=None, after_commit=None):
+        self.session = session
+        self.write = write
+        self.write_one = write_one
+        self.size = max(1, size)
+        self.seconds = seconds
+        self.index = index
+        self.after_commit = after_commit
+        # (key, harvest object, package dict, callback) tuples
+        self.items = []
+        self.started = None
+        self.committed = 0
+
+    def add(self, key, harvest_object, package_dict, done=None):
+        '''Write a dataset and commit the batch if it is full or old.
+
+        :param key: identifies the dataset in the returned failures
+        :param done: called without arguments after the dataset is committed
+        :returns: the keys of the datasets that could not be written
+        :rtype: list
+        '''
+        if not self.items:
+            self.started = time.time()
+        self.items.append((key, harvest_object, package_dict, done))
+        try:
+            self.write(harvest_object, package_dict)
+        except Exception, e:
+            log.info('Writing dataset {id} of a batch failed, writing the '
+                     'batch one by one: {er}'.format(id=package_dict.get('id'),
+                                                     er=e))
+            return self._write_one_by_one()
+        if len(self.items) >= self.size or \
+                time.time() - self.started >= self.seconds:
+            return self.flush()
+        return []
+
+    def flush(self):
+        '''Commit the datasets written so far.
+
+        :returns: the keys of the datasets that could not be written
+        :rtype: list
+        '''
+        if not self.items:
+            return []
+        try:
+            self.session.commit()
+        except Exception, e:
+            log.info('Committing a batch failed, writing it one by one: '
+                     '{er}'.format(er=e))
+            return self._write_one_by_one()
+        return self._committed(self.items, [])
+
+    def _write_one_by_one(self):
+        self.session.rollback()
+        written = []
+        failed = []
+        for item in self.items:
+            key, harvest_object, package_dict, _ = item
+            if self.write_one(harvest_object, package_dict):
+                written.append(item)
+            else:
+                failed.append(key)
+        return self._committed(written, failed)
+
+    def _committed(self, items, failed):
+        self.items = []
+        self.committed += len(items)
+        for _, _, _, done in items:
+            if done is not None:
+                done()
+        (self.index or index_packages)(
+            [package_dict['id'] for _, _, package_dict, _ in items])
+        if self.after_commit is not None:
+            self.after_commit()
+        log.debug('Committed a batch of {n} datasets, {f} failed'.format(
+            n=len(items), f=len(failed)))
+        return failed
@@ -0,0 +1,330 @@
+# coding: utf-8
+'''
+Paster commands importing DDI2 documents in bulk
+'''
+
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from ckan.lib.cli import CkanCommand
+
+import bulk
+import ddifiles
+
+log = logging.getLogger(__name__)
+
+# Harvester of this process, created on first use
+_harvester = None
+
+
+def _convert_file(args):
+    '''Convert one DDI document with DDIHarvester.parse_xml().
+
+    Run in the worker processes.
+
+    :param args: the name, the url and the XML of the document and whether
+        mandatory fields are required
+    :type args: tuple
+    :returns: the name and the package dict or None
+    :rtype: tuple
+    '''
+    global _harvester
+    name, url, xml, strict = args
+    if _harvester is None:
+        from ckanext.ddi.harvester import DDIHarvester
+        _harvester = DDIHarvester()
+    try:
+        package_dict = _harvester.parse_xml(xml, None, url, strict)
+    except Exception, e:
+        log.debug('Unable to convert {na}: {er}'.format(na=name, er=e))
+        package_dict = None
+    return name, package_dict or None
+
+
+class Checkpoint(object):
+    '''File listing the documents already handled by an import, one name per
+    line. A name is added only after its batch has been committed.
+
+    :param path: path of the checkpoint file or None for no checkpoint
+    :type path: string
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self.done = set(line.rstrip('\n')
+                                for line in checkpoint_file if line.strip())
+
+    def add(self, names):
+        '''Record 'names' as handled.
+        '''
+        self.done.update(names)
+        if not self.path:
+            return
+        with open(self.path, 'a') as checkpoint_file:
+            for name in names:
+                checkpoint_file.write(name + '\n')
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+
+
+class DDIImporter(CkanCommand):
+    '''Import DDI2 documents from a directory or a tarball
+
+    Usage:
+      ddi_import <directory or tarball> [options]
+
+    The XML files are converted in parallel worker processes and the datasets
+    are written in batches, committing once per batch. Existing datasets with
+    the same PIDs are updated.
+
+    With --checkpoint the names of the imported files are appended to the
+    given file after each batch, and files listed in it are skipped, so an
+    interrupted import can be resumed by running the same command again.
+    Files that could not be imported are tried again.
+    '''
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    min_args = 1
+    max_args = 1
+
+    def __init__(self, name):
+        super(DDIImporter, self).__init__(name)
+        self.parser.add_option(
+            '-p', '--processes', dest='processes', type='int', default=None,
+            help='Number of conversion processes, defaults to the number of '
+                 'CPUs')
+        self.parser.add_option(
+            '-b', '--batch-size', dest='batch_size', type='int', default=100,
+            help='Number of datasets written per commit, defaults to 100')
+        self.parser.add_option(
+            '-k', '--checkpoint', dest='checkpoint', default=None,
+            help='File recording the imported documents for resuming')
+        self.parser.add_option(
+            '-u', '--base-url', dest='base_url', default='',
+            help='Prefix of the file names giving the original urls of the '
+                 'documents')
+        self.parser.add_option(
+            '-o', '--organization', dest='organization', default=u'',
+            help='Name of the organization owning the datasets')
+        self.parser.add_option(
+            '--lenient', dest='strict', action='store_false', default=True,
+            help='Import documents missing mandatory fields')
+
+    def command(self):
+        self._load_config()
+        path = self.args[0]
+        if not os.path.exists(path):
+            print 'No such file or directory: {pa}'.format(pa=path)
+            sys.exit(1)
+
+        checkpoint = Checkpoint(self.options.checkpoint)
+        if checkpoint.done:
+            print 'Resuming, skipping {n} imported documents'.format(
+                n=len(checkpoint.done))
+        processes = self.options.processes or multiprocessing.cpu_count()
+        # Start the workers before any database connection is opened
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        try:
+            self._import(path, checkpoint, pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _import(self, path, checkpoint, pool):
+        import ckan.model as model
+        from ckan.logic import get_action
+        from ckanext.kata.plugin import KataPlugin
+
+        self.user = get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {})['name']
+        self.schema = KataPlugin.create_package_schema_ddi()
+
+        documents = ((name, self.options.base_url + name, xml,
+                      self.options.strict) for name, xml
+                     in ddifiles.read_documents(path, checkpoint.done))
+        if pool is None:
+            converted = (_convert_file(document) for document in documents)
+        else:
+            converted = pool.imap_unordered(_convert_file, documents,
+                                            chunksize=10)
+
+        started = time.time()
+        self.done = self.written = 0
+        batch = []
+        for name, package_dict in converted:
+            batch.append((name, package_dict))
+            if len(batch) >= self.options.batch_size:
+                self._write_batch(batch, checkpoint)
+                self._progress(started)
+                batch = []
+        if batch or not self.done:
+            self._write_batch(batch, checkpoint)
+            self._progress(started)
+
+    def _write_batch(self, batch, checkpoint):
+        '''Create or update the datasets of 'batch', commit them together and
+        add the documents committed to the checkpoint.
+
+        If a dataset cannot be written, the batch is rolled back and written
+        again one dataset at a time, so that the others are still imported.
+
+        :param batch: (name, package dict or None) tuples
+        :type batch: list
+        '''
+        import ckan.model as model
+
+        committed = []
+        package_batch = bulk.PackageBatch(
+            model.Session, self._write_package, self._write_package_committed,
+            size=len(batch) + 1)
+        with bulk.indexing_suspended():
+            for name, package_dict in batch:
+                if not package_dict:
+                    print 'Unable to convert {na}'.format(na=name)
+                    continue
+                package_dict['owner_org'] = self.options.organization
+                package_batch.add(name, name, package_dict,
+                                  lambda name=name: committed.append(name))
+            package_batch.flush()
+        checkpoint.add(committed)
+        self.done += len(batch)
+        self.written += len(committed)
+
+    def _write_package(self, name, package_dict):
+        '''Create or update the dataset of document 'name' without
+        committing. Existing datasets with the same PIDs are updated.
+
+        :raises ckan.logic.ValidationError: if the dataset is invalid
+        '''
+        import ckan.model as model
+        from ckan.logic import get_action
+        import ckanext.kata.utils as utils
+
+        context = {'model': model, 'session': model.Session,
+                   'user': self.user, 'schema': self.schema,
+                   'defer_commit': True}
+        pkg_id = utils.get_package_id_by_data_pids(package_dict)
+        if pkg_id:
+            package_dict['id'] = pkg_id
+            action = 'package_update'
+        else:
+            # The id of a create rolled back with its batch
+            package_dict.pop('id', None)
+            action = 'package_create'
+        package_dict['id'] = get_action(action)(context, package_dict)['id']
+
+    def _write_package_committed(self, name, package_dict):
+        '''Write and commit the dataset of document 'name'.
+
+        :returns: whether the dataset was written
+        :rtype: boolean
+        '''
+        import ckan.model as model
+        from ckan.logic import ValidationError
+
+        try:
+            self._write_package(name, package_dict)
+            model.Session.commit()
+            return True
+        except ValidationError, e:
+            print 'Invalid dataset in {na}: {er}'.format(
+                na=name, er=e.error_dict)
+        except Exception, e:
+            log.exception(e)
+            print 'Unable to write {na}: {er}'.format(na=name, er=e)
+        model.Session.rollback()
+        return False
+
+    def _progress(self, started):
+        elapsed = time.time() - started
+        print '{do} documents, {wr} imported, {fa} failed, ' \
+              '{ra:.1f} documents/s'.format(
+                  do=self.done, wr=self.written,
+                  fa=self.done - self.written,
+                  ra=self.done / elapsed if elapsed else 0.0)
+        sys.stdout.flush()
+
+
+class DDIHarvestImporter(CkanCommand):
+    '''Fetch and import the harvest objects of DDI harvest sources with the batch_import option
+
+    Usage:
+      ddi_harvest_import [source id] [options]
+
+    The gather stage of a harvest source with the 'batch_import' option
+    leaves the harvest objects waiting instead of sending them to the fetch
+    queue. This command fetches them and imports them --batch-size objects
+    at a time, converting the documents in parallel worker processes, and
+    sets their states and report statuses like the fetch consumer does.
+    Running jobs of all such sources are imported, or only those of the
+    given source.
+
+    Run it after the gather stage, for example from cron next to "paster
+    harvester run", which then marks the jobs finished. Only one instance
+    should run at a time.
+    '''
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    min_args = 0
+    max_args = 1
+
+    def __init__(self, name):
+        super(DDIHarvestImporter, self).__init__(name)
+        self.parser.add_option(
+            '-b', '--batch-size', dest='batch_size', type='int', default=100,
+            help='Number of harvest objects fetched and imported at a time, '
+                 'defaults to 100')
+
+    def command(self):
+        self._load_config()
+        import ckan.model as model
+        import ckanext.harvest.model as hmodel
+        from ckanext.ddi.harvester import DDIHarvester
+
+        harvester = DDIHarvester()
+        jobs = model.Session.query(hmodel.HarvestJob) \
+            .join(hmodel.HarvestSource) \
+            .filter(hmodel.HarvestJob.status == u'Running') \
+            .filter(hmodel.HarvestSource.type == harvester.info()['name'])
+        if self.args:
+            jobs = jobs.filter(hmodel.HarvestSource.id == self.args[0])
+        for job in jobs.all():
+            config = json.loads(job.source.config or '{}')
+            if not config.get('batch_import'):
+                continue
+            self._import_job(harvester, job)
+            if config.get('defer_indexing'):
+                # Also what the last batch of the job could not index
+                harvester.index_pending(job.source_id)
+
+    def _import_job(self, harvester, job):
+        '''Fetch and import the waiting harvest objects of 'job'.
+        '''
+        import ckan.model as model
+        import ckanext.harvest.model as hmodel
+
+        started = time.time()
+        done = imported = 0
+        while True:
+            harvest_objects = model.Session.query(hmodel.HarvestObject) \
+                .filter(hmodel.HarvestObject.harvest_job_id == job.id) \
+                .filter(hmodel.HarvestObject.state == u'WAITING') \
+                .limit(self.options.batch_size).all()
+            if not harvest_objects:
+                break
+            imported += harvester.import_harvest_objects(harvest_objects)
+            done += len(harvest_objects)
+            elapsed = time.time() - started
+            print 'Harvest job {jo}: {do} objects, {im} imported, ' \
+                  '{ra:.1f} objects/s'.format(
+                      jo=job.id, do=done, im=imported,
+                      ra=done / elapsed if elapsed else 0.0)
+            sys.stdout.flush()
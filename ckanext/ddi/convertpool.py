@@ -0,0 +1,92 @@
+# coding: utf-8
+'''
+Process pool converting DDI documents for the batch import of the harvester
+
+Parsing and conversion are CPU bound, so they are run in worker processes.
+Only the XML goes to the workers and only the package dicts and errors come
+back. Everything touching the CKAN database stays in the calling process.
+'''
+
+import logging
+import multiprocessing
+
+import lxml.etree as etree
+
+import dataconverter as dconverter
+import lxmlconverter
+
+log = logging.getLogger(__name__)
+
+# Converter classes by the 'parser' option of the harvest source
+CONVERTERS = {
+    'bs4': dconverter.DataConverter,
+    'lxml': lxmlconverter.LxmlDataConverter,
+}
+
+# Converters of this process, created on first use
+_converters = {}
+
+
+def _get_converter(parser):
+    if parser not in _converters:
+        _converters[parser] = CONVERTERS[parser]()
+    return _converters[parser]
+
+
+def convert_document(args):
+    '''Parse and convert one DDI document.
+
+    Run in the worker processes. The owner organization is not resolved,
+    since that needs the harvest object.
+
+    :param args: the parser name, the url and the XML of the document and
+        whether to prune the variable sections
+    :type args: tuple
+    :returns: the package dict or False, the list of ConversionError records
+        and the message of an XML syntax error or None
+    :rtype: tuple
+    '''
+    parser, url, xml, prune = args
+    converter = _get_converter(parser)
+    try:
+        ddi_xml = converter.parse(xml, prune)
+    except etree.XMLSyntaxError as err:
+        return False, [], err.msg
+    package_dict, errors = converter.convert(ddi_xml, url, xml)
+    return package_dict, errors, None
+
+
+class ConversionPool(object):
+    '''Convert DDI documents in a pool of worker processes.
+
+    The worker processes are started on first use and kept until close().
+
+    :param processes: number of worker processes, defaults to the number of
+        CPUs. With 1 the documents are converted in this process.
+    :type processes: int
+    '''
+
+    def __init__(self, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self._pool = None
+
+    def imap(self, documents):
+        '''Convert documents, yielding the results of convert_document() in
+        the order of 'documents'.
+
+        :param documents: (parser, url, xml, prune) tuples
+        :type documents: iterable
+        '''
+        if self.processes == 1:
+            return (convert_document(document) for document in documents)
+        if self._pool is None:
+            log.debug('Starting {n} conversion processes'.format(
+                n=self.processes))
+            self._pool = multiprocessing.Pool(self.processes)
+        return self._pool.imap(convert_document, documents)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
@@ -3,30 +3,35 @@
 Harvester for DDI2 formats
 '''
 
+import ast
+import collections
 import copy
-import inspect
+import io
 import logging
+import operator
 import os
 import re
 import socket
-import StringIO
+import sqlite3
+import threading
 import traceback
-import warnings
 import json
+import uuid
 
 
+from bs4 import BeautifulSoup
+from bs4.element import Comment, ProcessingInstruction, Tag
 import lxml.etree as etree
 from iso639 import languages
 from pylons import config
-import unicodecsv as csv
 
-import ckan.controllers.storage as storage
-from ckan.lib.base import h
 import ckan.model as model
 import ckanext.kata.utils as utils
 import ckanext.oaipmh.importcore as importcore
 
 from ckanext.kata.utils import generate_pid
+import fsdids
+import ownerorgs
 
 log = logging.getLogger(__name__)
 socket.setdefaulttimeout(30)
@@ -55,42 +60,80 @@ DATE_REGEX = re.compile(
     re.VERBOSE)
 
 
+# A deficiency found in a DDI document. 'field' names the value or method
+# which failed and 'line' is the line of the XML element it was reading, if
+# known.
+ConversionError = collections.namedtuple('ConversionError',
+                                         ['field', 'message', 'line'])
+
+
+def _sourceline(args):
+    '''Return the source line of the element given to a converter method, or
+    None if it is not known.
+    '''
+    line = getattr(args[1], 'sourceline', None) if len(args) > 1 else None
+    return line if isinstance(line, int) else None
+
+
+# Tag lookup modes of _match()
+MATCH_ONE = 'one'
+MATCH_FIRST = 'first'
+MATCH_ALL = 'all'
+
+
+class AmbiguousTagError(Exception):
+    '''Raised when a lookup expecting only one tag finds several.
+    '''
+    pass
+
+
+def _match(result_set, tag, match=MATCH_ONE):
+    '''Select tags from the results of a lookup of 'tag'.
+
+    MATCH_ONE returns the only tag and raises AmbiguousTagError if there are
+    several, MATCH_FIRST returns the first tag and MATCH_ALL a list of all of
+    them.
+
+    :raises TypeError: if no tag was found with MATCH_ONE or MATCH_FIRST
+    '''
+    if match == MATCH_ALL:
+        return list(result_set)
+    if not result_set:
+        raise TypeError('No {tag} found'.format(tag=tag))
+    if match == MATCH_ONE and len(result_set) > 1:
+        raise AmbiguousTagError('Ambiguous tag found: {tag}'.format(tag=tag))
+    return result_set[0]
+
+
 # TODO Nice to have: decorator for this decorator to separate mandatory and not
 def ExceptReturn(exceptions, returns=u'', mandatory_field=False):
     '''Decorator to handle exceptions in the import stage in controlled manner.
 
     Prevents the whole import to fail with flawed harvest objects or in the case
     of optional metadata. Collects all deficiencies of harvest objects to
-    self.errors to be showed in WUI.
+    self.errors as ConversionError records to be showed in WUI.
 
     :param exceptions: Exceptions to catch.
     :type exceptions: single exception or tuple of exceptions
     '''
     def decorator(f):
+        field = f.__name__
+
         def call(*args, **kwargs):
             try:
                 return f(*args, **kwargs)
             except exceptions as e:
                 self_ = args[0]  # Decorator intercepts method args, 1st is self
-                # If inspecting is too slow remove it and use
-                # 'carg=args[2] or args[1]' in format()'s below.
-                frame = inspect.currentframe()  # To show caller argument
-                caller_record = inspect.getouterframes(frame)[1]
-                line_num = caller_record[2]
-                call_line = caller_record[4][0]
-                call_arg = call_line.strip().split(')', 1)[0]
-                del frame  # To remove possible reference cycles
+                line = _sourceline(args)
                 if mandatory_field:
-                    log.error('Unable to read mandatory value: {etype}: {ex} at'
-                              ' {carg} (line {li})'.format(
-                        etype=e.__class__.__name__, ex=e, li=line_num,
-                        carg=call_arg))
-                    self_.errors.append(('{etype}: {ex} at {carg}'.format(
-                        etype=e.__class__.__name__, ex=e, carg=call_arg),
-                                         line_num))
+                    message = '{etype}: {ex} in {field}'.format(
+                        etype=e.__class__.__name__, ex=e, field=field)
+                    log.error('Unable to read mandatory value: {msg} (line {li})'
+                              .format(msg=message, li=line))
+                    self_.errors.append(ConversionError(field, message, line))
                 else:
-                    log.info('Unable to read optional value: {carg} (line {li})'
-                       .format(li=line_num, carg=call_arg))
+                    log.info('Unable to read optional value: {field} (line {li})'
+                             .format(field=field, li=line))
                 return returns
         return call
     return decorator
@@ -107,71 +150,109 @@ def _collect_attribs(el):
     return astr
 
 
-def _construct_csv(var, heads):
-    retdict = {}
-    els = var(text=False)
-    varcnt = 0
-    retdict['ID'] = var.get('ID', var['name'])
-    for var in els:
-        if var.name in ('catValu', 'catStat', 'qstn', 'catgry'):
+def _call(args, kwargs):
+    return lambda obj: obj(*args, **kwargs)
+
+
+def _compile_accessor(path):
+    '''Compile a path like "ddi_xml.codeBook.titlStmt('titl')" to a function
+    returning the value of the path read from the object given to it.
+
+    Supports attribute access, subscripts and calls with literal arguments,
+    which is enough for reading BeautifulSoup objects.
+
+    :raises ValueError: if the path contains anything else
+    '''
+    node = ast.parse(path.strip(), mode='eval').body
+    steps = []
+    try:
+        while not isinstance(node, ast.Name):
+            if isinstance(node, ast.Attribute):
+                steps.append(operator.attrgetter(node.attr))
+            elif isinstance(node, ast.Subscript):
+                steps.append(operator.itemgetter(
+                    ast.literal_eval(node.slice.value)))
+            elif isinstance(node, ast.Call) and not (node.starargs or
+                                                      node.kwargs):
+                steps.append(_call(
+                    [ast.literal_eval(arg) for arg in node.args],
+                    dict((kw.arg, ast.literal_eval(kw.value))
+                         for kw in node.keywords)))
+                node = node.func
+                continue
+            else:
+                raise ValueError
+            node = node.value
+    except (AttributeError, ValueError):
+        raise ValueError('Unsupported accessor path: {path}'.format(path=path))
+    steps.append(operator.attrgetter(node.id))
+    steps.reverse()
+
+    def accessor(obj):
+        for step in steps:
+            obj = step(obj)
+        return obj
+    return accessor
+
+
+# Compiled accessors of _read_value() by path
+_ACCESSORS = {}
+
+
+def _get_accessor(path):
+    '''Return the compiled accessor of 'path', compiling it on first use.
+    '''
+    try:
+        return _ACCESSORS[path]
+    except KeyError:
+        accessor = _ACCESSORS[path] = _compile_accessor(
+            path[5:] if path.startswith('self.') else path)
+        return accessor
+
+
+def _soup_to_etree(tag, parent=None):
+    '''Copy the bs4 tag 'tag' and its descendants to an lxml element.
+
+    Gives the same tree as serializing the soup with str() and parsing the
+    result with etree.fromstring(), without the two passes over the whole
+    document. Returns None if 'tag' is None.
+    '''
+    if tag is None:
+        return None
+    nsmap = {}
+    attrib = {}
+    for key, value in tag.attrs.iteritems():
+        if isinstance(value, list):
+            value = u' '.join(value)
+        if key == 'xmlns' or key.startswith('xmlns:'):
+            nsmap[key[6:] or None] = value
+        elif getattr(key, 'namespace', None):
+            attrib['{%s}%s' % (key.namespace, key.name)] = value
+        else:
+            attrib[key] = value
+    name = '{%s}%s' % (tag.namespace, tag.name) if tag.namespace else tag.name
+    if parent is None:
+        el = etree.Element(name, attrib, nsmap=nsmap or None)
+    else:
+        el = etree.SubElement(parent, name, attrib, nsmap=nsmap or None)
+    last = None
+    for child in tag.contents:
+        if isinstance(child, Tag):
+            last = _soup_to_etree(child, el)
+            continue
+        if isinstance(child, Comment):
+            last = etree.Comment(child)
+        elif isinstance(child, ProcessingInstruction):
+            target, _, data = child.rstrip('?').partition(' ')
+            last = etree.ProcessingInstruction(target, data or None)
+        elif last is None:
+            el.text = (el.text or u'') + child
             continue
-        if var.name == 'qstn':
-            valstr = var.preQTxt.string.strip() if var.preQTxt.string else None
-            retdict['preQTxt'] = valstr
-            valstr = var.qstnLit.string.strip() if var.qstnLit.string else None
-            retdict['qstnLit'] = valstr
-            valstr = var.postQTxt.string.strip() if var.postQTxt.string else None
-            retdict['postQTxt'] = valstr
-            valstr = var.ivuInstr.string.strip() if var.ivuInstr.string else None
-            retdict['ivuInstr'] = valstr
-        elif var.name.startswith('sumStat'):
-            var.name = "sumStat_%s" % var['type']
-            retdict[var.name] = var.string.strip()
-        elif var.name == 'valrng':
-            retdict['range'] = [("%s,%s" % (k, v) for k, v in var.range.attrs.iteritems())]
-        elif var.name == 'invalrng':
-            if var.item:
-                retdict['item'] = [("%s,%s" % (k, v) for k, v in var.item.attrs.iteritems())]
         else:
-            if var.name == 'labl' and 'level' in var.attrs:
-                if var['level'] == 'variable' and var.string:
-                    retdict['labl'] = var.string.strip()
-            else:
-                retdict[var.name] = var.string.strip() if var.string else None
-    return retdict
-
-
-def _create_code_rows(var):
-    rows = []
-    for cat in var('catgry', text=False, recursive=False):
-        catdict = {}
-        catdict['ID'] = var['ID'] if 'ID' in var else var['name']
-        catdict['catValu'] = cat.catValu.string if cat.catValu else None
-        catdict['labl'] = cat.labl.string if cat.labl else None
-        catdict['catStat'] = cat.catStat.string if cat.catStat else None
-        rows.append(catdict)
-    return rows
-
-
-def _get_headers():
-    longest_els = ['ID',
-                   'labl',
-                   'preQTxt',
-                   'qstnLit',
-                   'postQTxt',
-                   'ivuInstr',
-                   'varFormat',
-                   'TotlResp',
-                   'range',
-                   'item',
-                   'sumStat_vald',
-                   'sumStat_min',
-                   'sumStat_max',
-                   'sumStat_mean',
-                   'sumStat_stdev',
-                   'notes',
-                   'txt']
-    return longest_els
+            last.tail = (last.tail or u'') + child
+            continue
+        el.append(last)
+    return el
 
 
 def _is_fsd(url):
@@ -260,73 +341,210 @@ def _last_statements_to_rewrite():
     # pkg.extras['lang_title_0'] = pkg.language  # Guess. Good, I hope.
 
 
-class DataConverter:
+# Sections of codeBook not read by the conversion
+PRUNED_SECTIONS = ('dataDscr', 'fileDscr', 'otherMat')
+# The repeating children of the pruned sections, freed one by one
+_PRUNED_TAGS = ['{*}' + tag for tag in
+                PRUNED_SECTIONS + ('var', 'varGrp', 'nCube', 'fileTxt')]
+
+
+def parse_pruned(xml):
+    '''Parse DDI document 'xml' to an lxml tree without the PRUNED_SECTIONS
+    of codeBook.
+
+    The sections are dropped while parsing, so a document with thousands of
+    variables never exists as a whole tree. Recovers from errors like
+    etree.XMLParser(recover=True) does.
 
-    def __init__(self):
-        self.ddi_xml = None
-        self.context = None
-        self.strict = True
+    :param xml: the DDI XML document
+    :type xml: string
+    :rtype: lxml.etree._Element
+    '''
+    encoding = None
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+        encoding = 'utf-8'
+    events = etree.iterparse(io.BytesIO(xml), events=('start', 'end'),
+                             tag=_PRUNED_TAGS, encoding=encoding,
+                             recover=True)
+    section = None
+    for event, el in events:
+        if event == 'start':
+            if section is None:
+                parent = el.getparent()
+                if parent is not None and parent.getparent() is None and \
+                        etree.QName(el).localname in PRUNED_SECTIONS:
+                    section = el
+        elif el is section:
+            parent = el.getparent()
+            if el.tail:
+                previous = el.getprevious()
+                if previous is not None:
+                    previous.tail = (previous.tail or '') + el.tail
+                else:
+                    parent.text = (parent.text or '') + el.tail
+            parent.remove(el)
+            section = None
+        elif section is not None and el.getparent() is section:
+            el.clear()
+            while el.getprevious() is not None:
+                del section[0]
+    return events.root
+
+
+class ConversionContext(object):
+    '''State of one conversion: the parsed document, the options of the call
+    and the errors found.
+    '''
+
+    def __init__(self, ddi_xml=None, context=None, strict=True):
+        self.ddi_xml = ddi_xml
+        self.context = context
+        self.strict = strict
         self.errors = []
+
+
+def _context_attribute(name):
+    '''Return a property for attribute 'name' of the conversion context of
+    the calling thread.
+    '''
+    return property(lambda self: getattr(self._current(), name),
+                    lambda self, value: setattr(self._current(), name, value))
+
+
+class DataConverter(object):
+    '''Converter of DDI2 documents to CKAN package dicts.
+
+    The state of each conversion is kept in its own ConversionContext, so
+    one converter can run conversions in several threads at once. The
+    attributes below refer to the context of the conversion running in the
+    calling thread.
+    '''
+    ddi_xml = _context_attribute('ddi_xml')
+    context = _context_attribute('context')
+    strict = _context_attribute('strict')
+    errors = _context_attribute('errors')
+
+    def __init__(self, offline=False):
+        # Offline conversions leave the FSD id store untouched and give
+        # the same ids every time
+        self.offline = offline
+        self._local = threading.local()
         self.fsd_path = os.path.join(os.path.dirname(__file__), "../..", "1040-fix-update-datasets", 'fsd_names_filtered.csv')
-        self.fsd_items = {}
+        self._fsd_ids = None
+        self._fsd_ids_lock = threading.Lock()
 
-    def read_fsd_ref(self):
-        fsd_items = {}
-        try:
-            with open(self.fsd_path) as fsd_temp_f:
-                fsd_lines = fsd_temp_f.readlines()
-            for l in fsd_lines:
-                idd, name = l.strip().split(',')
-                fsd_items[name] = idd
-            if len(fsd_items) == 0:
-                fsd_items['Note to self'] = u'NOTE: All FSD ids have been assigned'\
-                    + u' in reharvesting. Related ckanext-ddi code & directory'\
-                    + u'should be removed.'
-        except Exception:
-            log.info("Couldn't open FSD id table for reading in {path}.".format(
-                path=self.fsd_path))
-        self.fsd_items = fsd_items
-
-    def write_fsd_ref(self):
+    def _contexts(self):
+        '''Return the stack of conversion contexts of the calling thread.
+
+        The first context holds the errors of the latest ddi2ckan() call.
+        '''
         try:
-            with open(self.fsd_path, 'w') as fsd_temp_f:
-                for name, idd in self.fsd_items.iteritems():
-                    fsd_temp_f.write(','.join([idd, name]) + '\n')
-                    fsd_temp_f.flush()
-                log.info('Updated FSD id table.')
-        except Exception:
-            log.info("Couldn't write to FSD id table.")
+            return self._local.contexts
+        except AttributeError:
+            self._local.contexts = [ConversionContext()]
+            return self._local.contexts
 
-    def ddi2ckan(self, data, original_url=None, original_xml=None,
-                 harvest_object=None, context=None, strict=True):
+    def _current(self):
+        return self._contexts()[-1]
+
+    def _get_fsd_ids(self):
+        '''Return the store of FSD dataset ids, opened once per process.
+
+        The location is read from 'ckanext.ddi.fsd_id_store'. The old CSV
+        id table is migrated to the store when found. Returns None if the
+        store can not be opened.
+        '''
+        with self._fsd_ids_lock:
+            if self._fsd_ids is None:
+                path = config.get('ckanext.ddi.fsd_id_store', os.path.join(
+                    os.path.dirname(self.fsd_path), 'fsd_ids.db'))
+                store = fsdids.FsdIdStore(path)
+                try:
+                    store.migrate_csv(self.fsd_path)
+                    log.info('{n} unassigned ids in FSD id table.'.format(
+                        n=len(store)))
+                except (EnvironmentError, sqlite3.Error) as e:
+                    log.info("Couldn't open FSD id table in {path}: {er}"
+                             .format(path=path, er=e))
+                    store = False
+                self._fsd_ids = store
+        return self._fsd_ids or None
+
+    def parse(self, xml, prune=True):
+        '''Parse a DDI document to the tree ddi2ckan() reads.
+
+        :param xml: the DDI XML document
+        :type xml: string
+        :param prune: leave out the PRUNED_SECTIONS, which are only needed
+            for the variable export
+        :type prune: boolean
+        :rtype: BeautifulSoup object
+        '''
+        if prune:
+            # The soup is built from the much smaller pruned document.
+            # Pruning with a BeautifulSoup tree builder would save the
+            # serialization, but calls back to Python for every element of
+            # the pruned sections and is slower.
+            xml = etree.tostring(
+                parse_pruned(xml).getroottree(), encoding='utf-8',
+                xml_declaration=xml.lstrip().startswith('<?xml'))
+        return BeautifulSoup(xml, 'xml')
+
+    def convert(self, data, original_url=None, original_xml=None,
+                harvest_object=None, context=None, strict=True):
         '''Read DDI2 data and convert it to CKAN format.
+
+        Safe to call from several threads and from within a conversion.
+
+        :param data: the document parsed with parse()
+        :returns: the package dict, or False if the conversion failed, and a
+            list of the ConversionError records of the conversion
+        :rtype: tuple
         '''
-        self.ddi_xml = data
-        self.context = context
-        self.strict = strict
+        conversion = ConversionContext(data, context, strict)
+        contexts = self._contexts()
+        contexts.append(conversion)
         try:
-            return self._ddi2ckan(original_url, original_xml, harvest_object)
+            package_dict = self._ddi2ckan(original_url, original_xml,
+                                          harvest_object)
         except Exception as e:
             log.debug(traceback.format_exc(e))
-        return False
+            package_dict = False
+        finally:
+            contexts.pop()
+        return package_dict, conversion.errors
+
+    def ddi2ckan(self, data, original_url=None, original_xml=None,
+                 harvest_object=None, context=None, strict=True):
+        '''Read DDI2 data and convert it to CKAN format.
+
+        Like convert(), but returns only the package dict. The errors are
+        available from get_errors() in the calling thread until the next
+        call.
+        '''
+        package_dict, errors = self.convert(data, original_url, original_xml,
+                                            harvest_object, context, strict)
+        self._contexts()[0].errors = errors
+        return package_dict
 
     def _read_value(self, bs_eval_string, default=u'', mandatory_field=False):
         '''
-        Evaluate values from Beautiful Soup objects.
+        Read values from Beautiful Soup objects with a path like
+        "ddi_xml.codeBook.stdyDscr.citation.titlStmt.IDNo.text", relative to
+        the instance. Paths are compiled once, see _compile_accessor().
         Returns default if evaluation failed, else return the evaluated output.
         '''
-        # Make sure we are using class variables
-        eval_string = bs_eval_string if bs_eval_string.startswith('self.') \
-            else 'self.' + bs_eval_string
+        accessor = _get_accessor(bs_eval_string)
         try:
-            output = eval(eval_string)
-            return output
+            return accessor(self)
         except (AttributeError, TypeError):
             if mandatory_field and self.strict:
                 log.debug('Unable to read mandatory value: {path}'
                           .format(path=bs_eval_string))
-                self.errors.append('Unable to read mandatory value: {path}'
-                                   .format(path=bs_eval_string))
+                self.errors.append(ConversionError(
+                    bs_eval_string, 'Unable to read mandatory value: {path}'
+                    .format(path=bs_eval_string), None))
             else:
                 log.debug('Unable to read optional value: {path}'
                           .format(path=bs_eval_string))
@@ -334,13 +552,15 @@ class DataConverter:
 
 
     def empty_errors(self):
-        '''Remove errors of the instance.
+        '''Remove errors of the latest conversion of the calling thread.
         '''
         self.errors = []
 
     def get_errors(self):
         '''
-        Return errors found in instance's data parsing.
+        Return errors found in the latest conversion of the calling thread.
+
+        :rtype: list of ConversionError records
         '''
         return self.errors
 
@@ -348,34 +568,42 @@ class DataConverter:
         '''
         Return id of existing dataset or None.
 
-        Fetch ids from an external file. Clear the id from the file when fetched.
+        Fetch ids from the FSD id store. The id is removed from the store when
+        fetched.
         '''
-        id_upper = self.fsd_items.get(name.upper(), None)
-        id_lower = self.fsd_items.get(name.lower(), None)
-        eid = None
-        msg_found = 'Found existing FSD id: {fid} corresponding Etsin id: {eid}'
+        if self.offline:
+            return None
         log.info('Checking the imported dataset with name: {na} against FSD id table.'.format(na=name))
-        if id_upper:
-            eid = id_upper
-            log.info(msg_found.format(fid=name.upper(), eid=eid))
-            del self.fsd_items[name.upper()]
-            if id_lower:
-                del self.fsd_items[name.lower()]
-        elif id_lower:
-            eid = id_lower
-            log.info(msg_found.format(fid=name.upper(), eid=eid))
-            del self.fsd_items[name.lower()]
+        fsd_ids = self._get_fsd_ids()
+        eid = None
+        if fsd_ids:
+            try:
+                eid = fsd_ids.consume(name)
+            except sqlite3.Error as e:
+                log.info("Couldn't read FSD id table: {er}".format(er=e))
+        if eid:
+            log.info('Found existing FSD id: {fid} corresponding Etsin id: {eid}'
+                     .format(fid=name.upper(), eid=eid))
         else:
             log.info('No existing FSD id found. Generating a new id.')
         return eid
 
+    def _new_pid(self, name):
+        '''Return a new id for dataset 'name', derived from the name when
+        converting offline.
+        '''
+        if self.offline:
+            return u'urn:uuid:{0}'.format(
+                uuid.uuid5(uuid.NAMESPACE_URL, name.encode('utf-8')))
+        return generate_pid()
+
     @ExceptReturn(AttributeError)
     def get_clean_date(self, bs4_element):
         raw_date = DATE_REGEX.search(bs4_element.get('date'))
         return raw_date.group(0).rstrip('-') if raw_date and \
                                                 raw_date.group(0) else ''
 
-    @ExceptReturn((AttributeError, TypeError, UserWarning, IndexError),
+    @ExceptReturn((AttributeError, TypeError, AmbiguousTagError, IndexError),
                   mandatory_field=True)
     def get_attrdate_mandatory(self, start_bs4tag, *args, **kwargs):
         # TODO: this is obsolete, more general see: get_attr_mandatory()
@@ -391,46 +619,41 @@ class DataConverter:
         :rtype: a string
         '''
         result_set = start_bs4tag(args, kwargs)
-        if len(result_set) > 1:
-            warnings.simplefilter('error', UserWarning)  # raises warning
-            warnings.warn('Ambiguous tag found: {tag}'.format(
-                tag=result_set[0].name))
-        return self.get_clean_date(result_set[0])
+        tag = _match(result_set, args[0] if args else kwargs)
+        return self.get_clean_date(tag)
 
-    @ExceptReturn((AttributeError, TypeError, UserWarning))
+    @ExceptReturn((AttributeError, TypeError, AmbiguousTagError))
     def get_attrdate_optional(self, start_bs4tag, *args, **kwargs):
         '''Search BeautifulSoup object for a tag and return its date attribute.
 
         Optional version. see. get_attrdate_mandatory
         '''
         result_set = start_bs4tag(args, kwargs)
-        if len(result_set) > 1:
-            warnings.simplefilter('error', UserWarning)  # raises warning
-            warnings.warn('Ambiguous tag found: {tag}'.format(
-                tag=result_set[0].name))
-        return self.get_clean_date(result_set[0]) if result_set else ''
-
-    @ExceptReturn((AttributeError, TypeError, KeyError, UserWarning), mandatory_field=True)
-    def get_attr_mandatory(self, start_bs4tag, search_tag, attr):
+        if not result_set:
+            return ''
+        tag = _match(result_set, args[0] if args else kwargs)
+        return self.get_clean_date(tag)
+
+    def _get_attr(self, start_bs4tag, search_tag, attr, match):
+        tags = _match(start_bs4tag(search_tag), search_tag, match)
+        if match == MATCH_ALL:
+            return [tag[attr] for tag in tags]
+        return tags[attr]
+
+    @ExceptReturn((AttributeError, TypeError, KeyError, AmbiguousTagError), mandatory_field=True)
+    def get_attr_mandatory(self, start_bs4tag, search_tag, attr,
+                           match=MATCH_ONE):
         '''Return the value of an attribute of a BeautifulSoup tag.
+
+        'match' selects the tag, see _match(). With MATCH_ALL, the values of
+        all 'search_tag' tags are returned in a list.
         '''
-        result_set = start_bs4tag(search_tag)
-        if len(result_set) > 1:
-            warnings.simplefilter('error', UserWarning)  # To raise as exception
-            warnings.warn('Ambiguous tag found: {tag}'.format(
-                tag=result_set[0].name))
-        # Strange 'else' statement is to trigger exception
-        return result_set[0][attr] if result_set else result_set[attr]
+        return self._get_attr(start_bs4tag, search_tag, attr, match)
 
     @ExceptReturn((AttributeError, TypeError, KeyError))
-    def get_attr_optional(self, start_bs4tag, search_tag, attr):
-        result_set = start_bs4tag(search_tag)
-        if len(result_set) > 1:
-            warnings.simplefilter('error', UserWarning)  # To raise as exception
-            warnings.warn('Ambiguous tag found: {tag}'.format(
-                tag=result_set[0].name))
-        # Strange 'else' statement is to trigger exception
-        return result_set[0][attr] if result_set else result_set[attr]
+    def get_attr_optional(self, start_bs4tag, search_tag, attr,
+                          match=MATCH_ONE):
+        return self._get_attr(start_bs4tag, search_tag, attr, match)
 
     # Authors & organizations
     @ExceptReturn((AttributeError, TypeError), mandatory_field=True)
@@ -569,73 +792,13 @@ class DataConverter:
             log.debug('Invalid language: {ke}'.format(ke=ke))
             return ''
 
-    def _save_ddi_variables_to_csv(self, name, pkg, harvest_object):
-        # JuhoL: Handle codeBook.dataDscr parts, extract data (eg. questionnaire)
-        # variables etc.
-        # Saves <var>...</var> elements to a csv file accessible at:
-        # <ckan_url>/storage/f/2013-11-05T18%3A10%3A19.686858/1049_var.csv
-        # And separately saves <catgry> elements inside <var> to a csv as a resource
-        # for package.
-        # Assumes that dataDscr has not changed. Valid?
-        data_dscr = "ddi_xml.codeBook.dataDscr"
-        try:
-            ofs = storage.get_ofs()
-        except IOError, ioe:
-            log.debug('Unable to save xml variables: {io}'.format(io=ioe))
-            self.errors.append('Unable to save xml variables: {io}'.format(io=ioe))
+    def _get_owner_org(self, harvest_object):
+        '''Return the name of the organization owning the harvest source of
+        'harvest_object' or an empty string without a harvest object.
+        '''
+        if not harvest_object:
             return u''
-
-        ddi_vars = self._read_value(data_dscr + "('var')")  # Find all <var> elements
-        heads = _get_headers()
-        c_heads = ['ID', 'catValu', 'labl', 'catStat']
-        f_var = StringIO.StringIO()
-        c_var = StringIO.StringIO()
-        varwriter = csv.DictWriter(f_var, heads)
-        codewriter = csv.DictWriter(c_var, c_heads)
-        heading_row = {}
-        for head in heads:
-            heading_row[head] = head
-        c_heading_row = {}
-        for head in c_heads:
-            c_heading_row[head] = head
-        varwriter.writerow(heading_row)
-        codewriter.writerow(c_heading_row)
-        for var in ddi_vars:
-            try:
-                varwriter.writerow(_construct_csv(var, heads))
-                codewriter.writerows(_create_code_rows(var))
-            except ValueError, e:
-                # Assumes that the process failed. Room for retry?
-                raise IOError("Failed to import DDI to CSV! %s" % e)
-        f_var.flush()
-        label = '{dir}/{filename}_var.csv'.format(
-            dir=harvest_object.harvest_source_id, filename=name)
-        ofs.put_stream(storage.BUCKET, label, f_var, {})
-        fileurl_var = config.get('ckan.site_url') + h.url_for('storage_file',
-                                                          label=label)
-        #pkg.add_resource(url=fileurl,
-        #                 description="Variable metadata",
-        #                 format="csv",
-        #                 size=f_var.len)
-
-        label = '{dir}/{filename}_code.csv'.format(
-            dir=harvest_object.harvest_source_id, filename=name)
-        ofs.put_stream(storage.BUCKET, label, c_var, {})
-        fileurl_code = config.get('ckan.site_url') + h.url_for('storage_file',
-                                                          label=label)
-        #pkg.add_resource(url=fileurl,
-        #                 description="Variable code values",
-        #                 format="csv",
-        #                 size=c_var.len)
-        # JuhoL: Append labels of variables ('questions') also to metas
-        # TODO: change to return XPath dict of labels
-        flattened_var_labels = {}
-        f_var.seek(0)  # JuhoL: Set 'read cursor' to row 0
-        reader = csv.DictReader(f_var)
-        #for var in reader:
-        #    metas.append(var['labl'] if 'labl' in var else var['qstnLit'])
-        # TODO: return flattened_var_labels
-        return fileurl_var, fileurl_code
+        return ownerorgs.get_owner_org(harvest_object)
 
     def _ddi2ckan(self, original_url, original_xml, harvest_object):
         '''Extract package values from bs4 object 'ddi_xml' parsed from xml
@@ -756,12 +919,7 @@ class DataConverter:
                       'name': owner})
 
         # Owner organisation
-        if harvest_object:
-            hsid = harvest_object.harvest_source_id
-            hsooid = model.Session.query(model.Package).filter(model.Package.id==hsid).one().owner_org
-            owner_org = model.Session.query(model.Group).filter(model.Group.id==hsooid).one().name
-        else:
-            owner_org = u''
+        owner_org = self._get_owner_org(harvest_object)
 
         # Distributor (Agent: distributor, the same is used as contact)
         agent.append({
@@ -820,10 +978,11 @@ class DataConverter:
         ####################################################################
         #      Flatten rest to 'XPath/path/to/element': 'value' pairs      #
         ####################################################################
-        etree_xml = etree.fromstring(str(self.ddi_xml))
-        flattened_ddi = importcore.generic_xml_metadata_reader(etree_xml.find('.//{*}docDscr'))
+        flattened_ddi = importcore.generic_xml_metadata_reader(
+            _soup_to_etree(self.ddi_xml.find('docDscr')))
         xpath_dict = flattened_ddi.getMap()
-        flattened_ddi = importcore.generic_xml_metadata_reader(etree_xml.find('.//{*}stdyDscr'))
+        flattened_ddi = importcore.generic_xml_metadata_reader(
+            _soup_to_etree(self.ddi_xml.find('stdyDscr')))
         xpath_dict.update(flattened_ddi.getMap())
 
 
@@ -842,7 +1001,7 @@ class DataConverter:
             event=events,
             geographic_coverage=geo_cover,
             groups=[],
-            id=self._get_id_by_name(name) or generate_pid(),
+            id=self._get_id_by_name(name) or self._new_pid(name),
             # langtitle=langtitle,
             langdis=u'True',  # HUOMAA!
             language=language,
@@ -873,7 +1032,6 @@ class DataConverter:
         #                'Uskon asia: nuorisobarometri 2006 (2006).'},
         #               {'stdyD...': 'Some value'}]
         # }
-        #package_dict['extras'].update(_save_ddi_variables_to_csv(ddi_xml, somepkg))
 
 
         # Vanhojen koodien järjestys:
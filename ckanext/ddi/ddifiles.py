@@ -0,0 +1,45 @@
+# coding: utf-8
+'''
+Reading DDI documents from the file system
+'''
+
+import os
+import tarfile
+
+
+def read_documents(path, skip=()):
+    '''Yield the names and contents of the XML files in directory or tarball
+    'path'.
+
+    Files are read in name order from a directory and in archive order from a
+    tarball. The names are relative to 'path'.
+
+    :param path: a directory or a (compressed) tar file
+    :type path: string
+    :param skip: names of documents not to read
+    :type skip: set
+    '''
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                if not filename.lower().endswith('.xml'):
+                    continue
+                full_path = os.path.join(root, filename)
+                name = os.path.relpath(full_path, path)
+                if name in skip:
+                    continue
+                with open(full_path, 'rb') as xml_file:
+                    yield name, xml_file.read()
+    else:
+        # Streaming mode reads the archive in a single pass
+        archive = tarfile.open(path, 'r|*')
+        try:
+            for member in archive:
+                if not member.isfile() or \
+                        not member.name.lower().endswith('.xml') or \
+                        member.name in skip:
+                    continue
+                yield member.name, archive.extractfile(member).read()
+        finally:
+            archive.close()
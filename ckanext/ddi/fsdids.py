@@ -0,0 +1,117 @@
+# coding: utf-8
+'''
+Persistent mapping of FSD dataset names to existing Etsin dataset ids
+
+When FSD datasets are reharvested, each one keeps the id it had before.
+Every id is handed out once and then removed from the store.
+'''
+
+import logging
+import os
+import sqlite3
+import threading
+
+import unicodecsv as csv
+
+log = logging.getLogger(__name__)
+
+
+class FsdIdStore(object):
+    '''Keyed store of the dataset ids not yet assigned to FSD datasets.
+
+    The store is a SQLite database indexed by dataset name, so lookups and
+    removals do not depend on the number of ids. Removals are atomic, so
+    several import processes and threads can share the store and each id is
+    handed out only once.
+
+    :param path: path of the database file
+    :type path: string
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # Worker processes open their own connection
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def _connect(self):
+        # Connections must not be shared between threads or with forked
+        # worker processes
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            local.conn = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None)
+            local.pid = os.getpid()
+            local.conn.execute(
+                'CREATE TABLE IF NOT EXISTS fsd_ids ('
+                'name TEXT PRIMARY KEY, id TEXT NOT NULL)')
+        return local.conn
+
+    def migrate_csv(self, csv_path):
+        '''Copy the ids of an old 'id,name' CSV file to the store and rename
+        the file so that it is read only once.
+
+        :param csv_path: path of the CSV file
+        :type csv_path: string
+        :returns: number of ids read from the file
+        :rtype: int
+        '''
+        if not os.path.exists(csv_path):
+            return 0
+        with open(csv_path) as csv_file:
+            rows = [(row[1].strip(), row[0].strip())
+                    for row in csv.reader(csv_file) if len(row) == 2]
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'INSERT OR IGNORE INTO fsd_ids (name, id) VALUES (?, ?)', rows)
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        os.rename(csv_path, csv_path + '.migrated')
+        log.info('Migrated {n} FSD ids from {path}.'.format(
+            n=len(rows), path=csv_path))
+        return len(rows)
+
+    def consume(self, name):
+        '''Return the id of dataset 'name' and remove it from the store.
+
+        The name is looked up in upper and lower case.
+
+        :param name: the name of the dataset
+        :type name: string
+        :returns: the id or None if the name is not in the store
+        :rtype: string
+        '''
+        names = (name.upper(), name.lower())
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = dict(conn.execute(
+                'SELECT name, id FROM fsd_ids WHERE name IN (?, ?)',
+                names).fetchall())
+            if rows:
+                conn.execute('DELETE FROM fsd_ids WHERE name IN (?, ?)', names)
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        return rows.get(names[0]) or rows.get(names[1])
+
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM fsd_ids').fetchone()[0]
+
+    def close(self):
+        '''Close the connection of the calling thread.
+        '''
+        if getattr(self._local, 'conn', None) is not None:
+            self._local.conn.close()
+            self._local.conn = None
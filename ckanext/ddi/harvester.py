@@ -4,40 +4,118 @@ Harvester for DDI2 formats
 '''
 
 import datetime
-import httplib
+import functools
 import itertools
 import json
 import logging
 import lxml.etree as etree
-import pickle
+from multiprocessing.pool import ThreadPool
+import os
 import socket
+import tempfile
 import traceback
-import urllib2
 
 
-from bs4 import BeautifulSoup
 from dateutil import parser
+from pylons import config as ckan_config
+import requests
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.exc import NoResultFound
+from ckan.logic import get_action
 import ckan.model as model
+import ckan.plugins as plugins
 from ckanext.harvest.harvesters.base import HarvesterBase
 import ckanext.harvest.model as hmodel
 from ckanext.kata.plugin import KataPlugin
-import ckanext.kata.utils as utils
-import dataconverter as dconverter
+import bulk
+import convertpool
+import httpcache
+import httpclient
+import ownerorgs
+import payload
+import pidresolver
+import urllist
+import varexport
+import varstats
 
 
 log = logging.getLogger(__name__)
 
 socket.setdefaulttimeout(30)
 
+# Urls probed at a time per probing thread in gather
+PROBE_WINDOW_FACTOR = 4
+# Size of the variable export files kept in memory before spooling to disk
+EXPORT_SPOOL_SIZE = 1024 * 1024
+# Harvest object extra holding the hash of the imported document
+CONTENT_HASH_KEY = 'content_hash'
+# Default maximum age in seconds of uncommitted datasets of a write batch
+WRITE_BATCH_SECONDS = 60
+# Default number of datasets per call of the deferred indexing
+INDEX_CHUNK_SIZE = 100
+# Harvest object extra holding the id of a dataset written with deferred
+# indexing and not indexed yet
+INDEX_PENDING_KEY = 'index_pending'
+# States of the harvest objects of a job still to be imported
+PENDING_STATES = [u'WAITING', u'FETCH', u'IMPORT']
+
 
 class DDIHarvester(HarvesterBase):
     '''
     DDI Harvester for ckanext-harvester.
     '''
+    plugins.implements(plugins.IConfigurable, inherit=True)
+
     config = None
 
     def __init__(self, **kwargs):
-        self.ddi_converter = dconverter.DataConverter()
+        self.ddi_converters = dict(
+            (name, converter()) for name, converter
+            in convertpool.CONVERTERS.iteritems())
+        self.ddi_converter = self.ddi_converters['bs4']
+        self._validator_store = None
+        self._conversion_pool = None
+        self._pid_resolver = None
+        self._package_schema = None
+        self._site_user = None
+        # Object errors waiting for the commit of a write batch
+        self._object_errors = None
+        # Create the shared connection pool with the configured host limit
+        httpclient.get_session(int(ckan_config.get(
+            'ckanext.ddi.http_pool_maxsize', httpclient.POOL_MAXSIZE)))
+        ownerorgs.cache.ttl = int(ckan_config.get(
+            'ckanext.ddi.owner_org_ttl', ownerorgs.TTL))
+
+    def configure(self, config):
+        # The plugins have been (re)loaded, their schemas may have changed
+        self._package_schema = None
+
+    def _validator_store_path(self):
+        '''Return the location of the store of HTTP validators, read from
+        'ckanext.ddi.validator_store' or under 'ckan.storage_path', or None if
+        neither is configured.
+        '''
+        path = ckan_config.get('ckanext.ddi.validator_store')
+        if not path and ckan_config.get('ckan.storage_path'):
+            path = os.path.join(ckan_config['ckan.storage_path'], 'ddi',
+                                'validators.db')
+        return path
+
+    def _get_validator_store(self):
+        '''Return the store of HTTP validators used by conditional fetch.
+
+        :raises ValueError: if the location of the store is not configured
+        '''
+        if self._validator_store is None:
+            path = self._validator_store_path()
+            if not path:
+                raise ValueError('conditional_fetch needs '
+                                 'ckanext.ddi.validator_store or '
+                                 'ckan.storage_path to be configured')
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self._validator_store = httpcache.ValidatorStore(path)
+        return self._validator_store
 
     def _set_config(self, config_str):
         '''Set the configuration string.
@@ -55,6 +133,8 @@ class DDIHarvester(HarvesterBase):
                 raise
         else:
             self.config = {}
+        self.ddi_converter = self.ddi_converters[
+            self.config.get('parser', 'bs4')]
 
     def info(self):
         '''Return information about this harvester.
@@ -81,6 +161,37 @@ class DDIHarvester(HarvesterBase):
             try:
                 config_obj = json.loads(config)
                 validate_param(config_obj, 'limit', int)
+                if validate_param(config_obj, 'gather_concurrency', int) and \
+                        config_obj['gather_concurrency'] < 1:
+                    raise ValueError("'gather_concurrency' needs to be at "
+                                     "least 1")
+                if validate_param(config_obj, 'conditional_fetch', bool) and \
+                        config_obj['conditional_fetch'] and \
+                        not self._validator_store_path():
+                    raise ValueError("'conditional_fetch' needs "
+                                     "ckanext.ddi.validator_store or "
+                                     "ckan.storage_path to be configured")
+                validate_param(config_obj, 'force_import', bool)
+                validate_param(config_obj, 'export_variables', bool)
+                validate_param(config_obj, 'defer_indexing', bool)
+                validate_param(config_obj, 'batch_import', bool)
+                if validate_param(config_obj, 'parser', basestring) and \
+                        config_obj['parser'] not in self.ddi_converters:
+                    raise ValueError("'parser' needs to be one of: {p}".format(
+                        p=', '.join(sorted(self.ddi_converters))))
+                if validate_param(config_obj, 'gather_batch_size', int) and \
+                        config_obj['gather_batch_size'] < 1:
+                    raise ValueError("'gather_batch_size' needs to be at "
+                                     "least 1")
+                if validate_param(config_obj, 'write_batch_size', int) and \
+                        config_obj['write_batch_size'] < 1:
+                    raise ValueError("'write_batch_size' needs to be at "
+                                     "least 1")
+                if validate_param(config_obj, 'write_batch_seconds',
+                                  (int, float)) and \
+                        config_obj['write_batch_seconds'] <= 0:
+                    raise ValueError("'write_batch_seconds' needs to be "
+                                     "positive")
             except TypeError as e:
                 raise e
         else:
@@ -117,6 +228,56 @@ class DDIHarvester(HarvesterBase):
     def _str_from_datetime(self, dt):
         return dt.strftime('%Y-%m-%dT%H:%M:%S')
 
+    def _get_last_modified(self, url):
+        '''Probe the Last-Modified time of a document with a HEAD request.
+
+        :param url: the url of the document
+        :type url: string
+        :returns: a tuple of the url and its modification time, or None as the
+            time if the probe failed
+        :rtype: tuple
+        '''
+        try:
+            response = httpclient.head(url, allow_redirects=True)
+            response.raise_for_status()
+            lastmod = parser.parse(response.headers['last-modified'],
+                                   ignoretz=True)
+        except (requests.RequestException, KeyError, ValueError):
+            log.info('Connection error, url: {ur}. Probably just try again.'
+                     .format(ur=url))
+            lastmod = None
+        return url, lastmod
+
+    def _probe_urls(self, urls, concurrency=1):
+        '''Probe the Last-Modified times of 'urls' with at most 'concurrency'
+        simultaneous HEAD requests.
+
+        :param urls: iterable of document urls
+        :param concurrency: number of probing threads
+        :type concurrency: int
+        :returns: (url, last modified) tuples in the order of 'urls'
+        :rtype: generator
+        '''
+        if concurrency <= 1:
+            for url in urls:
+                yield self._get_last_modified(url)
+            return
+        pool = ThreadPool(concurrency)
+        urls = iter(urls)
+        try:
+            # imap() reads all of its input at once, so it is given a window
+            # of urls at a time to keep the streaming of the list
+            while True:
+                window = list(itertools.islice(
+                    urls, concurrency * PROBE_WINDOW_FACTOR))
+                if not window:
+                    break
+                # imap() keeps the source order regardless of completion order
+                for probed in pool.imap(self._get_last_modified, window):
+                    yield probed
+        finally:
+            pool.terminate()
+
     #    def _add_retry(self, harvest_object):
     #        HarvesterRetry.mark_for_retry(harvest_object)
 
@@ -141,12 +302,6 @@ class DDIHarvester(HarvesterBase):
         def date_from_config(key):
             return self._datetime_from_str(key, self.config.get(key, None))
 
-        def add_harvest_object(harvest_job, url):
-            harvest_obj = hmodel.HarvestObject(job=harvest_job)
-            harvest_obj.content = url
-            harvest_obj.save()
-            return harvest_obj
-
         from_ = date_from_config('from')
         until = date_from_config('until')
         previous_job = model.Session.query(hmodel.HarvestJob) \
@@ -155,83 +310,445 @@ class DDIHarvester(HarvesterBase):
             .filter(hmodel.HarvestJob.id != harvest_job.id) \
             .order_by(hmodel.HarvestJob.gather_finished.desc()) \
             .limit(1).first()
-        if previous_job and not until and not from_:
+        # Conditional fetch checks the modification itself in a single request
+        if previous_job and not until and not from_ and \
+                not self.config.get('conditional_fetch'):
             from_ = previous_job.gather_finished
             until = None
 
+        # Harvest objects are written in batches instead of one commit each
+        harvest_objects = bulk.BulkInserter(
+            model.Session,
+            class_mapper(hmodel.HarvestObject).mapped_table,
+            self.config.get('gather_batch_size', 500),
+            harvest_job_id=harvest_job.id,
+            harvest_source_id=harvest_job.source_id)
         object_ids = []
         # Add retries.
         #        for url in self._scan_retries(harvest_job):
         #            obj = add_harvest_object(harvest_job, url)
         #            object_ids.append(obj.id)
         #            log.debug('Retrying record: %s' % url)
+        source = None
         try:
-            urls = urllib2.urlopen(harvest_job.source.url)
-            for url in itertools.islice(urls.readlines(), self.config.get('limit')):
-                if from_ or until:
-                    # This should not fail the whole gather.
-                    try:
-                        request = urllib2.Request(url)
-                        request.get_method = lambda: 'HEAD'
-                        doc_url = urllib2.urlopen(request)
-                        lastmod = parser.parse(doc_url.headers['last-modified'],
-                                               ignoretz=True)
-                    except (urllib2.URLError, urllib2.HTTPError,):
-                    # Actually we do not know if it fits the time limits.
-                    # Rather get it twice than lose it.
-                    # self._add_retry(add_harvest_object(harvest_job, url))
-                        log.info('Connection error, url: {ur}. Probably just try again.'.format(ur=url))
-                        continue
+            source = httpclient.get(harvest_job.source.url, stream=True)
+            source.raise_for_status()
+            source.raw.decode_content = True
+            # Stream the list so that reading stops at 'limit'
+            urls = urllist.iter_urls(source.raw, self.config.get('limit'))
+            if from_ or until:
+                # This should not fail the whole gather.
+                probed = self._probe_urls(
+                    urls, self.config.get('gather_concurrency', 1))
+            else:
+                probed = ((url, None) for url in urls)
+            for url, lastmod in probed:
+                # If the probe failed we do not know if the document fits the
+                # time limits. Rather get it twice than lose it.
+                if lastmod:
                     if from_ and lastmod < from_:
                         continue
                     if until and until < lastmod:
                         continue
-                obj = add_harvest_object(harvest_job, url)
-                object_ids.append(obj.id)
-        except urllib2.HTTPError, err:
+                object_ids.append(harvest_objects.add(content=url, guid=url))
+            harvest_objects.flush()
+        except requests.HTTPError, err:
             self._save_gather_error(
                 'HTTPError: Could not gather XML files from URL! ' +
-                'Error: {er}'.format(er=err.code), harvest_job)
+                'Error: {er}'.format(er=err.response.status_code), harvest_job)
             return None
-        except urllib2.URLError, err:
+        except requests.RequestException, err:
             self._save_gather_error(
                 'URLError: Could not gather XML files from URL! ' +
-                'Error: {er}, urls: {ur}'.format(er=err.reason, ur=harvest_job.source.url),
+                'Error: {er}, urls: {ur}'.format(er=err, ur=harvest_job.source.url),
                 harvest_job)
             return None
         except Exception as e:
             log.debug(traceback.format_exc(e))
             return None
+        finally:
+            # Returns the pooled connection also when gathering failed
+            if source is not None:
+                source.close()
         #        self._clear_retries()
         log.info('Gathered %i records from %s.' % (
             len(object_ids), harvest_job.source.url,))
+        if self.config.get('batch_import'):
+            # The objects wait for the ddi_harvest_import command instead of
+            # the fetch queue. Without objects to send the gather consumer
+            # returns early, so gathering is marked finished here for "paster
+            # harvester run" to finish the job once they are imported.
+            harvest_job.gather_finished = datetime.datetime.utcnow()
+            model.Session.add(harvest_job)
+            model.Session.commit()
+            return []
         return object_ids
 
     def fetch_stage(self, harvest_object):
         '''Fetch and parse the DDI XML document.
+
+        With 'conditional_fetch' enabled the validators saved from the
+        previous import of the url are sent along the request. A document
+        that has not been modified is marked unchanged and not imported.
         '''
+        self._set_config(harvest_object.job.source.config)
         url = harvest_object.content
+        validators = None
+        headers = {}
+        if self.config.get('conditional_fetch'):
+            validators = self._get_validator_store().get(url)
+            if validators and validators['etag']:
+                headers['If-None-Match'] = validators['etag']
+            if validators and validators['last_modified']:
+                headers['If-Modified-Since'] = validators['last_modified']
         try:
-            f = urllib2.urlopen(url).read()
-        except (urllib2.URLError, urllib2.HTTPError,):
+            response = httpclient.get(url, headers=headers)
+            if response.status_code == 304:
+                log.info('Not modified since last harvest: {ur}'.format(
+                    ur=url.strip()))
+                return 'unchanged'
+            response.raise_for_status()
+            f = response.content
+        except requests.RequestException:
         #            self._add_retry(harvest_object)
             self._save_object_error('Could not fetch from url %s!' % url,
                                     harvest_object)
             return False
-        except httplib.BadStatusLine:
+        info = {'url': url, 'xml': f}
+        if self.config.get('conditional_fetch'):
+            info['content_hash'] = httpcache.content_hash(f)
+            if validators and \
+                    validators['content_hash'] == info['content_hash']:
+                log.info('Content not changed since last harvest: {ur}'
+                         .format(ur=url.strip()))
+                return 'unchanged'
+            info['etag'] = response.headers.get('etag')
+            info['last_modified'] = response.headers.get('last-modified')
+        harvest_object.content = payload.encode(info)
+        return True
+
+    def _load_content(self, harvest_object):
+        '''Return the document fetched for 'harvest_object' or None if there
+        is none. Sets the configuration of the harvest source.
+        '''
+        if not harvest_object.content:
+            self._save_object_error('Import: Empty content for object {id}'.format(
+                id=harvest_object.id), harvest_object)
+            return None
+
+        self._set_config(harvest_object.job.source.config)
+        try:
+            info = payload.decode(harvest_object.content)
+        except ValueError, e:
+            self._save_object_error('Import: Unable to read content for object '
+                                    '{id}: {er}'.format(id=harvest_object.id,
+                                                        er=e), harvest_object)
+            return None
+        log.info("Harvest object url: {ur}".format(ur=info['url'].strip()))
+        return info
+
+    def _stored_content_hash(self, harvest_object):
+        '''Return the content hash saved with the current harvest object of
+        the same document, or None if there is none or its dataset is no
+        longer active.
+        '''
+        row = model.Session.query(hmodel.HarvestObjectExtra.value) \
+            .join(hmodel.HarvestObject, hmodel.HarvestObject.id ==
+                  hmodel.HarvestObjectExtra.harvest_object_id) \
+            .join(model.Package,
+                  model.Package.id == hmodel.HarvestObject.package_id) \
+            .filter(hmodel.HarvestObject.guid == harvest_object.guid) \
+            .filter(hmodel.HarvestObject.harvest_source_id ==
+                    harvest_object.harvest_source_id) \
+            .filter(hmodel.HarvestObject.current == True) \
+            .filter(model.Package.state == u'active') \
+            .filter(hmodel.HarvestObjectExtra.key == CONTENT_HASH_KEY) \
+            .first()
+        return row[0] if row else None
+
+    def _skip_unchanged(self, harvest_object, info):
+        '''Return whether the document of 'harvest_object' is byte for byte
+        the one its current dataset was imported from.
+
+        Otherwise the hash of the document is saved with 'harvest_object' to
+        be compared with in the next harvest. The 'force_import' option
+        imports every document.
+        '''
+        if not harvest_object.guid:
+            return False
+        digest = info.get('content_hash') or \
+            httpcache.content_hash(info['xml'])
+        if not self.config.get('force_import') and \
+                self._stored_content_hash(harvest_object) == digest:
+            log.info('Document not changed since last import: {ur}'.format(
+                ur=info['url'].strip()))
+            harvest_object.content = None
+            self._save_validators(info)
+            return True
+        harvest_object.extras.append(hmodel.HarvestObjectExtra(
+            key=CONTENT_HASH_KEY, value=digest))
+        return False
+
+    def _save_parse_error(self, harvest_object, info, message):
+        self._save_object_error('Unable to parse XML! {er}'
+                                .format(er=message), harvest_object,
+                                'Import')
+        # I presume source sent wrong data but it arrived correctly.
+        # This could result in a case where incorrect source is tried
+        # over and over again without success.
+        del info['xml']
+        harvest_object.content = info['url']
         #            self._add_retry(harvest_object)
-            self._save_object_error('Bad HTTP response status line.',
-                                    harvest_object, stage='Fetch')
+        return False
+
+    def _get_package_schema(self):
+        '''Return the schema of the imported datasets.
+
+        The schema is the same for every document, so it is built once and
+        again only after the plugins are reloaded.
+        '''
+        if self._package_schema is None:
+            self._package_schema = KataPlugin.create_package_schema_ddi()
+        # A copy, as the schema may be changed for a single dataset
+        return dict(self._package_schema)
+
+    def _get_pid_resolver(self, harvest_object):
+        '''Return the resolver of data PIDs of the job of 'harvest_object'.
+
+        A new resolver is made and prefetched for each harvest job.
+        '''
+        job_id = harvest_object.harvest_job_id
+        if self._pid_resolver is None or self._pid_resolver.job_id != job_id:
+            self._pid_resolver = pidresolver.PidResolver(job_id)
+            self._pid_resolver.prefetch(harvest_object.harvest_source_id)
+        return self._pid_resolver
+
+    def _prepare_package(self, harvest_object, info, package_dict, errors):
+        '''Save the conversion errors of the document of 'harvest_object' and
+        complete 'package_dict' for writing. Return whether there is a
+        dataset to write.
+        '''
+        # Check if dataset already exists and use its id.
+        pkg_id = self._get_pid_resolver(harvest_object).resolve(
+            package_dict) if package_dict else None
+        if pkg_id:
+            package_dict['id'] = pkg_id
+            log.debug('Found existing package with PIDs: {pid}'.format(pid=package_dict['pids']))
+
+        for error in errors:
+            self._save_object_error('Invalid or missing mandatory metadata in {ur}. '
+                                    '{er}'.format(ur=info['url'], er=error.message),
+                                    harvest_object,
+                                    'Import',
+                                    error.line)
+        if not package_dict:
             return False
-        # Need to pickle the XML so that the data type remains the same.
-        harvest_object.content = pickle.dumps({'url': url, 'xml': f})
+        if self.config.get('export_variables'):
+            self._export_variables(harvest_object, info, package_dict)
         return True
 
+    def _package_imported(self, harvest_object, info, package_dict):
+        '''Record the dataset 'package_dict' as written.
+        '''
+        self._pid_resolver.add(package_dict)
+        if self.config.get('defer_indexing'):
+            # Saved with the harvest object, so any process can index it
+            harvest_object.extras.append(hmodel.HarvestObjectExtra(
+                key=INDEX_PENDING_KEY, value=package_dict['id']))
+        # Remember validators only after a successful import so that a
+        # failed document is fetched again next time.
+        self._save_validators(info)
+
+    def _save_validators(self, info):
+        '''Remember the validators of the document of 'info', if it was
+        fetched conditionally, for the next harvest to send.
+        '''
+        if 'content_hash' in info:
+            self._get_validator_store().set(info['url'], info.get('etag'),
+                                            info.get('last_modified'),
+                                            info['content_hash'])
+
+    def _import_package(self, harvest_object, info, package_dict, errors):
+        '''Create or update the dataset converted from the document of
+        'harvest_object'.
+        '''
+        if not self._prepare_package(harvest_object, info, package_dict,
+                                     errors):
+            return False
+        result = self._create_or_update_package(package_dict, harvest_object,
+                                                self._get_package_schema())
+        if result:
+            self._package_imported(harvest_object, info, package_dict)
+        return result
+
+    def _get_site_user(self):
+        if self._site_user is None:
+            self._site_user = get_action('get_site_user')(
+                {'model': model, 'ignore_auth': True}, {})['name']
+        return self._site_user
+
+    def _write_package(self, harvest_object, package_dict):
+        '''Create or update the dataset 'package_dict' without committing and
+        make 'harvest_object' the current harvest object of the dataset.
+
+        :raises ckan.logic.ValidationError: if the dataset is invalid
+        '''
+        context = {'model': model, 'session': model.Session,
+                   'user': self._get_site_user(),
+                   'schema': self._get_package_schema(),
+                   'ignore_auth': True, 'defer_commit': True}
+        if model.Package.get(package_dict['id']):
+            get_action('package_update')(context, package_dict)
+        else:
+            get_action('package_create')(context, package_dict)
+        model.Session.query(hmodel.HarvestObject) \
+            .filter(hmodel.HarvestObject.package_id == package_dict['id']) \
+            .filter(hmodel.HarvestObject.id != harvest_object.id) \
+            .update({'current': False}, synchronize_session=False)
+        harvest_object.package_id = package_dict['id']
+        harvest_object.current = True
+        model.Session.add(harvest_object)
+
+    def _write_package_committed(self, harvest_object, package_dict):
+        return bool(self._create_or_update_package(
+            package_dict, harvest_object, self._get_package_schema()))
+
+    def _get_package_batch(self):
+        '''Return a batch of dataset writes for import_batch() or None if the
+        datasets are written one by one.
+        '''
+        size = self.config.get('write_batch_size', 1)
+        if size <= 1:
+            return None
+        # May create the site user, which commits
+        self._get_site_user()
+        # With deferred indexing _package_imported() collects the datasets
+        index = (lambda package_ids: None) \
+            if self.config.get('defer_indexing') else None
+        return bulk.PackageBatch(
+            model.Session, self._write_package, self._write_package_committed,
+            size, self.config.get('write_batch_seconds', WRITE_BATCH_SECONDS),
+            index, self._save_object_errors)
+
+    def _save_object_error(self, message, obj, stage=u'Fetch', line=None):
+        if self._object_errors is not None:
+            # Saving commits, which would commit a write batch half way
+            self._object_errors.append((message, obj, stage, line))
+            return
+        super(DDIHarvester, self)._save_object_error(message, obj, stage,
+                                                     line)
+
+    def _save_object_errors(self):
+        '''Save the object errors collected while a write batch was open.
+        '''
+        errors, self._object_errors = self._object_errors, []
+        for message, obj, stage, line in errors:
+            super(DDIHarvester, self)._save_object_error(message, obj, stage,
+                                                         line)
+
+    def _index_if_job_imported(self, harvest_objects):
+        '''Index the datasets waiting for deferred indexing if no harvest
+        objects of the job other than 'harvest_objects' are left to import.
+        '''
+        remaining = model.Session.query(hmodel.HarvestObject.id) \
+            .filter(hmodel.HarvestObject.harvest_job_id ==
+                    harvest_objects[0].harvest_job_id) \
+            .filter(hmodel.HarvestObject.state.in_(PENDING_STATES)) \
+            .filter(~hmodel.HarvestObject.id.in_(
+                [harvest_object.id for harvest_object in harvest_objects])) \
+            .first()
+        if remaining is None:
+            self.index_pending(harvest_objects[0].harvest_source_id)
+
+    def index_pending(self, source_id):
+        '''Index the datasets of harvest source 'source_id' written with the
+        'defer_indexing' option and not indexed yet, in chunks and with one
+        commit of the search index.
+
+        The datasets are read from the harvest objects of all processes and
+        earlier jobs, so datasets missed when two jobs ended at once are
+        indexed at the end of the next job. The number of datasets indexed
+        at a time is read from 'ckanext.ddi.index_chunk_size'.
+
+        :returns: the number of datasets indexed
+        :rtype: int
+        '''
+        pending = model.Session.query(hmodel.HarvestObjectExtra.id,
+                                      hmodel.HarvestObjectExtra.value) \
+            .join(hmodel.HarvestObject, hmodel.HarvestObject.id ==
+                  hmodel.HarvestObjectExtra.harvest_object_id) \
+            .filter(hmodel.HarvestObject.harvest_source_id == source_id) \
+            .filter(hmodel.HarvestObjectExtra.key == INDEX_PENDING_KEY) \
+            .all()
+        if not pending:
+            return 0
+        deferred_index = bulk.DeferredIndex(int(ckan_config.get(
+            'ckanext.ddi.index_chunk_size', INDEX_CHUNK_SIZE)))
+        deferred_index.add(package_id for _, package_id in pending)
+        indexed = deferred_index.flush()
+        model.Session.query(hmodel.HarvestObjectExtra) \
+            .filter(hmodel.HarvestObjectExtra.id.in_(
+                [extra_id for extra_id, _ in pending])) \
+            .delete(synchronize_session='fetch')
+        model.Session.commit()
+        log.info('Indexed {n} datasets of harvest source {so}'.format(
+            n=indexed, so=source_id))
+        return indexed
+
+    def _export_variables(self, harvest_object, info, package_dict):
+        '''Save the variables of the document of 'harvest_object' to the CKAN
+        storage as two CSV files and add them to the resources of
+        'package_dict'. With NumPy installed, the statistics of the variables
+        are also saved as columns in an .npz file.
+
+        The document is read again with varexport, so the variables are not
+        needed in the parsed tree. The files are spooled to disk when they
+        grow large.
+        '''
+        # Needs a CKAN site, so not imported with the module
+        import ckan.controllers.storage as storage
+        from ckan.lib.base import h
+
+        files = [('var.csv', 'Variable metadata', 'csv',
+                  tempfile.SpooledTemporaryFile(EXPORT_SPOOL_SIZE)),
+                 ('code.csv', 'Variable code values', 'csv',
+                  tempfile.SpooledTemporaryFile(EXPORT_SPOOL_SIZE))]
+        stats = varstats.VariableStats() if varstats.available() else None
+        try:
+            if not varexport.write_variables(info['xml'], files[0][3],
+                                             files[1][3], stats):
+                return
+            if stats is not None:
+                files.append(('stats.npz', 'Variable statistics', 'npz',
+                              tempfile.SpooledTemporaryFile(EXPORT_SPOOL_SIZE)))
+                stats.save(files[2][3])
+            ofs = storage.get_ofs()
+            for suffix, description, file_format, export_file in files:
+                label = '{dir}/{name}_{suffix}'.format(
+                    dir=harvest_object.harvest_source_id,
+                    name=package_dict['name'], suffix=suffix)
+                export_file.seek(0)
+                ofs.put_stream(storage.BUCKET, label, export_file, {})
+                package_dict.setdefault('resources', []).append({
+                    'url': ckan_config.get('ckan.site_url', '') +
+                    h.url_for('storage_file', label=label),
+                    'description': description,
+                    'format': file_format,
+                    'resource_type': 'documentation',
+                })
+        except IOError, ioe:
+            self._save_object_error('Unable to save xml variables: {io}'
+                                    .format(io=ioe), harvest_object, 'Import')
+        finally:
+            for _, _, _, export_file in files:
+                export_file.close()
+
     def import_stage(self, harvest_object):
         '''Import the metadata received in the fetch stage to a dataset.
 
-        DDI document is parsed to a BeautifulSoup object for metadata
-        extraction. Study (stdyDscr) and document (docDscr) descriptions are
+        DDI document is parsed once to an lxml tree, or to a BeautifulSoup
+        object with the 'bs4' parser option, which is used both for metadata
+        extraction and for flattening. Study (stdyDscr) and document (docDscr) descriptions are
         used. File (fileDscr) and data (dataDscr) description parts of a ddi
         file are saved as csv files (unfinished).
         Also create groups if ones are defined (unfinished).
@@ -240,58 +757,222 @@ class DDIHarvester(HarvesterBase):
             log.error('No harvest object received')
             return False
 
-        if not harvest_object.content:
-            self._save_object_error('Import: Empty content for object {id}'.format(
-                id=harvest_object.id), harvest_object)
+        info = self._load_content(harvest_object)
+        if info is None:
             return False
+        if not self.config.get('defer_indexing'):
+            return self._import_document(harvest_object, info)
+        with bulk.indexing_suspended():
+            result = self._import_document(harvest_object, info)
+        self._index_if_job_imported([harvest_object])
+        return result
 
-        # TODO: cPickle might be faster
-        info = pickle.loads(harvest_object.content)
-        log.info("Harvest object url: {ur}".format(ur=info['url'].strip()))
+    def _import_document(self, harvest_object, info):
+        if self._skip_unchanged(harvest_object, info):
+            return 'unchanged'
         try:
-            ddi_xml = BeautifulSoup(info['xml'], 'xml')
+            ddi_xml = self.ddi_converter.parse(info['xml'])
         except etree.XMLSyntaxError, err:
-            self._save_object_error('Unable to parse XML! {er}'
-                                    .format(er=err.msg), harvest_object,
-                                    'Import')
-            # I presume source sent wrong data but it arrived correctly.
-            # This could result in a case where incorrect source is tried
-            # over and over again without success.
-            del info['xml']
-            harvest_object.content = info['url']
-            #            self._add_retry(harvest_object)
-            return False
-
-        self.ddi_converter.read_fsd_ref()
-        package_dict = self.ddi_converter.ddi2ckan(ddi_xml, info['url'],
-                                                   info['xml'], harvest_object)
+            return self._save_parse_error(harvest_object, info, err.msg)
 
-        # Check if dataset already exists and use its id.
-        pkg_id = utils.get_package_id_by_data_pids(package_dict)
-        pkg = model.Session.query(model.Package).filter(model.Package.id == pkg_id).first() if pkg_id else None
-        if pkg:
-            package_dict['id'] = pkg.id
-            log.debug('Found existing package with PIDs: {pid}'.format(pid=package_dict['pids']))
-
-        errors = self.ddi_converter.get_errors()
-        if errors:
-            # FIXME: Using line number here hazardous. Old _read_value doesn't support
-            for er, line in errors:
-                self._save_object_error('Invalid or missing mandatory metadata in {ur}. '
-                                        '{er}'.format(ur=info['url'], er=er),
-                                        harvest_object,
-                                        'Import',
-                                        line)
-            self.ddi_converter.empty_errors()
-        if not package_dict:
-            return False
-        schema = KataPlugin.create_package_schema_ddi()
-        result = self._create_or_update_package(package_dict, harvest_object,
-                                                schema)
-        self.ddi_converter.write_fsd_ref()
+        package_dict, errors = self.ddi_converter.convert(
+            ddi_xml, info['url'], info['xml'], harvest_object)
+        result = self._import_package(harvest_object, info, package_dict,
+                                      errors)
         log.debug("Exiting import_stage()")
         return result  # returns True
 
+    def _get_conversion_pool(self):
+        '''Return the pool of conversion processes of import_batch().
+
+        The number of processes is read from 'ckanext.ddi.import_processes'
+        and defaults to the number of CPUs.
+        '''
+        if self._conversion_pool is None:
+            processes = ckan_config.get('ckanext.ddi.import_processes')
+            self._conversion_pool = convertpool.ConversionPool(
+                int(processes) if processes else None)
+        return self._conversion_pool
+
+    def _import_converted(self, loaded, converted, results, batch):
+        '''Write the datasets converted in import_batch(), one by one or in
+        'batch', and set their 'results'.
+
+        With a batch the object errors are saved after each commit of the
+        batch, outside its transaction.
+        '''
+        if batch is None:
+            self._write_converted(loaded, converted, results, None)
+            return
+        self._object_errors = []
+        try:
+            self._write_converted(loaded, converted, results, batch)
+            for failed in batch.flush():
+                results[failed] = False
+            self._save_object_errors()
+        finally:
+            self._object_errors = None
+
+    def _write_converted(self, loaded, converted, results, batch):
+        for (i, harvest_object, info, _), (package_dict, errors, parse_error) \
+                in itertools.izip(loaded, converted):
+            if parse_error is not None:
+                results[i] = self._save_parse_error(harvest_object, info,
+                                                    parse_error)
+                continue
+            if package_dict:
+                # The workers have no access to the harvest objects
+                try:
+                    package_dict['owner_org'] = ownerorgs.get_owner_org(
+                        harvest_object)
+                except NoResultFound:
+                    self._save_object_error(
+                        'No owner organization for harvest source {so}'
+                        .format(so=harvest_object.harvest_source_id),
+                        harvest_object, 'Import')
+                    continue
+            if batch is None:
+                results[i] = self._import_package(harvest_object, info,
+                                                  package_dict, errors)
+                if results[i]:
+                    harvest_object.content = None
+            elif self._prepare_package(harvest_object, info, package_dict,
+                                       errors):
+                results[i] = True
+                for failed in batch.add(i, harvest_object, package_dict,
+                                        functools.partial(
+                                            self._batch_package_imported,
+                                            harvest_object, info,
+                                            package_dict)):
+                    results[failed] = False
+
+    def _batch_package_imported(self, harvest_object, info, package_dict):
+        self._package_imported(harvest_object, info, package_dict)
+        # The document is no longer needed once its dataset is committed
+        harvest_object.content = None
+
+    def import_batch(self, harvest_objects):
+        '''Import several harvest objects like import_stage() does. Called
+        by import_harvest_objects().
+
+        The documents are parsed and converted in parallel in a pool of worker
+        processes. The datasets are then written one by one in this process,
+        so database access is not shared with the workers.
+
+        With the 'write_batch_size' option the datasets are committed together
+        every 'write_batch_size' datasets or 'write_batch_seconds' seconds,
+        and indexed once per commit. A batch that fails is written again one
+        dataset at a time.
+
+        With the 'defer_indexing' option the datasets are indexed when the
+        whole job has been imported.
+
+        :param harvest_objects: fetched harvest objects
+        :type harvest_objects: list
+        :returns: the result of import_stage() for each harvest object
+        :rtype: list
+        '''
+        results = [False] * len(harvest_objects)
+        if harvest_objects:
+            # Prefetch the data PIDs of the job before converting
+            self._get_pid_resolver(harvest_objects[0])
+        loaded = []
+        for i, harvest_object in enumerate(harvest_objects):
+            info = self._load_content(harvest_object)
+            if info is None:
+                continue
+            if self._skip_unchanged(harvest_object, info):
+                results[i] = 'unchanged'
+                continue
+            loaded.append((i, harvest_object, info,
+                           self.config.get('parser', 'bs4')))
+        converted = self._get_conversion_pool().imap(
+            (parser, info['url'], info['xml'], True)
+            for _, _, info, parser in loaded)
+        batch = self._get_package_batch() if loaded else None
+        if batch is not None:
+            # Rolling back a failed batch would lose the content hashes
+            model.Session.commit()
+        # The job may end with a batch of unchanged documents
+        defer_indexing = bool(harvest_objects and self.config and
+                              self.config.get('defer_indexing'))
+        if batch is None and not defer_indexing:
+            self._import_converted(loaded, converted, results, None)
+        else:
+            with bulk.indexing_suspended():
+                self._import_converted(loaded, converted, results, batch)
+        if defer_indexing:
+            self._index_if_job_imported(harvest_objects)
+        log.debug('Imported a batch of {n} harvest objects, {u} unchanged'
+                  .format(n=len(harvest_objects),
+                          u=results.count('unchanged')))
+        return results
+
+    def import_harvest_objects(self, harvest_objects):
+        '''Fetch and import waiting harvest objects of a job, doing what the
+        fetch consumer of ckanext-harvest does for each object, but with
+        import_batch() for the fetched documents. Used by the
+        ddi_harvest_import command for sources with the 'batch_import'
+        option.
+
+        :param harvest_objects: waiting harvest objects of one harvest job
+        :type harvest_objects: list
+        :returns: the number of harvest objects imported
+        :rtype: int
+        '''
+        fetched = []
+        for harvest_object in harvest_objects:
+            harvest_object.fetch_started = datetime.datetime.utcnow()
+            harvest_object.state = u'FETCH'
+            result = self.fetch_stage(harvest_object)
+            harvest_object.fetch_finished = datetime.datetime.utcnow()
+            if result is True:
+                harvest_object.import_started = datetime.datetime.utcnow()
+                harvest_object.state = u'IMPORT'
+                fetched.append(harvest_object)
+            else:
+                self._finish_object(harvest_object, result)
+            model.Session.add(harvest_object)
+        model.Session.commit()
+        try:
+            results = self.import_batch(fetched)
+        except Exception, e:
+            # The objects would otherwise stay in the IMPORT state
+            log.exception(e)
+            model.Session.rollback()
+            results = [False] * len(fetched)
+            for harvest_object in fetched:
+                self._save_object_error(
+                    'Unable to import the batch: {er}'.format(er=e),
+                    harvest_object, 'Import')
+        for harvest_object, result in itertools.izip(fetched, results):
+            harvest_object.import_finished = datetime.datetime.utcnow()
+            self._finish_object(harvest_object, result)
+            model.Session.add(harvest_object)
+        model.Session.commit()
+        return len([result for result in results if result])
+
+    def _finish_object(self, harvest_object, result):
+        '''Set the state and the report status of 'harvest_object' from the
+        result of fetch_stage() or import_stage().
+        '''
+        if result == 'unchanged':
+            harvest_object.state = u'COMPLETE'
+            harvest_object.report_status = u'not modified'
+            return
+        harvest_object.state = u'COMPLETE' if result else u'ERROR'
+        if not result:
+            harvest_object.report_status = u'errored'
+        elif harvest_object.current is False:
+            harvest_object.report_status = u'deleted'
+        elif model.Session.query(hmodel.HarvestObject.id) \
+                .filter(hmodel.HarvestObject.package_id ==
+                        harvest_object.package_id) \
+                .limit(2).count() == 2:
+            harvest_object.report_status = u'updated'
+        else:
+            harvest_object.report_status = u'added'
+
     def fetch_xml(self, url, context):
         '''Get xml for import. Shortened from :meth:`fetch_stage`
 
@@ -303,12 +984,11 @@ class DDIHarvester(HarvesterBase):
         '''
         try:
             log.debug('Requesting url {ur}'.format(ur=url))
-            f = urllib2.urlopen(url).read()
-            return self.parse_xml(f, context, url)
-        except (urllib2.URLError, urllib2.HTTPError,):
+            response = httpclient.get(url)
+            response.raise_for_status()
+            return self.parse_xml(response.content, context, url)
+        except requests.RequestException:
             log.debug('fetch_xml: Could not fetch from url {ur}!'.format(ur=url))
-        except httplib.BadStatusLine:
-            log.debug('Bad HTTP response status line.')
 
     def parse_xml(self, f, context, orig_url=None, strict=True):
         '''Import single metadata file.
@@ -324,20 +1004,16 @@ class DDIHarvester(HarvesterBase):
         :rtype: dict
         '''
         try:
-            ddi_xml = BeautifulSoup(f, 'xml')
+            ddi_xml = self.ddi_converter.parse(f)
         except etree.XMLSyntaxError, err:
             log.debug('Unable to parse XML! {er}'.format(er=err.msg))
             return None
-        package_dict = self.ddi_converter.ddi2ckan(ddi_xml, orig_url, f,
-                                                   context=context,
-                                                   strict=strict)
-        errors = self.ddi_converter.get_errors()
-        if errors:
-            # FIXME: Can't use line number here. Old _read_value doesn't provide
-            for er in errors:
-                log.debug('Invalid or missing mandatory metadata in {ur}. '
-                          '{er}'.format(ur=orig_url, er=er))
-            self.ddi_converter.empty_errors()
+        package_dict, errors = self.ddi_converter.convert(
+            ddi_xml, orig_url, f, context=context, strict=strict)
+        for error in errors:
+            log.debug('Invalid or missing mandatory metadata in {ur}. '
+                      '{er} (line {li})'.format(ur=orig_url, er=error.message,
+                                               li=error.line))
         return package_dict
 
 #
@@ -0,0 +1,90 @@
+# coding: utf-8
+'''
+Persistent store of HTTP cache validators for harvested DDI documents
+'''
+
+import datetime
+import hashlib
+import logging
+import sqlite3
+
+log = logging.getLogger(__name__)
+
+
+def content_hash(content):
+    '''Return a hex digest identifying the bytes of a fetched document.
+
+    :param content: the document
+    :type content: string
+    :rtype: string
+    '''
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+class ValidatorStore(object):
+    '''Keep the ETag, Last-Modified and content hash of each fetched url
+    between harvest jobs.
+
+    The store is a SQLite database so that several harvester processes can
+    share it.
+
+    :param path: path of the database file
+    :type path: string
+    '''
+    FIELDS = ('etag', 'last_modified', 'content_hash')
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS validators ('
+                'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, '
+                'content_hash TEXT, updated TEXT)')
+            self._conn.commit()
+        return self._conn
+
+    def get(self, url):
+        '''Return the stored validators of 'url'.
+
+        :param url: the url of the document
+        :type url: string
+        :returns: a dict with keys 'etag', 'last_modified' and 'content_hash'
+            or None if the url is not known
+        :rtype: dict
+        '''
+        try:
+            row = self._connect().execute(
+                'SELECT etag, last_modified, content_hash FROM validators '
+                'WHERE url = ?', (url.strip(),)).fetchone()
+        except sqlite3.Error as e:
+            log.info('Unable to read validators of {ur}: {er}'.format(
+                ur=url.strip(), er=e))
+            return None
+        return dict(zip(self.FIELDS, row)) if row else None
+
+    def set(self, url, etag=None, last_modified=None, content_hash=None):
+        '''Save the validators of 'url', replacing the old ones.
+        '''
+        try:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO validators '
+                '(url, etag, last_modified, content_hash, updated) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (url.strip(), etag, last_modified, content_hash,
+                 datetime.datetime.utcnow().isoformat()))
+            conn.commit()
+        except sqlite3.Error as e:
+            log.info('Unable to save validators of {ur}: {er}'.format(
+                ur=url.strip(), er=e))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
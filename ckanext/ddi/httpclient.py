@@ -0,0 +1,65 @@
+# coding: utf-8
+'''
+Shared HTTP client of the DDI harvester
+
+All requests go through one requests.Session whose adapters keep per-host
+pools of keep-alive connections, so fetching thousands of documents from
+the same archive reuses a few sockets. Gzip and deflate encoded responses
+are decoded by requests.
+'''
+
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+TIMEOUT = 30
+# Number of hosts to keep pools for
+POOL_CONNECTIONS = 10
+# Connections kept open, and allowed at once, per host
+POOL_MAXSIZE = 10
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(pool_maxsize=POOL_MAXSIZE):
+    '''Return the process-wide HTTP session, creating it on first use.
+
+    :param pool_maxsize: maximum number of connections per host. Only used
+        when the session is created. Requests wait for a free connection
+        when the limit is reached.
+    :type pool_maxsize: int
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                                  pool_maxsize=pool_maxsize,
+                                  pool_block=True)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def head(url, **kwargs):
+    '''Send a HEAD request through the shared session.
+
+    :rtype: requests.Response
+    '''
+    kwargs.setdefault('timeout', TIMEOUT)
+    return get_session().head(url, **kwargs)
+
+
+def get(url, **kwargs):
+    '''Send a GET request through the shared session.
+
+    :rtype: requests.Response
+    '''
+    kwargs.setdefault('timeout', TIMEOUT)
+    return get_session().get(url, **kwargs)
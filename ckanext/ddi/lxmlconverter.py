@@ -0,0 +1,568 @@
+# coding: utf-8
+'''
+lxml engine for converting DDI2 to CKAN format
+
+Extracts the same fields as :class:`dataconverter.DataConverter` but reads
+them from an lxml tree with precompiled XPath expressions instead of walking
+a BeautifulSoup tree. The expressions mimic BeautifulSoup lookups so both
+engines produce the same package dictionaries.
+'''
+
+import json
+import logging
+
+import lxml.etree as etree
+
+import ckanext.kata.utils as utils
+import ckanext.oaipmh.importcore as importcore
+
+import dataconverter as dconverter
+from dataconverter import ExceptReturn
+
+log = logging.getLogger(__name__)
+
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+# Whitespace-only strings are collapsed by BeautifulSoup
+ASCII_SPACES = dict.fromkeys(map(ord, u'\x20\x0a\x09\x0c\x0d'))
+
+
+def _xpath(path, absolute=True):
+    '''Compile a dotted path like 'stdyDscr.citation.titlStmt' to an XPath
+    expression.
+
+    Like chained BeautifulSoup attribute access each step selects the first
+    descendant with the name, ignoring namespaces.
+    '''
+    steps = '/'.join("descendant::*[local-name()='{n}'][1]".format(n=name)
+                     for name in path.split('.'))
+    return etree.XPath(('/' if absolute else '') + steps)
+
+
+CODEBOOK = _xpath('codeBook')
+STDY_CITATION = _xpath('stdyDscr.citation')
+STDY_STDYINFO = _xpath('stdyDscr.stdyInfo')
+STDY_SUBJECT = _xpath('stdyDscr.stdyInfo.subject')
+
+DOC_TITLSTMT = _xpath('codeBook.docDscr.citation.titlStmt')
+DOC_IDNO = _xpath('codeBook.docDscr.citation.titlStmt.IDNo')
+DOC_PRODSTMT = _xpath('codeBook.docDscr.citation.prodStmt')
+DOC_PRODUCER = _xpath('codeBook.docDscr.citation.prodStmt.producer')
+DOC_HOLDINGS = _xpath('codeBook.docDscr.citation.holdings')
+
+STDY_TITLSTMT = _xpath('codeBook.stdyDscr.citation.titlStmt')
+STDY_IDNO = _xpath('codeBook.stdyDscr.citation.titlStmt.IDNo')
+STDY_USESTMT = _xpath('codeBook.stdyDscr.dataAccs.useStmt')
+STDY_DISTSTMT = _xpath('codeBook.stdyDscr.citation.distStmt')
+STDY_CONTACT = _xpath('codeBook.stdyDscr.citation.distStmt.contact')
+STDY_DISTRBTR = _xpath('codeBook.stdyDscr.citation.distStmt.distrbtr')
+STDY_PRODSTMT = _xpath('codeBook.stdyDscr.citation.prodStmt')
+STDY_PRODUCER = _xpath('codeBook.stdyDscr.citation.prodStmt.producer')
+STDY_RSP_AUTHENTY = _xpath('codeBook.stdyDscr.citation.rspStmt.AuthEnty')
+STDY_HOLDINGS = _xpath('codeBook.stdyDscr.citation.holdings')
+STDY_BIBLCIT = _xpath('codeBook.stdyDscr.citation.biblCit')
+STDY_ACCSPLAC = _xpath('codeBook.stdyDscr.dataAccs.setAvail.accsPlac')
+STDY_ABSTRACT = _xpath('codeBook.stdyDscr.stdyInfo.abstract')
+STDY_SERINFO = _xpath('codeBook.stdyDscr.citation.serStmt.serInfo')
+STDY_SUMDSCR = _xpath('codeBook.stdyDscr.stdyInfo.sumDscr')
+STDY_DATACOLL = _xpath('codeBook.stdyDscr.method.dataColl')
+
+FIND_ALL = etree.XPath('descendant::*[local-name()=$name]')
+FIND_TITLES = etree.XPath(
+    "descendant::*[local-name()='titl' or local-name()='parTitl']")
+FIND_KEYWORDS = etree.XPath("descendant::*[@vocab and not(@vocab='FSD')]")
+FIND_DISCIPLINES = etree.XPath(
+    "descendant::*[local-name()='topcClas'][@vocab='FSD']")
+FIND_COLLECTION_STARTS = etree.XPath(
+    "descendant::*[local-name()='collDate'][@event='start']")
+TEXT_NODES = etree.XPath('descendant::text()')
+CHILD_NODES = etree.XPath('child::node()')
+
+
+def _first(xpath, node):
+    '''Return the first element selected by 'xpath' or None.
+    '''
+    result = xpath(node)
+    return result[0] if result else None
+
+
+def _collapse(text):
+    '''Return 'text' as BeautifulSoup stores it.
+    '''
+    text = unicode(text)
+    if not text.translate(ASCII_SPACES):
+        return u'\n' if u'\n' in text else u' '
+    return text
+
+
+def _strings(el):
+    '''Return the text nodes of 'el' like BeautifulSoup's strings.
+    '''
+    return [_collapse(t) for t in TEXT_NODES(el)]
+
+
+def _text(el):
+    '''Return the text of 'el' like BeautifulSoup's Tag.text.
+    '''
+    return u''.join(_strings(el))
+
+
+def _string(el):
+    '''Return the only string inside 'el' like BeautifulSoup's Tag.string.
+    '''
+    nodes = CHILD_NODES(el)
+    if len(nodes) != 1:
+        return None
+    node = nodes[0]
+    if isinstance(node, basestring):
+        return _collapse(node)
+    if isinstance(node, (etree._Comment, etree._ProcessingInstruction)):
+        return unicode(node.text)
+    return _string(node)
+
+
+def _extract(el):
+    '''Remove 'el' from its tree but keep the text following it, like
+    BeautifulSoup's Tag.extract().
+    '''
+    parent = el.getparent()
+    if el.tail:
+        previous = el.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + el.tail
+        else:
+            parent.text = (parent.text or '') + el.tail
+    parent.remove(el)
+    return el
+
+
+class LxmlDataConverter(dconverter.DataConverter):
+    '''DataConverter reading lxml trees with precompiled XPath expressions.
+    '''
+
+    def parse(self, xml, prune=True):
+        '''Parse a DDI document to the tree ddi2ckan() reads.
+
+        Recovers from errors like the BeautifulSoup parser does.
+
+        :param xml: the DDI XML document
+        :type xml: string
+        :param prune: leave out the PRUNED_SECTIONS, which are only needed
+            for the variable export
+        :type prune: boolean
+        :rtype: lxml.etree._Element
+        '''
+        if prune:
+            return dconverter.parse_pruned(xml)
+        return etree.fromstring(xml, etree.XMLParser(recover=True))
+
+    def _read(self, xpath, path, mandatory_field=False):
+        '''Return the element selected by 'xpath' from the document.
+
+        Returns None and records missing mandatory values like
+        :meth:`DataConverter._read_value` does.
+
+        :param path: the path of 'xpath' for messages
+        '''
+        el = _first(xpath, self.ddi_xml)
+        if el is None:
+            if mandatory_field and self.strict:
+                log.debug('Unable to read mandatory value: {path}'
+                          .format(path=path))
+                self.errors.append(dconverter.ConversionError(
+                    path, 'Unable to read mandatory value: {path}'
+                    .format(path=path), None))
+            else:
+                log.debug('Unable to read optional value: {path}'
+                          .format(path=path))
+        return el
+
+    def _read_all(self, xpath, path, name, mandatory_field=False):
+        '''Return all elements named 'name' below the element selected by
+        'xpath', or an empty string if there is no such element.
+        '''
+        el = self._read(xpath, path, mandatory_field=mandatory_field)
+        return FIND_ALL(el, name=name) if el is not None else u''
+
+    def _read_attr(self, xpath, path, attr, default=None,
+                   mandatory_field=False):
+        el = self._read(xpath, path, mandatory_field=mandatory_field)
+        return el.get(attr, default) if el is not None else u''
+
+    def _read_text(self, xpath, path, mandatory_field=False):
+        el = self._read(xpath, path, mandatory_field=mandatory_field)
+        return _text(el) if el is not None else u''
+
+    @ExceptReturn(AttributeError)
+    def get_clean_date(self, el):
+        raw_date = dconverter.DATE_REGEX.search(el.get('date'))
+        return raw_date.group(0).rstrip('-') if raw_date and \
+                                                raw_date.group(0) else ''
+
+    def _find_attr(self, start_el, search_tag, attr, match):
+        els = dconverter._match(FIND_ALL(start_el, name=search_tag),
+                                search_tag, match)
+        if match == dconverter.MATCH_ALL:
+            return [unicode(el.attrib[attr]) for el in els]
+        return unicode(els.attrib[attr])
+
+    @ExceptReturn((AttributeError, TypeError, KeyError,
+                   dconverter.AmbiguousTagError), mandatory_field=True)
+    def get_attr_mandatory(self, start_el, search_tag, attr,
+                           match=dconverter.MATCH_ONE):
+        '''Return the value of an attribute of the only 'search_tag' element.
+
+        See :meth:`DataConverter.get_attr_mandatory` for 'match'.
+        '''
+        return self._find_attr(start_el, search_tag, attr, match)
+
+    @ExceptReturn((AttributeError, TypeError, KeyError))
+    def get_attr_optional(self, start_el, search_tag, attr,
+                          match=dconverter.MATCH_ONE):
+        return self._find_attr(start_el, search_tag, attr, match)
+
+    def _get_agents(self, start_el, search_tag, role):
+        return [{'role': role,
+                 'name': _text(tag).strip(),
+                 'organisation': tag.get('affiliation', '')}
+                for tag in FIND_ALL(start_el, name=search_tag)]
+
+    @ExceptReturn((AttributeError, TypeError), mandatory_field=True)
+    def get_authors(self, start_el, search_tag='AuthEnty'):
+        return self._get_agents(start_el, search_tag, 'author')
+
+    @ExceptReturn((AttributeError, TypeError))
+    def get_contributors(self, start_el, search_tag='othId'):
+        return self._get_agents(start_el, search_tag, 'contributor')
+
+    @ExceptReturn((AttributeError, TypeError), mandatory_field=True)
+    def get_keywords(self, start_el):
+        return self.search_tag_content(start_el, FIND_KEYWORDS)
+
+    @ExceptReturn((AttributeError, TypeError))
+    def get_discipline(self, start_el):
+        return self.search_tag_content(start_el, FIND_DISCIPLINES)
+
+    def search_tag_content(self, start_el, xpath):
+        '''Return comma separated strings of the elements selected by 'xpath'
+        and remove the elements from the tree.
+        '''
+        strings = [_string(_extract(tag)) for tag in xpath(start_el)]
+        return ','.join([s for s in strings if s])
+
+    def _get_events(self, authors):
+        '''
+        Parse data into events from DDI fields
+        '''
+        events = []
+
+        # Event: Collection
+        sum_dscr = self._read(STDY_SUMDSCR, 'stdyDscr.stdyInfo.sumDscr')
+        ev_type_collect = FIND_COLLECTION_STARTS(sum_dscr) \
+            if sum_dscr is not None else u''
+        data_collector = self._read_all(STDY_DATACOLL,
+                                        'stdyDscr.method.dataColl',
+                                        'dataCollector')
+        data_coll_string = u''
+        for d in data_collector:
+            text = _text(d)
+            if text:
+                data_coll_string += '; ' + text
+            elif d.attrib['affiliation']:
+                data_coll_string += '; ' + d.attrib['affiliation']
+        data_coll_string = data_coll_string[2:]
+        for collection in ev_type_collect:
+            events.append({'descr': u'Event automatically created at import.',
+                           'type': u'collection',
+                           'when': self.get_clean_date(collection),
+                           'who': data_coll_string})
+
+        # Event: Creation (eg. Published in publication)
+        ev_type_create = self._read_all(STDY_PRODSTMT,
+                                        'stdyDscr.citation.prodStmt',
+                                        'prodDate')
+        if ev_type_create:
+            data_creators = [ a.get('name') or a.get('organisation') for a in authors ]
+            data_creator_string = '; '.join(data_creators)
+            events.append({'descr': u'Event automatically created at import.',
+                           'type': u'creation',
+                           'when': self.get_clean_date(ev_type_create[0]),
+                           'who': data_creator_string})
+
+        return events
+
+    @ExceptReturn((AttributeError, TypeError))
+    def get_geo_coverage(self, start_el):
+        '''Return a string of comma separated locations.
+
+        Removes matched elements from the tree.
+        '''
+        geog_lcs = FIND_ALL(start_el, name='geogCover')
+        return ','.join([_string(_extract(loc)) for loc in geog_lcs])
+
+    @ExceptReturn((AttributeError, TypeError))
+    def get_temporal_coverage(self, start_el):
+        '''Return the beginning and ending date of a time period covered by
+        dataset.
+
+        Removes matched elements from the tree.
+        '''
+        t_begin = t_end = u''
+        for t in FIND_ALL(start_el, name='timePrd'):
+            clean_date = self.get_clean_date(_extract(t))
+            if t.attrib['event'] == 'single':
+                t_begin = t_end = clean_date
+            if t.attrib['event'] == 'start':
+                t_begin = clean_date
+            if t.attrib['event'] == 'end':
+                t_end = clean_date
+        return t_begin, t_end
+
+    def _ddi2ckan(self, original_url, original_xml, harvest_object):
+        '''Extract package values from lxml tree 'ddi_xml' parsed from xml
+        '''
+        is_fsd = dconverter._is_fsd(original_url)
+        stdy_citation = _first(STDY_CITATION, self.ddi_xml)
+        if stdy_citation is None or \
+                _first(STDY_STDYINFO, self.ddi_xml) is None:
+            raise AttributeError('No stdyDscr/citation or stdyDscr/stdyInfo '
+                                 'found')
+
+        ####################################################################
+        #      Read mandatory metadata fields:                             #
+        ####################################################################
+        # Authors & organizations
+        authors = self.get_authors(stdy_citation, 'AuthEnty')
+        agent = authors[:]
+        agent.extend(self.get_contributors(stdy_citation))
+
+        # Availability
+        availability = dconverter.AVAILABILITY_DEFAULT
+        if dconverter._access_request_URL_is_found():
+            availability = 'direct_download'
+        if is_fsd:
+            availability = dconverter.AVAILABILITY_FSD
+
+        # Keywords
+        keywords = self.get_keywords(_first(STDY_SUBJECT, self.ddi_xml))
+
+        # Language
+        language = self.convert_language(
+            self._read_attr(CODEBOOK, 'codeBook', XML_LANG))
+
+        # Titles
+        title_stmt = self._read(STDY_TITLSTMT, 'stdyDscr.citation.titlStmt')
+        titles = FIND_TITLES(title_stmt) if title_stmt is not None else u''
+        if not titles:
+            title_stmt = self._read(DOC_TITLSTMT,
+                                    'docDscr.citation.titlStmt',
+                                    mandatory_field=True)
+            titles = FIND_TITLES(title_stmt) if title_stmt is not None \
+                else u''
+
+        transl_json = {}
+        first_title = ""
+        default_lang = "fi"
+        for title in titles:
+            transl_json[self.convert_language(
+                title.get(XML_LANG, default_lang))] = _text(title)
+            if not first_title:
+                first_title = _text(title)
+
+        title = json.dumps(transl_json)
+
+        # License
+        use_stmt = self._read(STDY_USESTMT, 'stdyDscr.dataAccs.useStmt')
+        license_url = u' '.join(_strings(use_stmt)) \
+            if use_stmt is not None else u''
+        if is_fsd:
+            license_id = dconverter.LICENSE_ID_FSD
+        else:
+            license_id = dconverter.LICENSE_ID_DEFAULT
+
+        # Contact
+        contact_name = self._read_all(STDY_DISTSTMT,
+                                      'stdyDscr.citation.distStmt',
+                                      'contact') or \
+            self._read_all(STDY_DISTSTMT, 'stdyDscr.citation.distStmt',
+                           'distrbtr') or \
+            self._read_all(DOC_PRODSTMT, 'docDscr.citation.prodStmt',
+                           'producer', mandatory_field=True)
+        if contact_name and _text(contact_name[0]):
+            contact_name = _text(contact_name[0])
+        else:
+            contact_name = self._read_attr(
+                STDY_PRODUCER, 'stdyDscr.citation.prodStmt.producer',
+                'affiliation', mandatory_field=True)
+        if is_fsd:
+            contact_email = dconverter.CONTACT_EMAIL_FSD
+        else:
+            contact_email = self._read_attr(
+                STDY_CONTACT, 'stdyDscr.citation.distStmt.contact', 'email',
+                mandatory_field=True)
+
+        # Modified date
+        version = self.get_attr_optional(stdy_citation, 'prodDate', 'date') or \
+                  self.get_attr_mandatory(stdy_citation, 'version', 'date')
+
+        # Name
+        name_prefix = self._read_attr(STDY_IDNO,
+                                      'stdyDscr.citation.titlStmt.IDNo',
+                                      'agency')
+        name_id = self._read_text(STDY_IDNO, 'stdyDscr.citation.titlStmt.IDNo')
+        if not name_prefix:
+            doc_idno = self._read(DOC_IDNO, 'docDscr.citation.titlStmt.IDNo',
+                                  mandatory_field=True)
+            name_prefix = doc_idno.attrib['agency'] \
+                if doc_idno is not None else u''
+        if not name_id:
+            name_id = self._read_text(DOC_IDNO,
+                                      'docDscr.citation.titlStmt.IDNo',
+                                      mandatory_field=True)
+        name = utils.datapid_to_name(name_prefix + name_id)
+
+        pids = list()
+        pids.append({'id': name, 'type': 'data', 'primary': 'True', 'provider': name_prefix})
+
+        # Original web page as resource
+        orig_web_page = self._read_attr(DOC_HOLDINGS,
+                                        'docDscr.citation.holdings', 'URI',
+                                        default='')
+        if orig_web_page:
+            orig_web_page_resource = {'description': first_title,
+                                      'format': u'html',
+                                      'resource_type': 'documentation',
+                                      'url': orig_web_page}
+        else:
+            orig_web_page_resource = {}
+
+        # Owner
+        owner = self._read_text(STDY_PRODUCER,
+                                'stdyDscr.citation.prodStmt.producer') or \
+            self._read_text(STDY_RSP_AUTHENTY,
+                            'stdyDscr.citation.rspStmt.AuthEnty')
+        if not owner:
+            producer = self._read(DOC_PRODUCER,
+                                  'docDscr.citation.prodStmt.producer',
+                                  mandatory_field=True)
+            owner = _string(producer) if producer is not None else u''
+        agent.append({'role': 'owner',
+                      'name': owner})
+
+        # Owner organisation
+        owner_org = self._get_owner_org(harvest_object)
+
+        # Distributor (Agent: distributor, the same is used as contact)
+        agent.append({
+            'role': 'distributor',
+            'name': contact_name})
+
+        ####################################################################
+        #      Read optional metadata fields:                              #
+        ####################################################################
+        # Availability
+        if is_fsd:
+            access_request_url = dconverter.ACCESS_REQUEST_URL_FSD
+        else:
+            access_request_url = u''
+
+        # Contact
+        contact_phone = self._read_attr(DOC_HOLDINGS,
+                                        'docDscr.citation.holdings',
+                                        'callno') or \
+            self._read_attr(STDY_HOLDINGS, 'stdyDscr.citation.holdings',
+                            'callno')
+
+        contact_URL = self._read_attr(STDY_ACCSPLAC,
+                                      'stdyDscr.dataAccs.setAvail.accsPlac',
+                                      'URI') or \
+            self._read_attr(STDY_CONTACT, 'stdyDscr.citation.distStmt.contact',
+                            'URI') or \
+            self._read_attr(STDY_DISTRBTR,
+                            'stdyDscr.citation.distStmt.distrbtr', 'URI') or \
+            dconverter.CONTACT_URL_FSD if is_fsd else None
+
+        # Descriptions as JSON string of type {"fin":"aineiston kuvaus", ...}
+        descriptions = self._read_all(STDY_ABSTRACT, 'stdyDscr.stdyInfo.abstract',
+                                      'p')
+        if not descriptions:
+            descriptions = self._read_all(STDY_SERINFO,
+                                          'stdyDscr.citation.serStmt.serInfo',
+                                          'p')
+        translated_notes = {}
+
+        for des in descriptions:
+            lang = self.convert_language(des.get(XML_LANG, 'fi'))
+            if lang in translated_notes:
+                translated_notes[lang] += '\r\n\r\n' + _text(des)
+            else:
+                translated_notes[lang] = _text(des)
+
+        notes = json.dumps(translated_notes)
+
+        # Discipline
+        discipline = self.get_discipline(_first(STDY_SUBJECT, self.ddi_xml))
+
+        # Dataset lifetime events
+        events = self._get_events(authors)
+
+        # Geographic coverage
+        geo_cover = self.get_geo_coverage(self.ddi_xml)
+
+        # Temporal coverage
+        temp_start, temp_end = self.get_temporal_coverage(self.ddi_xml)
+
+        # Citation
+        citation = self._read_text(STDY_BIBLCIT, 'stdyDscr.citation.biblCit')
+
+        ####################################################################
+        #      Flatten rest to 'XPath/path/to/element': 'value' pairs      #
+        ####################################################################
+        # The tree is flattened directly, without a serialization round trip
+        flattened_ddi = importcore.generic_xml_metadata_reader(
+            self.ddi_xml.find('.//{*}docDscr'))
+        xpath_dict = flattened_ddi.getMap()
+        flattened_ddi = importcore.generic_xml_metadata_reader(
+            self.ddi_xml.find('.//{*}stdyDscr'))
+        xpath_dict.update(flattened_ddi.getMap())
+
+        package_dict = dict(
+            access_application_URL=u'',
+            access_request_URL=unicode(access_request_url),
+            agent=agent,
+            algorithm=u'',   # To be implemented straight in 'resources'
+            availability=unicode(availability),
+            contact=[{'name': contact_name,
+                      'email': contact_email,
+                      'URL': contact_URL,
+                      'phone': contact_phone}],
+            direct_download_URL=u'',  # To be implemented straight in 'resources
+            discipline=discipline,
+            event=events,
+            geographic_coverage=geo_cover,
+            groups=[],
+            id=self._get_id_by_name(name) or self._new_pid(name),
+            langdis=u'True',
+            language=language,
+            license_URL=license_url,
+            license_id=license_id,
+            mimetype=u'',  # To be implemented straight in 'resources
+            name=name,
+            notes=notes or u'',
+            pids=pids,
+            owner_org=owner_org,
+            resources=[orig_web_page_resource],
+            tag_string=keywords,
+            temporal_coverage_begin=temp_start,
+            temporal_coverage_end=temp_end,
+            title=title,
+            type='dataset',
+            version=version,
+            version_PID='',
+            citation=citation
+        )
+        package_dict['xpaths'] = xpath_dict
+
+        if harvest_object is not None:
+            harvest_object.content = None
+
+        return package_dict
@@ -0,0 +1,136 @@
+# coding: utf-8
+'''
+Offline conversion of DDI2 documents to JSON Lines
+
+Converts a directory or tarball of DDI XML files to CKAN package dicts, one
+JSON object per line, without a CKAN site or database. The FSD id store and
+owner organizations are not used, and dataset ids are derived from the
+dataset names, so converting the same files twice gives the same output.
+'''
+
+import json
+import logging
+import multiprocessing
+import optparse
+import sys
+import time
+
+import lxml.etree as etree
+
+import convertpool
+import ddifiles
+
+log = logging.getLogger(__name__)
+
+# Offline converters of this process, created on first use
+_converters = {}
+
+
+def convert_file(args):
+    '''Convert one DDI document offline.
+
+    :param args: the parser name, the name, the url and the XML of the
+        document and whether mandatory fields are required
+    :type args: tuple
+    :returns: the name, the package dict or False and a list of error
+        messages
+    :rtype: tuple
+    '''
+    parser, name, url, xml, strict = args
+    if parser not in _converters:
+        _converters[parser] = convertpool.CONVERTERS[parser](offline=True)
+    converter = _converters[parser]
+    try:
+        ddi_xml = converter.parse(xml)
+    except etree.XMLSyntaxError as err:
+        return name, False, ['Unable to parse XML! {er}'.format(er=err.msg)]
+    package_dict, errors = converter.convert(ddi_xml, url, xml, strict=strict)
+    return name, package_dict, ['{er} (line {li})'.format(er=error.message,
+                                                         li=error.line)
+                                for error in errors]
+
+
+def convert_files(path, output, processes=None, parser='lxml', base_url='',
+                  strict=True):
+    '''Convert the DDI documents of directory or tarball 'path' and write the
+    package dicts to 'output' in document order.
+
+    :param output: file object for the JSON Lines
+    :param processes: number of conversion processes, defaults to the
+        number of CPUs
+    :type processes: int
+    :returns: the numbers of documents read and converted
+    :rtype: tuple
+    '''
+    processes = processes or multiprocessing.cpu_count()
+    documents = ((parser, name, base_url + name, xml, strict)
+                 for name, xml in ddifiles.read_documents(path))
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        converted = pool.imap(convert_file, documents, chunksize=10)
+    else:
+        converted = (convert_file(document) for document in documents)
+    read = written = 0
+    try:
+        for name, package_dict, errors in converted:
+            read += 1
+            for error in errors:
+                log.warning('{na}: {er}'.format(na=name, er=error))
+            if package_dict:
+                output.write(json.dumps(package_dict, sort_keys=True) + '\n')
+                written += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return read, written
+
+
+def main(argv=None):
+    '''Entry point of the ddi2jsonl script.
+    '''
+    option_parser = optparse.OptionParser(
+        usage='%prog [options] <directory or tarball>',
+        description='Convert DDI2 documents to CKAN package dicts as JSON '
+                    'Lines without a CKAN site.')
+    option_parser.add_option(
+        '-o', '--output', dest='output', default=None,
+        help='Output file, defaults to standard output')
+    option_parser.add_option(
+        '-p', '--processes', dest='processes', type='int', default=None,
+        help='Number of conversion processes, defaults to the number of CPUs')
+    option_parser.add_option(
+        '--parser', dest='parser', default='lxml',
+        choices=sorted(convertpool.CONVERTERS),
+        help="Conversion engine, 'lxml' (default) or 'bs4'")
+    option_parser.add_option(
+        '-u', '--base-url', dest='base_url', default='',
+        help='Prefix of the file names giving the original urls of the '
+             'documents')
+    option_parser.add_option(
+        '--lenient', dest='strict', action='store_false', default=True,
+        help='Convert documents missing mandatory fields')
+    options, args = option_parser.parse_args(argv)
+    if len(args) != 1:
+        option_parser.error('Give one directory or tarball')
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    output = open(options.output, 'wb') if options.output else sys.stdout
+    started = time.time()
+    try:
+        read, written = convert_files(args[0], output, options.processes,
+                                      options.parser, options.base_url,
+                                      options.strict)
+    finally:
+        if options.output:
+            output.close()
+    elapsed = time.time() - started
+    sys.stderr.write('{re} documents, {wr} converted, {ra:.1f} documents/s\n'
+                     .format(re=read, wr=written,
+                             ra=read / elapsed if elapsed else 0.0))
+    return 0 if read == written else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+# coding: utf-8
+'''
+Cache of the owner organizations of harvest sources
+'''
+
+import logging
+import time
+
+import ckan.model as model
+
+log = logging.getLogger(__name__)
+
+# Seconds an owner organization is used before it is read again
+TTL = 300
+
+
+class OwnerOrgCache(object):
+    '''Names of the organizations owning harvest sources, each read from the
+    database once per harvest job and at most once per 'ttl' seconds.
+
+    The harvest sources are updated in the web process, which cannot reach
+    the caches of the gather and fetch workers. An owner organization
+    changed meanwhile is therefore seen by the next harvest job of the
+    source, or within 'ttl' seconds in a running job.
+
+    :param ttl: seconds an entry is valid
+    :type ttl: int
+    '''
+
+    def __init__(self, ttl=TTL):
+        self.ttl = ttl
+        # harvest source id -> (organization name, job id, expiry time)
+        self.entries = {}
+
+    def get(self, source_id, job_id=None):
+        '''Return the name of the organization owning harvest source
+        'source_id' for harvest job 'job_id'.
+
+        :raises sqlalchemy.orm.exc.NoResultFound: if there is no such source
+            or organization
+        '''
+        now = time.time()
+        entry = self.entries.get(source_id)
+        if entry is not None and entry[1] == job_id and entry[2] > now:
+            return entry[0]
+        name = model.Session.query(model.Group.name) \
+            .join(model.Package, model.Package.owner_org == model.Group.id) \
+            .filter(model.Package.id == source_id) \
+            .one()[0]
+        self.entries[source_id] = (name, job_id, now + self.ttl)
+        log.debug('Owner organization of harvest source {so}: {na}'.format(
+            so=source_id, na=name))
+        return name
+
+
+# Shared by the converters and the harvester of a process
+cache = OwnerOrgCache()
+
+
+def get_owner_org(harvest_object):
+    '''Return the name of the organization owning the harvest source of
+    'harvest_object'.
+    '''
+    return cache.get(harvest_object.harvest_source_id,
+                     harvest_object.harvest_job_id)
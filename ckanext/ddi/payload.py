@@ -0,0 +1,92 @@
+# coding: utf-8
+'''
+Encoding of the fetched documents stored in HarvestObject.content
+
+The payload is a text envelope: a version line, the metadata of the
+document as JSON on the second line and the zlib compressed document in
+base64 on the third. HarvestObject.content is a text column, so the
+compressed bytes can not be stored as such.
+
+Payloads of older versions of the harvester were pickled dicts. They are
+still decoded.
+'''
+
+import base64
+import json
+import pickle
+import StringIO
+import zlib
+
+VERSION_LINE = 'ddi-payload/1'
+COMPRESS_LEVEL = 6
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    '''Unpickler of the legacy payloads, dicts of strings, refusing every
+    class and function so that no code is run from the database.
+    '''
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError('Not allowed in a payload: {m}.{n}'
+                                     .format(m=module, n=name))
+
+
+def _decode_legacy(content):
+    try:
+        info = _LegacyUnpickler(StringIO.StringIO(content)).load()
+    except Exception as e:
+        raise ValueError('Not a payload: {er!r}'.format(er=e))
+    if not isinstance(info, dict) or 'xml' not in info or \
+            not all(isinstance(value, (basestring, type(None)))
+                    for value in info.itervalues()):
+        raise ValueError('Not a payload: {ty}'.format(ty=type(info)))
+    return info
+
+
+def encode(info):
+    '''Encode the fetched document and its metadata.
+
+    :param info: the 'xml' of the document and other values like 'url',
+        all strings or None
+    :type info: dict
+    :rtype: string
+    '''
+    meta = dict(info)
+    xml = meta.pop('xml')
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+        meta['unicode'] = True
+    return '\n'.join([VERSION_LINE, json.dumps(meta),
+                      base64.b64encode(zlib.compress(xml, COMPRESS_LEVEL))])
+
+
+def decode(content):
+    '''Decode a payload made by encode() or an older pickled one.
+
+    :param content: the content of a harvest object
+    :type content: string
+    :returns: the info dict given to encode()
+    :rtype: dict
+    :raises ValueError: if the payload is of an unknown version, damaged or
+        not a payload at all
+    '''
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    if not content.startswith('ddi-payload/'):
+        # Pickled by versions before the envelope
+        return _decode_legacy(content)
+    try:
+        version, meta, data = content.split('\n', 2)
+    except ValueError:
+        raise ValueError('Truncated payload')
+    if version != VERSION_LINE:
+        raise ValueError('Unknown payload version: {v}'.format(v=version))
+    try:
+        xml = zlib.decompress(base64.b64decode(data))
+    except (TypeError, zlib.error) as e:
+        raise ValueError('Damaged payload: {er}'.format(er=e))
+    info = json.loads(meta)
+    if info.pop('unicode', False):
+        xml = xml.decode('utf-8')
+    info['xml'] = xml
+    return info
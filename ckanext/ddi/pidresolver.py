@@ -0,0 +1,152 @@
+# coding: utf-8
+'''
+Resolution of data PIDs to existing datasets for a harvest job
+'''
+
+import logging
+
+import ckan.model as model
+import ckanext.harvest.model as hmodel
+
+log = logging.getLogger(__name__)
+
+PID_PREFIX = u'pids_'
+
+
+def data_pids(package_dict):
+    '''Return the ids of the data PIDs of 'package_dict'.
+    '''
+    return [pid.get('id') for pid in package_dict.get('pids', [])
+            if pid.get('type') == 'data' and pid.get('id')]
+
+
+def _pid_rows(extras):
+    '''Group the PID extras of datasets ('pids_<index>_<field>' keys) to one
+    dict per PID and yield (package id, PID dict) tuples.
+    '''
+    pids = {}
+    for package_id, key, value in extras:
+        index, _, field = key[len(PID_PREFIX):].rpartition('_')
+        if index:
+            pids.setdefault((package_id, index), {})[field] = value
+    for (package_id, _), pid in pids.iteritems():
+        yield package_id, pid
+
+
+class PidResolver(object):
+    '''Map from the data PIDs to the ids of the datasets having them, kept
+    for one harvest job.
+
+    A data PID resolves to a dataset like with
+    ckanext.kata.utils.get_package_id_by_data_pids(): the PIDs may be held
+    by only one dataset, in any extra and whatever the state of the dataset,
+    and that dataset must have one of them as a data PID.
+
+    prefetch() reads the PIDs of the datasets of the harvest source and the
+    other datasets holding them with two queries. Other PIDs are looked up
+    from the database when they are first seen. The PIDs of the datasets of
+    the source are only looked for in their 'pids_' extras.
+
+    :param job_id: id of the harvest job
+    :type job_id: string
+    '''
+
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        # PID -> ids of all the datasets holding it
+        self.holders = {}
+        # (dataset id, PID) of the data PIDs
+        self.data = set()
+
+    def _add_pids(self, extras, holders=True):
+        '''Record the PIDs of the PID extras 'extras', as held by their
+        datasets too if 'holders' is True.
+        '''
+        for package_id, pid in _pid_rows(extras):
+            if not pid.get('id'):
+                continue
+            if holders:
+                self.holders.setdefault(pid['id'], set()).add(package_id)
+            if pid.get('type') == u'data':
+                self.data.add((package_id, pid['id']))
+
+    def prefetch(self, source_id):
+        '''Read the PIDs of the current datasets of harvest source
+        'source_id' and the other datasets holding any of them.
+        '''
+        source_packages = model.Session.query(
+            hmodel.HarvestObject.package_id) \
+            .filter(hmodel.HarvestObject.harvest_source_id == source_id) \
+            .filter(hmodel.HarvestObject.current == True) \
+            .subquery()
+        self._add_pids(
+            model.Session.query(model.PackageExtra.package_id,
+                                model.PackageExtra.key,
+                                model.PackageExtra.value)
+            .filter(model.PackageExtra.package_id.in_(source_packages))
+            .filter(model.PackageExtra.key.like(PID_PREFIX + u'%')))
+        pid_ids = model.Session.query(model.PackageExtra.value) \
+            .filter(model.PackageExtra.package_id.in_(source_packages)) \
+            .filter(model.PackageExtra.key.like(PID_PREFIX + u'%_id')) \
+            .subquery()
+        others = model.Session.query(model.PackageExtra.value,
+                                     model.PackageExtra.package_id) \
+            .filter(model.PackageExtra.value.in_(pid_ids)) \
+            .filter(~model.PackageExtra.package_id.in_(source_packages)) \
+            .distinct()
+        for pid, package_id in others:
+            self.holders.setdefault(pid, set()).add(package_id)
+        log.debug('Prefetched {n} PIDs of harvest source {so}'.format(
+            n=len(self.holders), so=source_id))
+
+    def _look_up(self, pids):
+        '''Read the datasets holding 'pids' and their data PIDs.
+        '''
+        for pid in pids:
+            self.holders.setdefault(pid, set())
+        package_ids = set()
+        for pid, package_id in model.Session.query(
+                model.PackageExtra.value, model.PackageExtra.package_id) \
+                .filter(model.PackageExtra.value.in_(pids)).distinct():
+            self.holders[pid].add(package_id)
+            package_ids.add(package_id)
+        if package_ids:
+            # Only the holders of 'pids' are known completely
+            self._add_pids(
+                model.Session.query(model.PackageExtra.package_id,
+                                    model.PackageExtra.key,
+                                    model.PackageExtra.value)
+                .filter(model.PackageExtra.package_id.in_(package_ids))
+                .filter(model.PackageExtra.key.like(PID_PREFIX + u'%')),
+                holders=False)
+
+    def resolve(self, package_dict):
+        '''Return the id of the dataset with the data PIDs of 'package_dict'
+        or None if there is none or several.
+        '''
+        pids = data_pids(package_dict)
+        if not pids:
+            return None
+        unknown = [pid for pid in pids if pid not in self.holders]
+        if unknown:
+            self._look_up(unknown)
+        package_ids = set()
+        for pid in pids:
+            package_ids.update(self.holders[pid])
+        if len(package_ids) != 1:
+            return None
+        package_id = package_ids.pop()
+        if any((package_id, pid) in self.data for pid in pids):
+            return package_id
+        return None
+
+    def add(self, package_dict):
+        '''Record the PIDs of the dataset 'package_dict' after it has been
+        created or updated.
+        '''
+        for pid in package_dict.get('pids', []):
+            # The other holders of an unknown PID are looked up when needed
+            if pid.get('id') in self.holders:
+                self.holders[pid['id']].add(package_dict['id'])
+                if pid.get('type') == u'data':
+                    self.data.add((package_dict['id'], pid['id']))
@@ -0,0 +1,516 @@
+# coding: utf-8
+'''
+Benchmarks for the DDI harvester.
+
+Run a benchmark with::
+
+    python -m ckanext.ddi.tests.benchmarks <name> [args]
+'''
+# pylint: disable=C0111
+
+import datetime
+import glob
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import sqlalchemy as sa
+
+
+def _harvest_object_table(metadata):
+    '''A stand-in for the harvest_object table of ckanext-harvest.
+    '''
+    return sa.Table(
+        'harvest_object', metadata,
+        sa.Column('id', sa.UnicodeText, primary_key=True),
+        sa.Column('guid', sa.UnicodeText, default=u''),
+        sa.Column('current', sa.Boolean, default=False),
+        sa.Column('gathered', sa.DateTime, default=datetime.datetime.utcnow),
+        sa.Column('content', sa.UnicodeText, nullable=True),
+        sa.Column('state', sa.UnicodeText, default=u'WAITING'),
+        sa.Column('harvest_job_id', sa.UnicodeText),
+        sa.Column('harvest_source_id', sa.UnicodeText),
+    )
+
+
+def bench_gather_insert(rows=5000, db_url=None):
+    '''Compare one commit per harvest object with BulkInserter batches.
+
+    Uses a SQLite file unless a SQLAlchemy url (eg. of a local Postgres) is
+    given.
+    '''
+    from sqlalchemy.orm import sessionmaker
+    from ckanext.ddi.bulk import BulkInserter
+
+    rows = int(rows)
+    path = None
+    if not db_url:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        db_url = 'sqlite:///' + path
+    engine = sa.create_engine(db_url)
+    metadata = sa.MetaData()
+    table = _harvest_object_table(metadata)
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    urls = [u'http://www.fsd.uta.fi/fi/aineistot/luettelo/FSD%04d/FSD%04d.xml'
+            % (i, i) for i in range(rows)]
+    try:
+        start = time.time()
+        for url in urls:
+            # Same as HarvestObject.save(): one INSERT and one commit
+            session.execute(table.insert(), {'id': unicode(uuid.uuid4()),
+                                             'content': url,
+                                             'harvest_job_id': u'job'})
+            session.commit()
+        single = time.time() - start
+        print('single   : {r:>9.0f} rows/s'.format(r=rows / single))
+        session.execute(table.delete())
+        session.commit()
+
+        for batch_size in (100, 500, 2000):
+            inserter = BulkInserter(session, table, batch_size,
+                                    harvest_job_id=u'job')
+            start = time.time()
+            for url in urls:
+                inserter.add(content=url)
+            inserter.flush()
+            batched = time.time() - start
+            assert session.query(table).count() == rows
+            session.execute(table.delete())
+            session.commit()
+            print('batch {b:>5}: {r:>9.0f} rows/s'.format(
+                b=batch_size, r=rows / batched))
+    finally:
+        session.close()
+        if path:
+            os.remove(path)
+
+
+def _fixtures():
+    '''Return (name, xml) pairs of the DDI test documents.
+    '''
+    from ckanext.ddi.tests import testdata
+    docs = [('nr1', testdata.nr1), ('nr2', testdata.nr2)]
+    pattern = os.path.join(os.path.dirname(__file__), '..', 'test_fixtures',
+                           'FSD*.xml')
+    for path in sorted(glob.glob(pattern)):
+        with open(path) as xml_file:
+            docs.append((os.path.basename(path), xml_file.read()))
+    return docs
+
+
+def bench_converter(rounds=5):
+    '''Compare the BeautifulSoup and lxml engines of DataConverter on the
+    test documents, parsing included.
+    '''
+    import ckanext.ddi.dataconverter as dconverter
+    import ckanext.ddi.lxmlconverter as lxmlconverter
+
+    rounds = int(rounds)
+    docs = _fixtures()
+    results = {}
+    for name, converter in (('bs4', dconverter.DataConverter()),
+                            ('lxml', lxmlconverter.LxmlDataConverter())):
+        start = time.time()
+        for _ in range(rounds):
+            for _, xml in docs:
+                converter.ddi2ckan(converter.parse(xml), None, xml)
+                converter.empty_errors()
+        results[name] = (time.time() - start) / (rounds * len(docs))
+        print('{n:<5}: {t:8.2f} ms/document'.format(
+            n=name, t=results[name] * 1000))
+    print('speedup: {s:.1f}x'.format(s=results['bs4'] / results['lxml']))
+
+
+# Only the mandatory fields, every optional field is missing
+SPARSE_DDI = '''<?xml version="1.0" encoding="UTF-8"?>
+<codeBook xmlns="ddi:codebook:2_5" xml:lang="fi">
+<docDscr><citation>
+<titlStmt><titl>Title</titl><IDNo agency="FSD">9999</IDNo></titlStmt>
+<prodStmt><producer>Producer</producer></prodStmt>
+</citation></docDscr>
+<stdyDscr>
+<citation>
+<titlStmt><titl>Title</titl><IDNo agency="FSD">9999</IDNo></titlStmt>
+<rspStmt><AuthEnty>Author</AuthEnty></rspStmt>
+<prodStmt><producer>Producer</producer></prodStmt>
+<distStmt><contact email="contact@example.com">Contact</contact></distStmt>
+<verStmt><version date="2015-01-01"/></verStmt>
+</citation>
+<stdyInfo><subject><geogCover/></subject></stdyInfo>
+</stdyDscr>
+</codeBook>'''
+
+
+def bench_missing_fields(rounds=20):
+    '''Time converting a document with missing optional fields and the cost
+    of one error caught by ExceptReturn.
+    '''
+    import ckanext.ddi.dataconverter as dconverter
+    import ckanext.ddi.lxmlconverter as lxmlconverter
+    from ckanext.ddi.tests import testdata
+
+    rounds = int(rounds)
+    for name, converter in (('bs4', dconverter.DataConverter()),
+                            ('lxml', lxmlconverter.LxmlDataConverter())):
+        for doc_name, xml in (('sparse', SPARSE_DDI), ('nr1', testdata.nr1)):
+            # Conversion removes elements from the tree
+            trees = [converter.parse(xml) for _ in range(rounds)]
+            start = time.time()
+            for ddi_xml in trees:
+                converter.ddi2ckan(ddi_xml, None, xml)
+                converter.empty_errors()
+            print('{n:<5} {d:<7}: {t:8.3f} ms/document'.format(
+                n=name, d=doc_name, t=(time.time() - start) / rounds * 1000))
+
+    class Reader(object):
+        errors = []
+
+        @dconverter.ExceptReturn(AttributeError)
+        def optional(self, el):
+            return el.missing
+
+        @dconverter.ExceptReturn(AttributeError, mandatory_field=True)
+        def mandatory(self, el):
+            return el.missing
+
+    reader = Reader()
+    calls = rounds * 100
+    for name, method in (('optional', reader.optional),
+                         ('mandatory', reader.mandatory)):
+        start = time.time()
+        for _ in range(calls):
+            method(None)
+        print('{n:<9} error: {t:8.2f} us/error'.format(
+            n=name, t=(time.time() - start) / calls * 1e6))
+        del Reader.errors[:]
+
+
+def bench_read_value(rounds=200):
+    '''Compare reading the _ddi2ckan() paths of testdata.nr1 with eval()
+    and with the compiled accessors of DataConverter._read_value().
+    '''
+    import re
+    import ckanext.ddi.dataconverter as dconverter
+    from ckanext.ddi.tests import testdata
+
+    rounds = int(rounds)
+    # The paths read by _ddi2ckan() and _get_events()
+    source = open(dconverter.__file__.replace('.pyc', '.py')).read()
+    prefixes = {'stdy_dscr': 'ddi_xml.codeBook.stdyDscr',
+                'doc_citation': 'ddi_xml.codeBook.docDscr.citation'}
+    paths = []
+    for prefix, path in re.findall(
+            r'_read_value\(\s*(?:(stdy_dscr|doc_citation) \+ )?"([^"]+)"',
+            source):
+        paths.append(prefixes.get(prefix, '') + path)
+
+    class Anything(object):
+        '''Resolves every path instantly, to time the path handling only.
+        '''
+        def __getattr__(self, name):
+            return self
+
+        def __call__(self, *args, **kwargs):
+            return self
+
+        def __getitem__(self, key):
+            return self
+
+    converter = dconverter.DataConverter()
+    print('{n} paths'.format(n=len(paths)))
+    for tree in ('testdata.nr1', 'no tree'):
+        converter.ddi_xml = converter.parse(testdata.nr1) \
+            if tree == 'testdata.nr1' else Anything()
+
+        def read_eval(path):
+            try:
+                return eval('self.' + path, {'self': converter})
+            except (AttributeError, TypeError, KeyError):
+                return u''
+
+        def read_compiled(path):
+            try:
+                return converter._read_value(path)
+            except KeyError:
+                return u''
+
+        results = {}
+        for name, read in (('eval', read_eval), ('compiled', read_compiled)):
+            start = time.time()
+            for _ in range(rounds):
+                for path in paths:
+                    read(path)
+            results[name] = (time.time() - start) / (rounds * len(paths))
+            print('{tr:<12} {n:<8}: {t:8.2f} us/path'.format(
+                tr=tree, n=name, t=results[name] * 1e6))
+        print('{tr:<12} speedup : {s:8.1f}x'.format(
+            tr=tree, s=results['eval'] / results['compiled']))
+
+
+def _synthetic_codebooks(count):
+    '''Return 'count' codebooks made from testdata.nr1 with distinct ids.
+    '''
+    from ckanext.ddi.tests import testdata
+    return [testdata.nr1.replace('1008</IDNo>', '{i}</IDNo>'.format(i=100000 + i))
+            for i in range(count)]
+
+
+def bench_import_batch(docs=1000, max_processes=None, parser='lxml'):
+    '''Convert synthetic codebooks with ConversionPool using 1, 2, 4, ...
+    processes up to 'max_processes', by default the number of CPUs.
+    '''
+    import multiprocessing
+    from ckanext.ddi.convertpool import ConversionPool
+
+    documents = [(parser, u'http://example.com/{i}.xml'.format(i=i), xml, True)
+                 for i, xml in enumerate(_synthetic_codebooks(int(docs)))]
+    max_processes = int(max_processes or multiprocessing.cpu_count())
+    processes = 1
+    while True:
+        pool = ConversionPool(processes)
+        try:
+            # Start the workers before timing
+            list(pool.imap(documents[:processes]))
+            start = time.time()
+            converted = sum(1 for package_dict, _, _ in pool.imap(documents)
+                            if package_dict)
+            elapsed = time.time() - start
+        finally:
+            pool.close()
+        assert converted == len(documents)
+        print('{p:>3} processes: {r:8.1f} documents/s'.format(
+            p=processes, r=len(documents) / elapsed))
+        if processes >= max_processes:
+            break
+        processes = min(processes * 2, max_processes)
+    print('{c} CPUs'.format(c=multiprocessing.cpu_count()))
+
+
+def _run_pipeline(mode, rounds):
+    '''Parse the test documents to the trees used for extraction and
+    flattening, the way 'mode' does it, and print the time per document and
+    the growth of the peak memory use of this process.
+    '''
+    import resource
+    from bs4 import BeautifulSoup
+    import lxml.etree as etree
+    import ckanext.ddi.dataconverter as dconverter
+    import ckanext.ddi.lxmlconverter as lxmlconverter
+
+    def roundtrip(xml):
+        soup = BeautifulSoup(xml, 'xml')
+        return soup, etree.fromstring(str(soup))
+
+    def bs4(xml):
+        soup = BeautifulSoup(xml, 'xml')
+        return (soup, dconverter._soup_to_etree(soup.find('docDscr')),
+                dconverter._soup_to_etree(soup.find('stdyDscr')))
+
+    parse = {'roundtrip': roundtrip,
+             'bs4': bs4,
+             'lxml': lxmlconverter.LxmlDataConverter().parse}[mode]
+    docs = _fixtures()
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    for _ in range(rounds):
+        for _, xml in docs:
+            parse(xml)
+    elapsed = (time.time() - start) / (rounds * len(docs))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss
+    print('{m:<9}: {t:8.2f} ms/document, peak memory +{p:6.1f} MB'.format(
+        m=mode, t=elapsed * 1000, p=peak / 1024.0))
+
+
+def bench_import_pipeline(rounds=3):
+    '''Compare parsing a document for import_stage the old way (BeautifulSoup,
+    str() and etree.fromstring()) with the single parse of each engine.
+
+    Each mode runs in its own process so that the peak memory use can be
+    compared.
+    '''
+    import subprocess
+    for mode in ('roundtrip', 'bs4', 'lxml'):
+        sys.stdout.write(subprocess.check_output([
+            sys.executable, '-c',
+            'from ckanext.ddi.tests.benchmarks import _run_pipeline; '
+            '_run_pipeline({m!r}, {r:d})'.format(m=mode, r=int(rounds))]))
+
+
+def _run_prune(parser, prune, rounds):
+    '''Parse and convert the test documents with or without pruning and
+    print the time per document and the growth of the peak memory use.
+    '''
+    import resource
+    from ckanext.ddi.convertpool import CONVERTERS
+
+    converter = CONVERTERS[parser](offline=True)
+    docs = _fixtures()
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    for _ in range(rounds):
+        for _, xml in docs:
+            converter.convert(converter.parse(xml, prune), None, xml)
+    elapsed = (time.time() - start) / (rounds * len(docs))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss
+    print('{p:<5} {m:<8}: {t:8.2f} ms/document, peak memory +{mb:6.1f} MB'
+          .format(p=parser, m='pruned' if prune else 'full', t=elapsed * 1000,
+                  mb=peak / 1024.0))
+
+
+def bench_prune(rounds=3, parsers='lxml,bs4'):
+    '''Compare converting the test documents with and without dropping the
+    dataDscr, fileDscr and otherMat sections while parsing.
+
+    Each case runs in its own process so that the peak memory use can be
+    compared.
+    '''
+    import subprocess
+    for parser in parsers.split(','):
+        for prune in (False, True):
+            sys.stdout.write(subprocess.check_output([
+                sys.executable, '-c',
+                'from ckanext.ddi.tests.benchmarks import _run_prune; '
+                '_run_prune({p!r}, {pr!r}, {r:d})'.format(
+                    p=parser, pr=prune, r=int(rounds))]))
+
+
+def _large_codebook(variables):
+    '''Return a codebook with 'variables' variables of 5 categories each.
+    '''
+    var = ('<var ID="V{i}" name="V{i}"><labl level="variable">Variable {i}'
+           '</labl><qstn><qstnLit>Question {i}</qstnLit></qstn>'
+           '<sumStat type="vald">1000</sumStat>'
+           '<sumStat type="mean">{i}.5</sumStat>' +
+           ''.join('<catgry><catValu>{c}</catValu><labl>Category {c}</labl>'
+                    '<catStat>200</catStat></catgry>'.format(c=c)
+                    for c in range(5)) +
+           '</var>\n')
+    return ('<codeBook><stdyDscr/><dataDscr>\n' +
+            ''.join(var.format(i=i) for i in range(variables)) +
+            '</dataDscr></codeBook>')
+
+
+def _run_var_export(mode, variables):
+    import resource
+    import lxml.etree as etree
+    from ckanext.ddi import varexport
+
+    xml = _large_codebook(variables)
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    if mode == 'tree':
+        etree.fromstring(xml)
+    else:
+        var_file = tempfile.SpooledTemporaryFile(1024 * 1024)
+        code_file = tempfile.SpooledTemporaryFile(1024 * 1024)
+        varexport.write_variables(xml, var_file, code_file)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss
+    print('{m:<6}: {t:8.2f} s, peak memory +{p:6.1f} MB'.format(
+        m=mode, t=elapsed, p=peak / 1024.0))
+
+
+def bench_var_export(variables=50000):
+    '''Export the variables of a large synthetic codebook with varexport and
+    compare the peak memory with only parsing it to a whole tree.
+    '''
+    import subprocess
+    print('{n} variables, {mb:.1f} MB'.format(
+        n=int(variables), mb=len(_large_codebook(int(variables))) / 1e6))
+    for mode in ('tree', 'export'):
+        sys.stdout.write(subprocess.check_output([
+            sys.executable, '-c',
+            'from ckanext.ddi.tests.benchmarks import _run_var_export; '
+            '_run_var_export({m!r}, {v:d})'.format(m=mode, v=int(variables))]))
+
+
+def bench_var_stats(variables=50000, rounds=5):
+    '''Compute the mean of the variable means and the total category
+    frequency of a large synthetic codebook from the CSV export and from the
+    .npz statistics.
+    '''
+    import csv
+    import io
+    import numpy
+    from ckanext.ddi import varexport, varstats
+
+    var_file = io.BytesIO()
+    code_file = io.BytesIO()
+    stats_file = io.BytesIO()
+    stats = varstats.VariableStats()
+    varexport.write_variables(_large_codebook(int(variables)), var_file,
+                              code_file, stats)
+    stats.save(stats_file)
+    print('{n} variables: CSV {c:.1f} MB, npz {z:.2f} MB'.format(
+        n=int(variables),
+        c=(len(var_file.getvalue()) + len(code_file.getvalue())) / 1e6,
+        z=len(stats_file.getvalue()) / 1e6))
+
+    def from_csv():
+        var_file.seek(0)
+        code_file.seek(0)
+        means = [float(row['sumStat_mean'])
+                 for row in csv.DictReader(var_file) if row['sumStat_mean']]
+        freq = sum(float(row['catStat'])
+                   for row in csv.DictReader(code_file) if row['catStat'])
+        return sum(means) / len(means), freq
+
+    def from_npz():
+        stats_file.seek(0)
+        columns = varstats.load(stats_file)
+        return (numpy.nanmean(columns['mean']),
+                numpy.nansum(columns['cat_freq']))
+
+    for name, query in (('csv', from_csv), ('npz', from_npz)):
+        start = time.time()
+        for _ in range(int(rounds)):
+            result = query()
+        print('{n}: {t:8.2f} ms/query {r}'.format(
+            n=name, t=(time.time() - start) / int(rounds) * 1000, r=result))
+
+
+def bench_package_schema(rounds=20):
+    '''Profile the conversion and the schema construction of import_stage for
+    the test documents, with the schema built for every document and with
+    the memoized DDIHarvester._get_package_schema(), and print the share of
+    the time spent building schemas. Needs ckanext-kata.
+    '''
+    import cProfile
+    import pstats
+    from ckanext.kata.plugin import KataPlugin
+    from ckanext.ddi.convertpool import CONVERTERS
+    from ckanext.ddi.harvester import DDIHarvester
+
+    converter = CONVERTERS['lxml'](offline=True)
+    docs = _fixtures()
+    for mode, get_schema in (
+            ('per document', KataPlugin.create_package_schema_ddi),
+            ('memoized', DDIHarvester()._get_package_schema)):
+        def run():
+            for _ in range(int(rounds)):
+                for _, xml in docs:
+                    converter.convert(converter.parse(xml), None, xml)
+                    get_schema()
+        profile = cProfile.Profile()
+        profile.runcall(run)
+        stats = pstats.Stats(profile)
+        schema_time = sum(
+            cumulative for (_, _, function), (_, _, _, cumulative, _)
+            in stats.stats.iteritems()
+            if function == 'create_package_schema_ddi')
+        print('{m:<12}: {t:8.2f} ms/document, schema {s:5.1f} %'.format(
+            m=mode, t=stats.total_tt * 1000 / (int(rounds) * len(docs)),
+            s=100.0 * schema_time / stats.total_tt))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Benchmarks: ' + ', '.join(
+            sorted(n[6:] for n in dir() if n.startswith('bench_'))))
+        sys.exit(1)
+    globals()['bench_' + sys.argv[1]](*sys.argv[2:])
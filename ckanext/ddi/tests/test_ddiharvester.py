@@ -11,12 +11,25 @@ Tests for DDI harvester
 # import uuid
 # import pprint
 # from datetime import datetime, timedelta
+import gzip
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import pickle
+import re
+import shutil
+import StringIO
+import tarfile
+import tempfile
 import unittest
+import warnings
 
-# from nose.exc import SkipTest
-# from lxml import etree
+from nose.exc import SkipTest
 # from sqlalchemy.ext.associationproxy import _AssociationDict
 import bs4
+from lxml import etree
+import mock
+from sqlalchemy.orm.exc import NoResultFound
 
 # from ckan.model import Session, Package, User
 # from ckan.lib.helpers import url_for
@@ -26,11 +39,26 @@ import bs4
 # from ckanext.harvest.model import HarvestJob, HarvestSource, HarvestObject, \
 #                                   HarvestObjectError, HarvestGatherError, setup
 import ckan.model
+from ckan.logic import ValidationError
 import ckanext.harvest.model as harvest_model
 from ckanext.kata import model as kata_model
 # from ckanext.ddi.harvester import DDIHarvester
+import ckanext.ddi.bulk as bulk
+import ckanext.ddi.commands as commands
 import ckanext.ddi.harvester as dharvester
+import ckanext.ddi.convertpool as convertpool
 import ckanext.ddi.dataconverter as dconverter
+import ckanext.ddi.ddifiles as ddifiles
+import ckanext.ddi.fsdids as fsdids
+import ckanext.ddi.httpcache as httpcache
+import ckanext.ddi.lxmlconverter as lxmlconverter
+import ckanext.ddi.offline as offline
+import ckanext.ddi.ownerorgs as ownerorgs
+import ckanext.ddi.payload as payload
+import ckanext.ddi.pidresolver as pidresolver
+import ckanext.ddi.urllist as urllist
+import ckanext.ddi.varexport as varexport
+import ckanext.ddi.varstats as varstats
 import testdata
 
 
@@ -38,6 +66,13 @@ import testdata
 # realopen = urllib2.urlopen
 
 
+class _Stub(object):
+    '''Stand-in for the harvest objects and jobs of ckanext-harvest.
+    '''
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
 class TestDataConverter(unittest.TestCase):
 
     @classmethod
@@ -73,6 +108,9 @@ class TestDataConverter(unittest.TestCase):
             self.ddi_xml.stdyDscr.stdyInfo.subject)
         assert discipline == u'politiikantutkimus'
 
+    def test_get_clean_date_missing(self):
+        self.assertEquals(self.ddi_converter.get_clean_date(None), u'')
+
     def test_get_keywords(self):
         keywords = self.ddi_converter.get_keywords(
             self.ddi_xml.stdyDscr.stdyInfo.subject)
@@ -85,12 +123,627 @@ class TestDataConverter(unittest.TestCase):
         self.assertEquals(self.ddi_converter.convert_language('fi'), 'fin')
         self.assertEquals(self.ddi_converter.convert_language('en'), 'eng')
 
+    def test_read_value(self):
+        self.ddi_converter.ddi_xml = self.ddi_xml
+        self.assertEquals(self.ddi_converter._read_value(
+            "ddi_xml.codeBook.stdyDscr.citation.titlStmt.IDNo['agency']"),
+            u'FSD')
+        self.assertEquals(self.ddi_converter._read_value(
+            "ddi_xml.codeBook.stdyDscr.citation.titlStmt(['titl'])")[0].text,
+            u'Puolueiden ajankohtaistutkimus 1981')
+        self.assertEquals(self.ddi_converter._read_value(
+            "ddi_xml.codeBook.missing.text", default=None), None)
+        self.assertRaises(ValueError, self.ddi_converter._read_value,
+                          "ddi_xml.codeBook.get(__import__('os'))")
+
+    def test_get_attr_match(self):
+        # IDNo is found in both docDscr and stdyDscr
+        filters = list(warnings.filters)
+        self.assertEquals(self.ddi_converter.get_attr_optional(
+            self.ddi_xml, 'IDNo', 'agency', dconverter.MATCH_FIRST), u'FSD')
+        self.assertEquals(self.ddi_converter.get_attr_optional(
+            self.ddi_xml, 'IDNo', 'agency', dconverter.MATCH_ALL),
+            [u'FSD', u'FSD'])
+        self.assertRaises(dconverter.AmbiguousTagError,
+                          self.ddi_converter.get_attr_optional,
+                          self.ddi_xml, 'IDNo', 'agency')
+        self.assertEquals(warnings.filters, filters)
+
+    def test_soup_to_etree(self):
+        # Same tree as serializing the soup and parsing it again
+        expected = etree.fromstring(str(self.ddi_xml)).find('.//{*}stdyDscr')
+        result = dconverter._soup_to_etree(self.ddi_xml.find('stdyDscr'))
+        self.assertEquals(
+            [(e.tag, dict(e.attrib), e.text) for e in result.iter()],
+            [(e.tag, dict(e.attrib), e.text) for e in expected.iter()])
+
     @classmethod
     def teardown_class(self):
         #Session.remove()
         ckan.model.repo.rebuild_db()
 
 
+class TestLxmlDataConverter(unittest.TestCase):
+
+    @classmethod
+    def setup_class(cls):
+        cls.bs4_converter = dconverter.DataConverter()
+        cls.lxml_converter = lxmlconverter.LxmlDataConverter()
+
+    def _convert(self, converter, xml, prune=True):
+        package_dict = converter.ddi2ckan(converter.parse(xml, prune),
+                                          'http://www.fsd.uta.fi/', xml)
+        converter.empty_errors()
+        # Generated ids differ between calls
+        package_dict.pop('id')
+        return package_dict
+
+    def test_same_output_as_bs4(self):
+        for xml in (testdata.nr1, testdata.nr2):
+            self.assertEquals(self._convert(self.lxml_converter, xml),
+                              self._convert(self.bs4_converter, xml))
+
+    def test_get_discipline(self):
+        ddi_xml = self.lxml_converter.parse(testdata.nr1)
+        subject = lxmlconverter.STDY_SUBJECT(ddi_xml)[0]
+        discipline = self.lxml_converter.get_discipline(subject)
+        assert discipline == u'politiikantutkimus'
+
+    def test_mandatory_error_record(self):
+        ddi_xml = self.lxml_converter.parse(testdata.nr1)
+        citation = lxmlconverter.STDY_CITATION(ddi_xml)[0]
+        self.assertEquals(self.lxml_converter.get_attr_mandatory(
+            citation, 'noSuchTag', 'date'), u'')
+        errors = self.lxml_converter.get_errors()
+        self.lxml_converter.empty_errors()
+        self.assertEquals(len(errors), 1)
+        self.assertEquals(errors[0].field, 'get_attr_mandatory')
+        self.assertEquals(errors[0].line, citation.sourceline)
+
+    def test_parse_pruned(self):
+        xml = os.path.join(os.path.dirname(__file__), '..', 'test_fixtures',
+                           'FSD1050.xml')
+        with open(xml) as xml_file:
+            xml = xml_file.read()
+        full = self.lxml_converter.parse(xml, prune=False)
+        pruned = self.lxml_converter.parse(xml)
+        tags = [etree.QName(el).localname for el in pruned]
+        self.assertEquals(tags, ['docDscr', 'stdyDscr'])
+        self.assertTrue(len(full.xpath('//*')) > 10 * len(pruned.xpath('//*')))
+        self.assertEquals(pruned[1].sourceline, full[1].sourceline)
+        for converter in (self.lxml_converter, self.bs4_converter):
+            self.assertEquals(self._convert(converter, xml),
+                              self._convert(converter, xml, prune=False))
+
+
+class TestConcurrentConversion(unittest.TestCase):
+    '''Run conversions with one converter from several threads.
+    '''
+    documents = [
+        testdata.nr1,
+        testdata.nr2,
+        # Missing contact
+        re.sub(r'(?s)<distStmt>.*?</distStmt>', '', testdata.nr1),
+        # Missing version
+        re.sub(r'(?s)<verStmt>.*?</verStmt>', '', testdata.nr2),
+    ]
+
+    def _convert(self, converter, xml):
+        package_dict, errors = converter.convert(converter.parse(xml), None,
+                                                 xml)
+        # Generated ids differ between calls
+        package_dict.pop('id')
+        return package_dict, errors
+
+    def _stress(self, converter, rounds):
+        expected = [self._convert(converter, xml) for xml in self.documents]
+        jobs = range(len(self.documents)) * rounds
+        pool = ThreadPool(8)
+        try:
+            results = pool.map(
+                lambda i: self._convert(converter, self.documents[i]), jobs)
+        finally:
+            pool.terminate()
+        for i, result in zip(jobs, results):
+            self.assertEquals(result, expected[i])
+        self.assertEquals(len(expected[3][1]), len(expected[1][1]) + 1)
+
+    def test_lxml_converter(self):
+        self._stress(lxmlconverter.LxmlDataConverter(), 20)
+
+    def test_bs4_converter(self):
+        self._stress(dconverter.DataConverter(), 2)
+
+
+class TestValidatorStore(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.store = httpcache.ValidatorStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        os.remove(self.path)
+
+    def test_get_unknown_url(self):
+        self.assertEquals(self.store.get('http://example.com/1.xml'), None)
+
+    def test_set_and_get_survive_reopen(self):
+        xml_hash = httpcache.content_hash(testdata.nr1)
+        self.store.set('http://example.com/1.xml\n', '"abc"',
+                       'Mon, 01 Jun 2015 10:00:00 GMT', xml_hash)
+        self.store.close()
+        validators = httpcache.ValidatorStore(self.path).get(
+            'http://example.com/1.xml')
+        self.assertEquals(validators['etag'], '"abc"')
+        self.assertEquals(validators['content_hash'], xml_hash)
+
+
+def _consume_fsd_ids(args):
+    store, names = args
+    return [store.consume(name) for name in names]
+
+
+class TestFsdIdStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, 'fsd_names_filtered.csv')
+        with open(self.csv_path, 'w') as csv_file:
+            csv_file.write('id-1,FSD1049\nid-2,fsd1050\nid-3,FSD1088\n')
+        self.store = fsdids.FsdIdStore(os.path.join(self.tmpdir, 'ids.db'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_migrate_csv_once(self):
+        self.assertEquals(self.store.migrate_csv(self.csv_path), 3)
+        self.assertEquals(self.store.migrate_csv(self.csv_path), 0)
+        self.assertEquals(len(self.store), 3)
+
+    def test_consume(self):
+        self.store.migrate_csv(self.csv_path)
+        self.assertEquals(self.store.consume('fsd1049'), 'id-1')
+        self.assertEquals(self.store.consume('FSD1050'), 'id-2')
+        self.assertEquals(self.store.consume('fsd1049'), None)
+        self.assertEquals(len(self.store), 1)
+
+    def test_consume_from_several_processes(self):
+        self.store.migrate_csv(self.csv_path)
+        names = ['FSD1049', 'FSD1050', 'FSD1088']
+        pool = multiprocessing.Pool(4)
+        try:
+            results = pool.map(_consume_fsd_ids, [(self.store, names)] * 4)
+        finally:
+            pool.terminate()
+        ids = [eid for result in results for eid in result if eid]
+        self.assertEquals(sorted(ids), ['id-1', 'id-2', 'id-3'])
+
+
+class TestDDIImporter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.xml_dir = os.path.join(self.tmpdir, 'ddi')
+        os.makedirs(os.path.join(self.xml_dir, 'b'))
+        for name in ['a.xml', 'b/c.xml', 'b/notes.txt']:
+            with open(os.path.join(self.xml_dir, name), 'w') as xml_file:
+                xml_file.write('<codeBook>{na}</codeBook>'.format(na=name))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_directory(self):
+        documents = list(ddifiles.read_documents(self.xml_dir))
+        self.assertEquals(documents, [('a.xml', '<codeBook>a.xml</codeBook>'),
+                                      ('b/c.xml', '<codeBook>b/c.xml</codeBook>')])
+
+    def test_read_tarball(self):
+        path = os.path.join(self.tmpdir, 'ddi.tar.gz')
+        archive = tarfile.open(path, 'w:gz')
+        archive.add(self.xml_dir, 'ddi')
+        archive.close()
+        documents = dict(ddifiles.read_documents(path, set(['ddi/a.xml'])))
+        self.assertEquals(documents, {'ddi/b/c.xml': '<codeBook>b/c.xml</codeBook>'})
+
+    def test_checkpoint_resume(self):
+        path = os.path.join(self.tmpdir, 'checkpoint')
+        commands.Checkpoint(path).add(['a.xml'])
+        checkpoint = commands.Checkpoint(path)
+        self.assertEquals(checkpoint.done, set(['a.xml']))
+        names = [name for name, _ in
+                 ddifiles.read_documents(self.xml_dir, checkpoint.done)]
+        self.assertEquals(names, ['b/c.xml'])
+
+    def test_write_batch_with_invalid_dataset(self):
+        importer = commands.DDIImporter.__new__(commands.DDIImporter)
+        importer.options = _Stub(organization=u'org')
+        importer.done = importer.written = 0
+        written = []
+
+        def write(name, package_dict):
+            if name == 'b.xml':
+                raise ValidationError({'title': ['Missing value']})
+            written.append(name)
+        importer._write_package = write
+        checkpoint = commands.Checkpoint(None)
+        batch = [('a.xml', {'id': u'a'}), ('b.xml', {'id': u'b'}),
+                 ('c.xml', None), ('d.xml', {'id': u'd'})]
+        with mock.patch('ckan.model.Session') as session, \
+                mock.patch.object(bulk, 'index_packages') as index:
+            importer._write_batch(batch, checkpoint)
+        # Rolled back at the invalid dataset and written one by one
+        self.assertEquals(written, ['a.xml', 'a.xml', 'd.xml'])
+        self.assertEquals(session.rollback.call_count, 2)
+        self.assertEquals(checkpoint.done, set(['a.xml', 'd.xml']))
+        self.assertEquals((importer.done, importer.written), (4, 2))
+        self.assertEquals(index.call_args_list,
+                          [mock.call([u'a']), mock.call([u'd'])])
+
+    def test_harvest_import_in_batches(self):
+        importer = commands.DDIHarvestImporter.__new__(
+            commands.DDIHarvestImporter)
+        importer.options = _Stub(batch_size=2)
+        harvester = mock.Mock()
+        harvester.import_harvest_objects.side_effect = len
+        with mock.patch('ckan.model.Session') as session:
+            session.query.return_value.filter.return_value.filter \
+                .return_value.limit.return_value.all.side_effect = \
+                [['1', '2'], ['3'], []]
+            importer._import_job(harvester, _Stub(id='job'))
+        self.assertEquals(
+            [call[0][0] for call
+             in harvester.import_harvest_objects.call_args_list],
+            [['1', '2'], ['3']])
+
+
+class TestOfflineConversion(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name in ['FSD1049.xml', 'FSD1050.xml']:
+            shutil.copy(os.path.join(os.path.dirname(__file__), '..',
+                                     'test_fixtures', name), self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _convert(self, parser):
+        output = StringIO.StringIO()
+        self.assertEquals(offline.convert_files(self.tmpdir, output, 1, parser),
+                          (2, 2))
+        return output.getvalue()
+
+    def test_same_output_every_time(self):
+        first = self._convert('lxml')
+        self.assertEquals(first, self._convert('lxml'))
+        self.assertEquals(first, self._convert('bs4'))
+        self.assertTrue(first.startswith('{'))
+        self.assertTrue('"id": "urn:uuid:' in first)
+
+
+class TestVarExport(unittest.TestCase):
+
+    def test_write_variables(self):
+        with open(os.path.join(os.path.dirname(__file__), '..',
+                               'test_fixtures', 'FSD1050.xml')) as xml_file:
+            xml = xml_file.read()
+        var_file = StringIO.StringIO()
+        code_file = StringIO.StringIO()
+        self.assertEquals(varexport.write_variables(xml, var_file, code_file),
+                          167)
+        var_rows = var_file.getvalue().splitlines()
+        code_rows = code_file.getvalue().splitlines()
+        self.assertEquals(len(var_rows), 168)
+        self.assertTrue(var_rows[0].startswith('ID,labl,preQTxt,qstnLit'))
+        self.assertEquals(
+            var_rows[1].decode('utf-8').split(u',')[:3],
+            [u'FSD_NO', u'[fsd_no] Aineistonumero (lisätty FSD:ssä)', u''])
+        self.assertTrue('"max,1050 min,1050"' in var_rows[1])
+        self.assertEquals(code_rows[:2], ['ID,catValu,labl,catStat',
+                                          'FSD_NO,1050,,1512'])
+
+    def test_stats_columns(self):
+        if not varstats.available():
+            raise SkipTest('NumPy is not installed')
+        stats = varstats.VariableStats()
+        stats.add({'ID': 'V1', 'sumStat_vald': '10', 'sumStat_mean': '1.5'},
+                  [{'catValu': '1', 'catStat': '4'},
+                   {'catValu': '2', 'catStat': '6'}])
+        stats.add({'ID': 'V2', 'sumStat_min': 'n/a'}, [])
+        stored = StringIO.StringIO()
+        stats.save(stored)
+        stored.seek(0)
+        columns = varstats.load(stored)
+        self.assertEquals(list(columns['ids']), [u'V1', u'V2'])
+        self.assertEquals(columns['valid'][0], 10)
+        self.assertEquals(columns['mean'][0], 1.5)
+        self.assertTrue(varstats.numpy.isnan(columns['min']).all())
+        self.assertEquals(list(columns['cat_var']), [0, 0])
+        self.assertEquals(columns['cat_freq'].sum(), 10)
+
+    def test_no_variables(self):
+        var_file = StringIO.StringIO()
+        self.assertEquals(varexport.write_variables(
+            '<codeBook><stdyDscr/></codeBook>', var_file,
+            StringIO.StringIO()), 0)
+        self.assertEquals(len(var_file.getvalue().splitlines()), 1)
+
+
+class TestPayload(unittest.TestCase):
+
+    def test_round_trip(self):
+        for xml in ['<codeBook>\xc3\xa4</codeBook>',
+                    u'<codeBook>\xe4</codeBook>']:
+            info = {'url': 'http://example.com/', 'xml': xml, 'etag': None}
+            decoded = payload.decode(payload.encode(info))
+            self.assertEquals(decoded, info)
+            self.assertEquals(type(decoded['xml']), type(xml))
+
+    def test_text_safe(self):
+        content = payload.encode({'url': 'http://example.com/',
+                                  'xml': testdata.nr1})
+        self.assertTrue(content.decode('ascii'))
+        self.assertTrue(len(content) < len(testdata.nr1))
+        self.assertEquals(payload.decode(content.decode('ascii'))['xml'],
+                          testdata.nr1)
+
+    def test_pickled(self):
+        info = {'url': 'http://example.com/', 'xml': '<codeBook/>'}
+        self.assertEquals(payload.decode(pickle.dumps(info)), info)
+
+    def test_unknown_or_damaged(self):
+        content = payload.encode({'url': 'http://example.com/',
+                                  'xml': '<codeBook/>'})
+        self.assertRaises(ValueError, payload.decode,
+                          content.replace('ddi-payload/1', 'ddi-payload/9'))
+        self.assertRaises(ValueError, payload.decode, content[:-4])
+        self.assertRaises(ValueError, payload.decode, 'ddi-payload/1')
+
+    def test_not_a_payload(self):
+        # A url left by a parse error, an empty or a foreign content
+        for content in ['http://example.org/x.xml', '', 'garbage',
+                        pickle.dumps(['<codeBook/>'])]:
+            self.assertRaises(ValueError, payload.decode, content)
+
+    def test_pickled_code_refused(self):
+        content = pickle.dumps({'url': 'http://example.com/',
+                                'xml': '<codeBook/>', 'run': ThreadPool})
+        self.assertRaises(ValueError, payload.decode, content)
+
+
+class TestOwnerOrgCache(unittest.TestCase):
+
+    def _get(self, cache, *source_ids, **kwargs):
+        with mock.patch('ckan.model.Session') as session:
+            query = session.query.return_value
+            query.join.return_value.filter.return_value.one.return_value = \
+                (u'fsd',)
+            names = [cache.get(source_id, kwargs.get('job_id'))
+                     for source_id in source_ids]
+        self.assertEquals(set(names), set([u'fsd']))
+        return session.query.call_count
+
+    def test_one_query_per_source(self):
+        cache = ownerorgs.OwnerOrgCache()
+        self.assertEquals(self._get(cache, 'source', 'source', 'other'), 2)
+        self.assertEquals(self._get(cache, 'source', 'other'), 0)
+
+    def test_expired(self):
+        cache = ownerorgs.OwnerOrgCache(ttl=-1)
+        self.assertEquals(self._get(cache, 'source', 'source'), 2)
+
+    def test_read_again_for_next_job(self):
+        cache = ownerorgs.OwnerOrgCache()
+        self.assertEquals(self._get(cache, 'source', job_id='job1'), 1)
+        self.assertEquals(self._get(cache, 'source', job_id='job1'), 0)
+        self.assertEquals(self._get(cache, 'source', job_id='job2'), 1)
+
+
+class TestPidResolver(unittest.TestCase):
+
+    def _query(self, rows=()):
+        query = mock.MagicMock()
+        for method in ['join', 'filter', 'distinct', 'subquery']:
+            getattr(query, method).return_value = query
+        query.__iter__.side_effect = lambda: iter(rows)
+        return query
+
+    def setUp(self):
+        extras = [('pkg1', u'pids_0_id', u'urn:nbn:fi:fsd:T-1'),
+                  ('pkg1', u'pids_0_type', u'data'),
+                  ('pkg1', u'pids_1_id', u'urn:nbn:fi:fsd:M-1'),
+                  ('pkg1', u'pids_1_type', u'metadata'),
+                  ('pkg2', u'pids_0_id', u'urn:nbn:fi:fsd:T-2'),
+                  ('pkg2', u'pids_0_type', u'data'),
+                  ('pkg3', u'pids_0_id', u'urn:nbn:fi:fsd:T-2'),
+                  ('pkg3', u'pids_0_type', u'data'),
+                  ('pkg4', u'pids_0_id', u'urn:nbn:fi:fsd:T-4'),
+                  ('pkg4', u'pids_0_type', u'data'),
+                  ('pkg5', u'pids_0_id', u'urn:nbn:fi:fsd:M-5'),
+                  ('pkg5', u'pids_0_type', u'metadata')]
+        # Datasets of other sources holding the PIDs of the source
+        others = [(u'urn:nbn:fi:fsd:T-4', 'other')]
+        self.resolver = pidresolver.PidResolver('job')
+        with mock.patch('ckan.model.Session') as session:
+            session.query.side_effect = [self._query(), self._query(extras),
+                                         self._query(), self._query(others)]
+            self.resolver.prefetch('source')
+
+    def _package(self, *pids):
+        return {'pids': [{'id': pid, 'type': 'data'} for pid in pids]}
+
+    def test_prefetched(self):
+        with mock.patch('ckan.model.Session') as session:
+            self.assertEquals(self.resolver.resolve(
+                self._package(u'urn:nbn:fi:fsd:T-1')), 'pkg1')
+            package_dict = self._package(u'urn:nbn:fi:fsd:T-1')
+            package_dict['pids'].append({'id': u'urn:nbn:fi:fsd:M-2',
+                                         'type': 'metadata'})
+            self.assertEquals(self.resolver.resolve(package_dict), 'pkg1')
+            # Several datasets with the same PID
+            self.assertEquals(self.resolver.resolve(
+                self._package(u'urn:nbn:fi:fsd:T-2')), None)
+            # Also held by a dataset outside the source
+            self.assertEquals(self.resolver.resolve(
+                self._package(u'urn:nbn:fi:fsd:T-4')), None)
+            # Not a data PID of the dataset holding it
+            self.assertEquals(self.resolver.resolve(
+                self._package(u'urn:nbn:fi:fsd:M-5')), None)
+        self.assertFalse(session.query.called)
+
+    def test_unknown_looked_up_once(self):
+        package_dict = self._package(u'urn:nbn:fi:fsd:T-9')
+        with mock.patch('ckan.model.Session') as session:
+            session.query.return_value = self._query()
+            self.assertEquals(self.resolver.resolve(package_dict), None)
+            self.assertEquals(self.resolver.resolve(package_dict), None)
+            package_dict['id'] = 'pkg9'
+            self.resolver.add(package_dict)
+            self.assertEquals(self.resolver.resolve(package_dict), 'pkg9')
+        self.assertEquals(session.query.call_count, 1)
+
+    def test_unknown_held_by_one_dataset(self):
+        with mock.patch('ckan.model.Session') as session:
+            session.query.side_effect = [
+                self._query([(u'urn:nbn:fi:fsd:T-8', 'pkg8')]),
+                self._query([('pkg8', u'pids_0_id', u'urn:nbn:fi:fsd:T-8'),
+                             ('pkg8', u'pids_0_type', u'data')])]
+            self.assertEquals(self.resolver.resolve(
+                self._package(u'urn:nbn:fi:fsd:T-8')), 'pkg8')
+
+
+class TestPackageBatch(unittest.TestCase):
+
+    def _batch(self, size=2, seconds=60, invalid=()):
+        self.session = mock.Mock()
+        self.written = []
+        self.indexed = []
+
+        def write(harvest_object, package_dict):
+            if package_dict['id'] in invalid:
+                raise ValueError('Invalid')
+            self.written.append(package_dict['id'])
+
+        def write_one(harvest_object, package_dict):
+            return package_dict['id'] not in invalid
+        self.write_one = mock.Mock(side_effect=write_one)
+        return bulk.PackageBatch(self.session, write, self.write_one, size,
+                                 seconds, self.indexed.extend)
+
+    def test_commit_per_batch(self):
+        batch = self._batch()
+        done = mock.Mock()
+        batch.after_commit = mock.Mock()
+        for i in range(5):
+            self.assertEquals(batch.add(i, None, {'id': str(i)}, done), [])
+        self.assertEquals(self.session.commit.call_count, 2)
+        self.assertEquals(batch.after_commit.call_count, 2)
+        self.assertEquals(self.indexed, ['0', '1', '2', '3'])
+        self.assertEquals(batch.flush(), [])
+        self.assertEquals(self.session.commit.call_count, 3)
+        self.assertEquals(self.indexed, ['0', '1', '2', '3', '4'])
+        self.assertEquals(done.call_count, 5)
+        self.assertFalse(self.write_one.called)
+
+    def test_commit_when_old(self):
+        batch = self._batch(size=100, seconds=0)
+        batch.add(0, None, {'id': '0'})
+        self.assertEquals(self.session.commit.call_count, 1)
+
+    def test_invalid_falls_back_to_one_by_one(self):
+        batch = self._batch(size=3, invalid=['1'])
+        self.assertEquals(batch.add(0, None, {'id': '0'}), [])
+        batch.after_commit = mock.Mock()
+        self.assertEquals(batch.add(1, None, {'id': '1'}), [1])
+        self.assertTrue(self.session.rollback.called)
+        self.assertEquals(batch.after_commit.call_count, 1)
+        self.assertEquals(self.write_one.call_count, 2)
+        self.assertEquals(self.indexed, ['0'])
+        self.assertEquals(batch.add(2, None, {'id': '2'}), [])
+        self.assertEquals(batch.flush(), [])
+        self.assertEquals(self.indexed, ['0', '2'])
+
+    def test_failed_commit_falls_back_to_one_by_one(self):
+        batch = self._batch()
+        self.session.commit.side_effect = Exception('Deadlock')
+        batch.add(0, None, {'id': '0'})
+        self.assertEquals(batch.add(1, None, {'id': '1'}), [])
+        self.assertEquals(self.write_one.call_count, 2)
+        self.assertEquals(self.indexed, ['0', '1'])
+
+    def test_indexing_suspended(self):
+        with mock.patch.dict('pylons.config',
+                             {'ckan.search.automatic_indexing': True}):
+            with bulk.indexing_suspended():
+                self.assertFalse(
+                    dharvester.ckan_config['ckan.search.automatic_indexing'])
+            self.assertTrue(
+                dharvester.ckan_config['ckan.search.automatic_indexing'])
+
+
+class TestDeferredIndex(unittest.TestCase):
+
+    def test_chunks_and_one_commit(self):
+        chunks = []
+        commit = mock.Mock()
+        deferred_index = bulk.DeferredIndex(100, chunks.append, commit)
+        deferred_index.add([str(i) for i in range(250)])
+        deferred_index.add(['0', '1'])
+        self.assertEquals(deferred_index.flush(), 250)
+        self.assertEquals([len(chunk) for chunk in chunks], [100, 100, 50])
+        self.assertEquals(commit.call_count, 1)
+        self.assertEquals(deferred_index.flush(), 0)
+        self.assertEquals(commit.call_count, 1)
+
+
+class TestUrlList(unittest.TestCase):
+
+    URLS = '# FSD list\n' \
+           'http://example.com/1.xml\n' \
+           '\n' \
+           '  http://example.com/2.xml \r\n' \
+           'http://example.com/1.xml\n' \
+           'http://example.com/3.xml'
+
+    def test_iter_urls(self):
+        urls = list(urllist.iter_urls(StringIO.StringIO(self.URLS)))
+        self.assertEquals(urls, ['http://example.com/1.xml',
+                                 'http://example.com/2.xml',
+                                 'http://example.com/3.xml'])
+
+    def test_iter_urls_limit(self):
+        urls = list(urllist.iter_urls(StringIO.StringIO(self.URLS), 2))
+        self.assertEquals(len(urls), 2)
+
+    def test_iter_urls_gzip(self):
+        compressed = StringIO.StringIO()
+        gz = gzip.GzipFile(fileobj=compressed, mode='wb')
+        gz.write(self.URLS)
+        gz.close()
+        compressed.seek(0)
+        urls = list(urllist.iter_urls(compressed))
+        self.assertEquals(urls[-1], 'http://example.com/3.xml')
+
+    def test_key_set_grows(self):
+        keys = urllist.KeySet(capacity=4)
+        added = [keys.add(urllist._url_key('http://example.com/%d.xml' % i))
+                 for i in range(100)]
+        self.assertTrue(all(added))
+        self.assertEquals(len(keys), 100)
+        key = urllist._url_key('http://example.com/7.xml')
+        self.assertFalse(keys.add(key))
+        self.assertEquals(len(keys), 100)
+
+    def test_key_set_doubles(self):
+        # The keys of platforms without 64-bit unsigned longs
+        with mock.patch.multiple(urllist, KEY_TYPECODE='d', KEY_BITS=52):
+            self.assertTrue(urllist._url_key('http://example.com/') < 2 ** 52)
+            self.test_key_set_grows()
+
+
 class TestDDIHarvester(unittest.TestCase):
 
     @classmethod
@@ -121,6 +774,427 @@ class TestDDIHarvester(unittest.TestCase):
     def test_dummy(self):
         assert 1
 
+    def test_validate_config_gather_concurrency(self):
+        self.ddi_harvester.validate_config('{"gather_concurrency": 4}')
+        self.assertRaises(TypeError, self.ddi_harvester.validate_config,
+                          '{"gather_concurrency": "4"}')
+        self.assertRaises(ValueError, self.ddi_harvester.validate_config,
+                          '{"gather_concurrency": 0}')
+
+    def test_validate_config_conditional_fetch(self):
+        with mock.patch.dict('pylons.config', {'ckan.storage_path': '/srv'}):
+            self.ddi_harvester.validate_config('{"conditional_fetch": true}')
+            self.assertEquals(self.ddi_harvester._validator_store_path(),
+                              '/srv/ddi/validators.db')
+        with mock.patch.dict('pylons.config', {}, clear=True):
+            self.ddi_harvester.validate_config('{"conditional_fetch": false}')
+            self.assertRaises(ValueError, self.ddi_harvester.validate_config,
+                              '{"conditional_fetch": true}')
+
+    def test_validate_config_export_variables(self):
+        self.ddi_harvester.validate_config('{"export_variables": true}')
+        self.assertRaises(TypeError, self.ddi_harvester.validate_config,
+                          '{"export_variables": "yes"}')
+
+    def test_gather_closes_source_on_error(self):
+        harvester = dharvester.DDIHarvester()
+        harvest_job = _Stub(id='job', source_id='source',
+                            source=_Stub(config='{}',
+                                         url='http://example.com/list'))
+        source = mock.Mock(status_code=200)
+        with mock.patch('ckan.model.Session'), \
+                mock.patch.object(dharvester, 'class_mapper'), \
+                mock.patch('ckanext.ddi.httpclient.get',
+                           return_value=source), \
+                mock.patch.object(urllist, 'iter_urls',
+                                  side_effect=RuntimeError('Broken list')):
+            self.assertEquals(harvester.gather_stage(harvest_job), None)
+        source.close.assert_called_once_with()
+
+    def test_probe_urls_keeps_order(self):
+        urls = ['http://example.com/%d.xml' % i for i in range(20)]
+        harvester = dharvester.DDIHarvester()
+        harvester._get_last_modified = lambda url: (url, None)
+        probed = [url for url, _ in harvester._probe_urls(urls, 5)]
+        self.assertEquals(probed, urls)
+
+    def test_probe_urls_reads_urls_in_windows(self):
+        read = []
+
+        def urls():
+            for i in range(100):
+                read.append(i)
+                yield 'http://example.com/%d.xml' % i
+        harvester = dharvester.DDIHarvester()
+        harvester._get_last_modified = lambda url: (url, None)
+        probed = harvester._probe_urls(urls(), 2)
+        next(probed)
+        self.assertTrue(len(read) <= 2 * dharvester.PROBE_WINDOW_FACTOR + 1)
+        self.assertEquals(len(list(probed)), 99)
+
+    def _harvest_objects(self, documents, config='{"parser": "lxml"}',
+                         guid=None):
+        return [_Stub(id=str(i), job=_Stub(source=_Stub(config=config)),
+                      content=payload.encode({'url': 'http://example.com/',
+                                              'xml': xml}),
+                      guid=guid, harvest_source_id='source',
+                      harvest_job_id='job', extras=[])
+                for i, xml in enumerate(documents)]
+
+    def _imports(self, harvester, batch, harvest_objects):
+        '''Import 'harvest_objects' without the database, with import_batch()
+        or with import_stage(), returning the results and the converted
+        package dicts and errors.
+        '''
+        imported = {}
+        harvester._pid_resolver = pidresolver.PidResolver('job')
+
+        def import_package(harvest_object, info, package_dict, errors):
+            if package_dict:
+                # Generated ids differ between calls
+                package_dict.pop('id')
+            imported[harvest_object.id] = (package_dict, errors)
+            return bool(package_dict)
+        harvester._import_package = import_package
+        with mock.patch.object(ownerorgs, 'get_owner_org',
+                               return_value=u'org'):
+            if batch:
+                results = harvester.import_batch(harvest_objects)
+            else:
+                results = [harvester.import_stage(harvest_object)
+                           for harvest_object in harvest_objects]
+        return results, imported
+
+    def test_import_batch_same_as_import_stage(self):
+        documents = [testdata.nr1, testdata.nr2, '', 'not xml']
+        harvester = dharvester.DDIHarvester()
+        harvester._conversion_pool = convertpool.ConversionPool(2)
+        harvest_objects = self._harvest_objects(documents)
+        try:
+            results, imported = self._imports(harvester, True,
+                                              harvest_objects)
+        finally:
+            harvester._conversion_pool.close()
+        expected, expected_imported = self._imports(
+            dharvester.DDIHarvester(), False,
+            self._harvest_objects(documents))
+        self.assertEquals(results, [True, True, False, False])
+        self.assertEquals(results, expected)
+        self.assertEquals(imported, expected_imported)
+        self.assertEquals(imported['0'][0]['owner_org'], u'org')
+        # The document is kept when its dataset was not written
+        self.assertEquals([harvest_object.content is None
+                           for harvest_object in harvest_objects],
+                          [True, True, False, False])
+
+    def test_import_harvest_objects(self):
+        harvester = dharvester.DDIHarvester()
+        harvest_objects = [_Stub(id=str(i), current=None, package_id=None)
+                           for i in range(5)]
+        fetch_results = iter([False, 'unchanged', True, True, True])
+        harvester.fetch_stage = lambda harvest_object: next(fetch_results)
+
+        def import_batch(fetched):
+            self.assertEquals([harvest_object.state
+                               for harvest_object in fetched],
+                              ['IMPORT'] * 3)
+            fetched[0].current = True
+            fetched[0].package_id = 'pkg'
+            return [True, 'unchanged', False]
+        harvester.import_batch = import_batch
+        with mock.patch('ckan.model.Session') as session:
+            session.query.return_value.filter.return_value.limit \
+                .return_value.count.return_value = 1
+            self.assertEquals(
+                harvester.import_harvest_objects(harvest_objects), 2)
+        self.assertEquals(
+            [(harvest_object.state, harvest_object.report_status)
+             for harvest_object in harvest_objects],
+            [('ERROR', 'errored'), ('COMPLETE', 'not modified'),
+             ('COMPLETE', 'added'), ('COMPLETE', 'not modified'),
+             ('ERROR', 'errored')])
+        self.assertEquals(session.commit.call_count, 2)
+
+    def test_import_harvest_objects_batch_fails(self):
+        harvester = dharvester.DDIHarvester()
+        harvest_objects = [_Stub(id=str(i), current=None, package_id=None)
+                           for i in range(2)]
+        harvester.fetch_stage = lambda harvest_object: True
+        harvester.import_batch = mock.Mock(
+            side_effect=RuntimeError('Database gone'))
+        saved = []
+        with mock.patch('ckan.model.Session') as session, \
+                mock.patch.object(
+                    dharvester.HarvesterBase, '_save_object_error',
+                    lambda self, message, obj, stage, line: saved.append(
+                        (obj.id, stage))):
+            self.assertEquals(
+                harvester.import_harvest_objects(harvest_objects), 0)
+        self.assertEquals(
+            [(harvest_object.state, harvest_object.report_status)
+             for harvest_object in harvest_objects],
+            [('ERROR', 'errored')] * 2)
+        self.assertEquals(saved, [('0', 'Import'), ('1', 'Import')])
+        session.rollback.assert_called_once_with()
+
+    def test_import_batch_without_owner_org(self):
+        harvester = dharvester.DDIHarvester()
+        harvest_objects = self._harvest_objects([testdata.nr1, testdata.nr2])
+        harvester._pid_resolver = pidresolver.PidResolver('job')
+        imported = []
+        harvester._import_package = \
+            lambda harvest_object, info, package_dict, errors: \
+            imported.append(harvest_object.id) or True
+        saved = []
+        with mock.patch.object(ownerorgs, 'get_owner_org',
+                               side_effect=[NoResultFound(), u'org']), \
+                mock.patch.object(
+                    dharvester.HarvesterBase, '_save_object_error',
+                    lambda self, message, obj, stage, line: saved.append(
+                        (obj.id, stage))):
+            results = harvester.import_batch(harvest_objects)
+        self.assertEquals(results, [False, True])
+        self.assertEquals(imported, ['1'])
+        self.assertEquals(saved, [('0', 'Import')])
+
+    def test_batch_import_job_lifecycle(self):
+        harvester = dharvester.DDIHarvester()
+        harvest_job = _Stub(id='job', source_id='source',
+                            gather_finished=None,
+                            source=_Stub(config='{"batch_import": true}',
+                                         url='http://example.com/list'))
+        urls = ['http://example.com/%d.xml' % i for i in range(3)]
+        harvester._probe_urls = \
+            lambda urls, concurrency: ((url, None) for url in urls)
+        with mock.patch('ckan.model.Session') as session, \
+                mock.patch.object(dharvester, 'class_mapper'), \
+                mock.patch('ckanext.ddi.httpclient.get'), \
+                mock.patch.object(urllist, 'iter_urls',
+                                  return_value=iter(urls)):
+            # Nothing for the fetch queue
+            self.assertEquals(harvester.gather_stage(harvest_job), [])
+        # The gather consumer returns early without objects to send, so the
+        # job must already be gathered for "paster harvester run" to finish it
+        self.assertNotEquals(harvest_job.gather_finished, None)
+        session.add.assert_called_with(harvest_job)
+        self.assertTrue(session.commit.called)
+        self.assertEquals(session.execute.call_count, 1)
+
+        harvest_objects = [_Stub(id=str(i), current=None, package_id=None,
+                                 state=u'WAITING') for i in range(3)]
+        fetch_results = iter([False, True, True])
+        harvester.fetch_stage = lambda harvest_object: next(fetch_results)
+        harvester.import_batch = lambda fetched: [True, False]
+        with mock.patch('ckan.model.Session') as session:
+            session.query.return_value.filter.return_value.limit \
+                .return_value.count.return_value = 1
+            harvester.import_harvest_objects(harvest_objects)
+        # What harvest_jobs_run requires to finish the job
+        self.assertEquals(
+            [harvest_object.state for harvest_object in harvest_objects
+             if harvest_object.state not in ('COMPLETE', 'ERROR')], [])
+
+    def test_import_batch_write_batches(self):
+        harvester = dharvester.DDIHarvester()
+        harvest_objects = self._harvest_objects(
+            [testdata.nr1, testdata.nr2, testdata.nr1],
+            '{"parser": "lxml", "write_batch_size": 2}')
+        harvester._pid_resolver = pidresolver.PidResolver('job')
+        harvester._site_user = u'harvest'
+        written = []
+        harvester._write_package = \
+            lambda harvest_object, package_dict: written.append(
+                harvest_object.id)
+        with mock.patch('ckan.model.Session') as session, \
+                mock.patch.object(bulk, 'index_packages') as index, \
+                mock.patch.object(ownerorgs, 'get_owner_org',
+                                  return_value=u'org'):
+            results = harvester.import_batch(harvest_objects)
+        self.assertEquals(results, [True, True, True])
+        self.assertEquals(written, ['0', '1', '2'])
+        # The content hashes first, then the two batches
+        self.assertEquals(session.commit.call_count, 3)
+        self.assertEquals(index.call_count, 2)
+
+    def test_import_batch_saves_errors_after_commit(self):
+        harvester = dharvester.DDIHarvester()
+        harvest_objects = self._harvest_objects(
+            [testdata.nr1, 'not xml', testdata.nr2],
+            '{"parser": "lxml", "write_batch_size": 2}')
+        harvester._pid_resolver = pidresolver.PidResolver('job')
+        harvester._site_user = u'harvest'
+        written = []
+        harvester._write_package = \
+            lambda harvest_object, package_dict: written.append(
+                harvest_object.id)
+        saved = []
+        with mock.patch('ckan.model.Session') as session, \
+                mock.patch.object(bulk, 'index_packages'), \
+                mock.patch.object(ownerorgs, 'get_owner_org',
+                                  return_value=u'org'), \
+                mock.patch.object(
+                    dharvester.HarvesterBase, '_save_object_error',
+                    lambda self, message, obj, stage, line: saved.append(
+                        (obj.id, session.commit.call_count))):
+            results = harvester.import_batch(harvest_objects)
+        self.assertEquals(results, [True, False, True])
+        # The conversion errors are saved once the batch has been committed
+        self.assertEquals(saved, [('0', 2), ('2', 2)])
+        self.assertEquals(harvester._object_errors, None)
+
+    def test_defer_indexing(self):
+        harvester = dharvester.DDIHarvester()
+        harvest_objects = self._harvest_objects(
+            [testdata.nr2] * 3, '{"parser": "lxml", "defer_indexing": true}')
+        harvester._pid_resolver = pidresolver.PidResolver('job')
+        # Each document is a dataset of its own
+        harvester._pid_resolver.resolve = lambda package_dict: None
+        ids = iter(range(len(harvest_objects)))
+        harvester.ddi_converters['lxml']._get_id_by_name = \
+            lambda name: 'pkg{i}'.format(i=next(ids))
+        with mock.patch('ckan.model.Session') as session, \
+                mock.patch.object(harvester, 'index_pending') as index, \
+                mock.patch.object(ownerorgs, 'get_owner_org',
+                                  return_value=u'org'), \
+                mock.patch.dict('pylons.config',
+                                {'ckan.search.automatic_indexing': True}):
+            # Other objects of the job wait to be imported until the last one
+            session.query.return_value.filter.return_value.filter \
+                .return_value.filter.return_value.first.side_effect = \
+                [('next',)] * 2 + [None]
+            results = [harvester.import_stage(harvest_object)
+                       for harvest_object in harvest_objects]
+            self.assertTrue(
+                dharvester.ckan_config['ckan.search.automatic_indexing'])
+        self.assertEquals(results, [True] * 3)
+        self.assertEquals(
+            [[(extra.key, extra.value) for extra in harvest_object.extras]
+             for harvest_object in harvest_objects],
+            [[('index_pending', 'pkg{i}'.format(i=i))] for i in range(3)])
+        index.assert_called_once_with('source')
+
+    def test_index_pending(self):
+        harvester = dharvester.DDIHarvester()
+        with mock.patch('ckan.model.Session') as session, \
+                mock.patch.object(bulk, 'index_packages') as index, \
+                mock.patch.object(bulk, 'soft_commit') as soft_commit, \
+                mock.patch.dict('pylons.config',
+                                {'ckanext.ddi.index_chunk_size': '2'}):
+            query = session.query.return_value
+            query.join.return_value.filter.return_value.filter.return_value \
+                .all.return_value = [(1, 'pkg0'), (2, 'pkg1'), (3, 'pkg0'),
+                                     (4, 'pkg2')]
+            self.assertEquals(harvester.index_pending('source'), 3)
+        self.assertEquals([call[0][0] for call in index.call_args_list],
+                          [['pkg0', 'pkg1'], ['pkg2']])
+        self.assertEquals(soft_commit.call_count, 1)
+        self.assertTrue(query.filter.return_value.delete.called)
+        self.assertEquals(session.commit.call_count, 1)
+
+    def test_package_schema_built_once(self):
+        harvester = dharvester.DDIHarvester()
+        with mock.patch('ckanext.kata.plugin.KataPlugin.'
+                        'create_package_schema_ddi',
+                        side_effect=lambda: {'id': [unicode]}) as create:
+            schema = harvester._get_package_schema()
+            schema['id'] = []
+            self.assertEquals(harvester._get_package_schema(),
+                              {'id': [unicode]})
+            self.assertEquals(create.call_count, 1)
+            harvester.configure({})
+            harvester._get_package_schema()
+            self.assertEquals(create.call_count, 2)
+
+    def test_skip_unchanged(self):
+        digest = httpcache.content_hash(testdata.nr1)
+        for config, stored, expected in (
+                ('{}', digest, ['unchanged', 'unchanged']),
+                ('{}', 'old', [True, True]),
+                ('{"force_import": true}', digest, [True, True])):
+            harvester = dharvester.DDIHarvester()
+            harvest_objects = self._harvest_objects(
+                [testdata.nr1], config, 'http://example.com/')
+            harvest_objects += self._harvest_objects(
+                [testdata.nr1], config, 'http://example.com/')
+            with mock.patch.object(harvester, '_stored_content_hash',
+                                   return_value=stored):
+                results = [self._imports(harvester, False,
+                                         harvest_objects[:1])[0][0],
+                           self._imports(harvester, True,
+                                         harvest_objects[1:])[0][0]]
+            self.assertEquals(results, expected)
+            for harvest_object in harvest_objects:
+                if expected[0] == 'unchanged':
+                    self.assertEquals(harvest_object.extras, [])
+                    self.assertEquals(harvest_object.content, None)
+                else:
+                    self.assertEquals(harvest_object.extras[0].value, digest)
+
+    def test_skip_unchanged_saves_validators(self):
+        harvester = dharvester.DDIHarvester()
+        harvester._set_config('{}')
+        harvester._validator_store = mock.Mock()
+        harvest_object = _Stub(guid='http://example.com/', extras=[])
+        info = {'url': 'http://example.com/', 'xml': testdata.nr1,
+                'etag': '"1"', 'last_modified': None, 'content_hash': 'abc'}
+        with mock.patch.object(harvester, '_stored_content_hash',
+                               return_value='abc'):
+            self.assertTrue(harvester._skip_unchanged(harvest_object, info))
+        harvester._validator_store.set.assert_called_once_with(
+            'http://example.com/', '"1"', None, 'abc')
+
+    def test_default_parser(self):
+        harvester = dharvester.DDIHarvester()
+        harvester._set_config('{}')
+        self.assertTrue(harvester.ddi_converter is
+                        harvester.ddi_converters['bs4'])
+        harvester._set_config('{"parser": "lxml"}')
+        self.assertTrue(harvester.ddi_converter is
+                        harvester.ddi_converters['lxml'])
+
+    def test_validate_config_batch_import(self):
+        self.ddi_harvester.validate_config('{"batch_import": true}')
+        self.assertRaises(TypeError, self.ddi_harvester.validate_config,
+                          '{"batch_import": "yes"}')
+
+    def test_validate_config_force_import(self):
+        self.ddi_harvester.validate_config('{"force_import": true}')
+        self.assertRaises(TypeError, self.ddi_harvester.validate_config,
+                          '{"force_import": 1}')
+
+    def test_export_variables(self):
+        with open(os.path.join(os.path.dirname(__file__), '..',
+                               'test_fixtures', 'FSD1050.xml')) as xml_file:
+            info = {'xml': xml_file.read()}
+        stored = {}
+
+        def put_stream(bucket, label, stream, params):
+            stored[label] = stream.read()
+        ofs = mock.Mock()
+        ofs.put_stream.side_effect = put_stream
+        package_dict = {'name': u'fsd1050', 'resources': []}
+        harvester = dharvester.DDIHarvester()
+        with mock.patch('ckan.controllers.storage.get_ofs', return_value=ofs), \
+                mock.patch('ckan.lib.base.h') as h:
+            h.url_for.side_effect = lambda route, label: '/storage/f/' + label
+            harvester._export_variables(_Stub(harvest_source_id='source'),
+                                        info, package_dict)
+        self.assertEquals(len(stored['source/fsd1050_var.csv'].splitlines()),
+                          168)
+        urls = [r['url'] for r in package_dict['resources']]
+        self.assertTrue(urls[0].endswith('/storage/f/source/fsd1050_var.csv'))
+        self.assertTrue(urls[1].endswith('/storage/f/source/fsd1050_code.csv'))
+        if not varstats.available():
+            self.assertEquals(len(stored), 2)
+            return
+        self.assertTrue(urls[2].endswith('/storage/f/source/fsd1050_stats.npz'))
+        columns = varstats.load(
+            StringIO.StringIO(stored['source/fsd1050_stats.npz']))
+        self.assertEquals(len(columns['ids']), 167)
+        self.assertEquals(columns['ids'][0], u'FSD_NO')
+        self.assertEquals(columns['valid'][0], 1512)
+        self.assertEquals(columns['max'][0], 1050)
+
     @classmethod
     def teardown_class(self):
         #Session.remove()
@@ -0,0 +1,142 @@
+# coding: utf-8
+'''
+Streaming reader for the lists of DDI document urls harvested by gather
+'''
+
+import array
+import hashlib
+import logging
+import zlib
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+GZIP_MAGIC = '\x1f\x8b'
+# The keys are unsigned longs where those have 64 bits ('Q' is Python 3
+# only). Elsewhere, as on 32-bit and Windows builds, they are doubles, which
+# hold integers of up to 53 bits exactly.
+if array.array('L').itemsize >= 8:
+    KEY_TYPECODE = 'L'
+    KEY_BITS = 64
+else:
+    KEY_TYPECODE = 'd'
+    KEY_BITS = 52
+
+
+def _url_key(url):
+    '''Return a non-zero int of KEY_BITS bits identifying 'url' for
+    duplicate detection.
+    '''
+    key = long(hashlib.md5(url).hexdigest(), 16) >> (128 - KEY_BITS)
+    return key or 1
+
+
+class KeySet(object):
+    '''Set of the non-zero int keys of _url_key().
+
+    The keys are kept in an open addressing hash table in an array, filled
+    to at most 70 %, so each key takes 12 to 23 bytes instead of the 70 or
+    more of an int in a Python set.
+
+    :param capacity: number of keys the table is first sized for
+    :type capacity: int
+    '''
+    MAX_LOAD = 0.7
+
+    def __init__(self, capacity=1024):
+        size = 16
+        while size * self.MAX_LOAD < capacity:
+            size *= 2
+        self._slots = array.array(KEY_TYPECODE, [0]) * size
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _insert(self, key):
+        slots = self._slots
+        mask = len(slots) - 1
+        i = key & mask
+        while True:
+            slot = slots[i]
+            if slot == 0:
+                slots[i] = key
+                self._count += 1
+                return True
+            if slot == key:
+                return False
+            i = (i + 1) & mask
+
+    def _grow(self):
+        old = self._slots
+        self._slots = array.array(KEY_TYPECODE, [0]) * (len(old) * 2)
+        self._count = 0
+        for key in old:
+            if key:
+                self._insert(long(key))
+
+    def add(self, key):
+        '''Add 'key' and return whether it was not in the set already.
+        '''
+        if self._count + 1 > len(self._slots) * self.MAX_LOAD:
+            self._grow()
+        return self._insert(key)
+
+
+def _iter_chunks(fileobj, chunk_size=CHUNK_SIZE):
+    '''Yield decompressed chunks of 'fileobj'. Gzip compressed data is
+    recognized from its magic bytes.
+    '''
+    chunk = fileobj.read(chunk_size)
+    if chunk.startswith(GZIP_MAGIC):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while chunk:
+            yield decompressor.decompress(chunk)
+            chunk = fileobj.read(chunk_size)
+        yield decompressor.flush()
+    else:
+        while chunk:
+            yield chunk
+            chunk = fileobj.read(chunk_size)
+
+
+def _iter_lines(fileobj):
+    '''Yield the lines of 'fileobj' without reading it all into memory.
+    '''
+    rest = ''
+    for chunk in _iter_chunks(fileobj):
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+def iter_urls(fileobj, limit=None):
+    '''Yield the unique urls listed in 'fileobj', one url per line.
+
+    Blank lines and lines starting with '#' are skipped and the list may be
+    gzip compressed. Reading stops as soon as 'limit' urls are found.
+
+    :param fileobj: file-like object, eg. the response of urllib2.urlopen()
+    :param limit: maximum number of urls to return
+    :type limit: int
+    :returns: the urls in the order of the list
+    :rtype: generator
+    '''
+    if limit is not None and limit <= 0:
+        return
+    seen = KeySet()
+    count = 0
+    for line in _iter_lines(fileobj):
+        url = line.strip()
+        if not url or url.startswith('#'):
+            continue
+        if not seen.add(_url_key(url)):
+            log.debug('Skipping duplicate url: {ur}'.format(ur=url))
+            continue
+        yield url
+        count += 1
+        if count == limit:
+            return
@@ -0,0 +1,143 @@
+# coding: utf-8
+'''
+Streaming export of the variables of DDI2 codebooks to CSV
+
+Reads the var elements of codeBook/dataDscr with lxml iterparse and writes
+one row per variable and one row per category (catgry) of a variable. Each
+variable is cleared after its rows are written, so memory use does not
+grow with the number of variables.
+'''
+
+import csv
+import io
+import logging
+
+import lxml.etree as etree
+
+log = logging.getLogger(__name__)
+
+VAR_HEADERS = ['ID',
+               'labl',
+               'preQTxt',
+               'qstnLit',
+               'postQTxt',
+               'ivuInstr',
+               'varFormat',
+               'TotlResp',
+               'range',
+               'item',
+               'sumStat_vald',
+               'sumStat_min',
+               'sumStat_max',
+               'sumStat_mean',
+               'sumStat_stdev',
+               'notes',
+               'txt']
+CODE_HEADERS = ['ID', 'catValu', 'labl', 'catStat']
+
+
+def _name(el):
+    return el.tag[el.tag.rfind('}') + 1:]
+
+
+def _text(el):
+    if len(el):
+        return u''.join(el.itertext()).strip()
+    return (el.text or u'').strip()
+
+
+def _encode(row, headers):
+    # The stdlib writer with encoded values is much faster than unicodecsv
+    values = []
+    for header in headers:
+        value = row.get(header)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        values.append(value or '')
+    return values
+
+
+def _attributes(el):
+    return u' '.join(u'{k},{v}'.format(k=k, v=v)
+                     for k, v in sorted(el.attrib.iteritems()))
+
+
+def var_row(var):
+    '''Return the row of the variable file for element 'var'.
+
+    Categories are left out, they are in the rows of code_rows().
+    '''
+    row = {'ID': var.get('ID', var.get('name'))}
+    for child in var.iterchildren(tag=etree.Element):
+        name = _name(child)
+        if name == 'catgry':
+            continue
+        elif name == 'valrng':
+            row['range'] = u' '.join(_attributes(r) for r in child)
+            continue
+        elif name == 'invalrng':
+            row['item'] = u' '.join(_attributes(i) for i in child)
+            continue
+        for el in child.iter(tag=etree.Element):
+            name = _name(el)
+            if name == 'labl':
+                if el.get('level') == 'variable':
+                    row['labl'] = _text(el)
+            elif name == 'sumStat':
+                row['sumStat_{t}'.format(t=el.get('type'))] = _text(el)
+            elif name == 'varFormat':
+                row['varFormat'] = _text(el) or el.get('type')
+            elif name in VAR_HEADERS:
+                row[name] = _text(el)
+    return row
+
+
+def code_rows(var):
+    '''Return the rows of the code file for the categories of element 'var'.
+    '''
+    var_id = var.get('ID', var.get('name'))
+    rows = []
+    for cat in var.iterchildren(tag='{*}catgry'):
+        row = {'ID': var_id}
+        for el in cat.iterchildren(tag=etree.Element):
+            name = _name(el)
+            if name in CODE_HEADERS and name not in row:
+                row[name] = _text(el)
+        rows.append(row)
+    return rows
+
+
+def write_variables(xml, var_file, code_file, stats=None):
+    '''Write the variables of DDI document 'xml' as CSV to 'var_file' and
+    their categories to 'code_file'.
+
+    :param xml: the DDI XML document
+    :type xml: string
+    :param var_file: binary file object for the variables
+    :param code_file: binary file object for the categories
+    :param stats: collects the statistics of the variables if given
+    :type stats: varstats.VariableStats
+    :returns: the number of variables written
+    :rtype: int
+    '''
+    var_writer = csv.writer(var_file)
+    code_writer = csv.writer(code_file)
+    var_writer.writerow(VAR_HEADERS)
+    code_writer.writerow(CODE_HEADERS)
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+    count = 0
+    for _, var in etree.iterparse(io.BytesIO(xml), tag='{*}var',
+                                  recover=True):
+        row = var_row(var)
+        codes = code_rows(var)
+        var_writer.writerow(_encode(row, VAR_HEADERS))
+        code_writer.writerows(_encode(code, CODE_HEADERS) for code in codes)
+        if stats is not None:
+            stats.add(row, codes)
+        count += 1
+        var.clear()
+        while var.getprevious() is not None:
+            del var.getparent()[0]
+    log.debug('Exported {n} variables'.format(n=count))
+    return count
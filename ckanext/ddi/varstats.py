@@ -0,0 +1,112 @@
+# coding: utf-8
+'''
+Columnar statistics of the variables of a DDI2 codebook
+
+Collects the summary statistics (sumStat) and category frequencies
+(catgry/catStat) read by :mod:`varexport` into NumPy columns and saves them
+as an .npz file next to the CSV export, so that aggregates over all
+variables of a dataset do not need the CSV files to be parsed.
+
+NumPy is optional. Without it the statistics are not collected.
+'''
+
+import array
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+STAT_COLUMNS = ('valid', 'min', 'max', 'mean', 'stdev')
+
+
+def available():
+    '''Return whether the statistics can be saved (NumPy is installed).
+    '''
+    return numpy is not None
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class VariableStats(object):
+    '''Statistics of the variables of one codebook, added one variable at a
+    time.
+
+    Columns of the saved file:
+
+    * ids: the variable ids
+    * valid, min, max, mean, stdev: float64, NaN when missing
+    * cat_var: index in ids of the variable of each category (int32)
+    * cat_value: the category values
+    * cat_freq: the category frequencies, float64, NaN when missing
+    '''
+
+    def __init__(self):
+        self.ids = []
+        self.stats = dict((name, array.array('d')) for name in STAT_COLUMNS)
+        self.cat_var = array.array('i')
+        self.cat_value = []
+        self.cat_freq = array.array('d')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, var_row, code_rows):
+        '''Add a variable from its varexport rows.
+
+        :param var_row: the row of varexport.var_row()
+        :type var_row: dict
+        :param code_rows: the rows of varexport.code_rows()
+        :type code_rows: list
+        '''
+        index = len(self.ids)
+        self.ids.append(unicode(var_row.get('ID') or u''))
+        for name in STAT_COLUMNS:
+            self.stats[name].append(
+                _number(var_row.get('sumStat_{n}'.format(
+                    n='vald' if name == 'valid' else name))))
+        for row in code_rows:
+            self.cat_var.append(index)
+            self.cat_value.append(unicode(row.get('catValu') or u''))
+            self.cat_freq.append(_number(row.get('catStat')))
+
+    def columns(self):
+        '''Return the columns as NumPy arrays by name.
+        '''
+        columns = {
+            'ids': numpy.array(self.ids, dtype=unicode),
+            'cat_var': numpy.frombuffer(self.cat_var, dtype=numpy.intc)
+            .astype(numpy.int32),
+            'cat_value': numpy.array(self.cat_value, dtype=unicode),
+            'cat_freq': numpy.frombuffer(self.cat_freq, dtype=numpy.float64),
+        }
+        for name in STAT_COLUMNS:
+            columns[name] = numpy.frombuffer(self.stats[name],
+                                             dtype=numpy.float64)
+        return columns
+
+    def save(self, stats_file):
+        '''Write the columns to 'stats_file' as a compressed .npz file.
+
+        :param stats_file: binary file object or path
+        '''
+        numpy.savez_compressed(stats_file, **self.columns())
+
+
+def load(stats_file):
+    '''Load the columns saved by VariableStats.save().
+
+    :param stats_file: binary file object or path
+    :returns: the arrays by column name
+    :rtype: dict
+    '''
+    with numpy.load(stats_file, allow_pickle=False) as columns:
+        return dict((name, columns[name]) for name in columns.files)
@@ -35,5 +35,8 @@ setup(
     # ddi3_harvester=ckanext.ddi.harvester:DDI3Harvester
     [paste.paster_command]
     ddi_import = ckanext.ddi.commands:DDIImporter
+    ddi_harvest_import = ckanext.ddi.commands:DDIHarvestImporter
+    [console_scripts]
+    ddi2jsonl = ckanext.ddi.offline:main
     """,
 )